@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import atexit
+import base64
+import contextlib
+import shutil
+import hashlib
+import logging
+import pathlib
+import threading
+import wave
+import numpy as np
+import lameenc
+# custom scripts
+import helpers
+import catalog
+import silence
+
+
+MP3_BIT_RATE = 192
+MP3_QUALITY = 2
+# The cache evicts the least recently used entries above this size
+DEFAULT_MAX_BYTES = 2 * 2**30
+# Lock of the index shared by the processes: a lock older than this was left by a dead process
+INDEX_LOCK_STALE_S = 60
+
+
+def read_wav(path: pathlib.Path) -> tuple[dict, bytes]:
+    """Reads PCM WAV and returns (params, raw_bytes)."""
+    with wave.open(path.as_posix(), "rb") as w:
+        params = {
+            "channels": w.getnchannels(),
+            "sampwidth": w.getsampwidth(),
+            "framerate": w.getframerate(),
+            "nframes": w.getnframes()
+        }
+        pcm = w.readframes(params["nframes"])
+    return params, pcm
+
+
+def slice_pcm(pcm: bytes, params: dict, start_ms: float, end_ms: float) -> bytes:
+    """Return PCM slice between start/end in ms."""
+    bytes_per_frame = params["channels"] * params["sampwidth"]
+    start_frame = int(start_ms / 1000 * params["framerate"])
+    end_frame = int(end_ms / 1000 * params["framerate"])
+    return pcm[start_frame * bytes_per_frame:end_frame * bytes_per_frame]
+
+
+def encode_mp3(pcm: bytes, params: dict) -> bytes:
+    encoder = lameenc.Encoder()
+    encoder.set_in_sample_rate(params["framerate"])
+    encoder.set_channels(params["channels"])
+    encoder.set_bit_rate(MP3_BIT_RATE)
+    encoder.set_quality(MP3_QUALITY)
+
+    mp3 = encoder.encode(pcm)
+    mp3 += encoder.flush()
+    return mp3
+
+
+class AudioCache(object):
+    """
+    Per-chapter audio artifacts, keyed by the sha1 of their source file, so that no stage decodes
+    or encodes the same audio twice:
+
+    - `info(wav)`: framerate, channels, sample width, frames and duration
+    - `split_mp3s(wav, bounds_ms)`: the encoded MP3 of each split
+    - `chapter_mp3(wav)`: the whole chapter as MP3 (served by the dashboard instead of the WAV)
+    - `peaks(wav, buckets)`: min/max waveform envelope for plotting
+    - `b64(mp3)`: base64 payload of an MP3 split, as sent to the model
+
+    Layout: `audio/cache/{source_sha1}/...` and `audio/cache/b64/{mp3_sha1}.b64`, with an
+    `index.json` holding the size and last access time of every entry. The least recently used
+    entries are evicted when the cache grows over `max_bytes`. Hits only update the index in memory:
+    it is saved on put and eviction, and at exit.
+
+    Several processes can share the cache (workers, splitter, dashboard): the index is saved under
+    a lock file, merged with the entries saved by the others, so that every entry counts toward `max_bytes`.
+    """
+    def __init__(self, path: pathlib.Path=None, max_bytes: int=DEFAULT_MAX_BYTES):
+        self.path = path if path is not None else helpers.AUDIO_PATH/"cache"
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = {"sources": {}, "entries": {}}
+        self._dirty = False
+
+        index_path = self.path/"index.json"
+        if index_path.exists():
+            self._index = json.load(open(index_path, "r"))
+        atexit.register(self.save)
+
+    @contextlib.contextmanager
+    def _index_lock(self):
+        """Lock file of the index, shared by every process using the cache"""
+        lock_path = self.path/"index.json.lock"
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - lock_path.stat().st_mtime > INDEX_LOCK_STALE_S:
+                        logging.warning(f"Removing the stale lock of the audio cache index: {lock_path.as_posix()}")
+                        lock_path.unlink()
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.05)
+        try:
+            os.write(fd, str(os.getpid()).encode("utf-8"))
+            os.close(fd)
+            yield
+        finally:
+            lock_path.unlink()
+
+    def _merge_index(self):
+        """Adds the entries and sources saved by the other processes, and drops the entries they evicted"""
+        try:
+            saved = json.load(open(self.path/"index.json", "r"))
+        except (FileNotFoundError, ValueError):
+            return
+        self._index["sources"] = {**saved.get("sources", {}), **self._index["sources"]}
+        entries = saved.get("entries", {})
+        for key, entry in self._index["entries"].items():
+            if key in entries:
+                entry = {**entry, "last_used": max(entry["last_used"], entries[key]["last_used"])}
+            entries[key] = entry
+        self._index["entries"] = {key: e for key, e in entries.items() if (self.path/key).exists()}
+
+    def _save_index(self, keep: str=None):
+        """Merges the index with the one on disk, evicts the least recently used entries if needed and saves it"""
+        if not self.path.exists():
+            self.path.mkdir(parents=True)
+        with self._index_lock():
+            self._merge_index()
+            self._evict(keep=keep)
+            tmp_path = self.path/f"index.json.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._index, f, indent=2)
+            tmp_path.replace(self.path/"index.json")
+        self._dirty = False
+
+    def save(self):
+        """Saves the access times and source hashes updated since the last put"""
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    def source_hash(self, path: pathlib.Path) -> str:
+        """sha1 of a source file, hashed again only when its size or mtime change"""
+        stat = path.stat()
+        key = path.resolve().as_posix()
+        cached = self._index["sources"].get(key)
+        if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached["sha1"]
+
+        sha1 = catalog.file_hash(path)
+        with self._lock:
+            self._index["sources"][key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": sha1}
+            self._dirty = True
+        return sha1
+
+    def _get(self, key: str) -> pathlib.Path:
+        """Path of a cached entry (file or folder), None on a miss"""
+        entry_path = self.path/key
+        if not entry_path.exists():
+            return None
+        with self._lock:
+            if key not in self._index["entries"]:
+                # Written by another process since the index was loaded
+                self._index["entries"][key] = {"bytes": self._size(entry_path)}
+            self._index["entries"][key]["last_used"] = time.time()
+            self._dirty = True
+        return entry_path
+
+    @staticmethod
+    def _size(entry_path: pathlib.Path) -> int:
+        return sum(f.stat().st_size for f in entry_path.rglob("*")) if entry_path.is_dir() else entry_path.stat().st_size
+
+    def _put(self, key: str, write_fn) -> pathlib.Path:
+        """Writes an entry with `write_fn(tmp_path)` and evicts the least recently used entries if needed"""
+        entry_path = self.path/key
+        tmp_path = entry_path.with_name(f"{entry_path.name}.{os.getpid()}.tmp")
+        tmp_path.parent.mkdir(parents=True, exist_ok=True)
+        write_fn(tmp_path)
+        if entry_path.is_dir():
+            shutil.rmtree(entry_path)
+        tmp_path.replace(entry_path)
+
+        with self._lock:
+            self._index["entries"][key] = {"bytes": self._size(entry_path), "last_used": time.time()}
+            self._save_index(keep=key)
+        return entry_path
+
+    def _evict(self, keep: str=None):
+        entries = self._index["entries"]
+        total = sum(e["bytes"] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            logging.info(f"Evicting '{key}' from the audio cache")
+            entry_path = self.path/key
+            if entry_path.is_dir():
+                shutil.rmtree(entry_path)
+            elif entry_path.exists():
+                entry_path.unlink()
+            if entry_path.parent != self.path and entry_path.parent.exists() and not any(entry_path.parent.iterdir()):
+                entry_path.parent.rmdir()
+            total -= entries.pop(key)["bytes"]
+
+    def info(self, wav: pathlib.Path) -> dict:
+        key = f"{self.source_hash(wav)}/info.json"
+        cached = self._get(key)
+        if cached:
+            return json.load(open(cached, "r"))
+
+        with wave.open(wav.as_posix(), "rb") as w:
+            info = {
+                "channels": w.getnchannels(),
+                "sampwidth": w.getsampwidth(),
+                "framerate": w.getframerate(),
+                "nframes": w.getnframes()
+            }
+        info["duration_s"] = info["nframes"] / info["framerate"]
+
+        def write_fn(p: pathlib.Path):
+            with open(p, "w") as f:
+                json.dump(info, f, indent=2)
+        self._put(key, write_fn)
+        return info
+
+    def split_mp3s(self, wav: pathlib.Path, bounds_ms: list[tuple[float, float]], pcm: tuple[dict, bytes]=None) -> list[bytes]:
+        """
+        MP3 of each `(start_ms, end_ms)` split of `wav`. On a miss the WAV is decoded once
+        (or `pcm=(params, raw_bytes)` is used when the caller already decoded it) and every split is encoded.
+        """
+        bounds_key = hashlib.sha1(
+            json.dumps([[round(s, 3), round(e, 3)] for s, e in bounds_ms] + [MP3_BIT_RATE, MP3_QUALITY]).encode("utf-8")
+        ).hexdigest()[:16]
+        key = f"{self.source_hash(wav)}/splits_{bounds_key}"
+        cached = self._get(key)
+        if cached:
+            return [(cached/f"{i}.mp3").read_bytes() for i in range(len(bounds_ms))]
+
+        params, raw = pcm if pcm is not None else read_wav(wav)
+        mp3s = [encode_mp3(slice_pcm(raw, params, s, e), params) for s, e in bounds_ms]
+
+        def write_fn(p: pathlib.Path):
+            p.mkdir(parents=True, exist_ok=True)
+            for i, mp3 in enumerate(mp3s):
+                (p/f"{i}.mp3").write_bytes(mp3)
+        self._put(key, write_fn)
+        return mp3s
+
+    def chapter_mp3(self, wav: pathlib.Path) -> pathlib.Path:
+        """Path of the whole chapter encoded as MP3"""
+        key = f"{self.source_hash(wav)}/chapter.mp3"
+        cached = self._get(key)
+        if cached:
+            return cached
+
+        params, raw = read_wav(wav)
+        mp3 = encode_mp3(raw, params)
+        return self._put(key, lambda p: p.write_bytes(mp3))
+
+    def peaks(self, wav: pathlib.Path, buckets: int=2000) -> np.ndarray:
+        """
+        `(buckets, 2)` array with the min and max sample (channels averaged, in [-1, 1]) of each
+        bucket, computed in a streaming pass over the WAV.
+        """
+        key = f"{self.source_hash(wav)}/peaks_{buckets}.npy"
+        cached = self._get(key)
+        if cached:
+            return np.load(cached)
+
+        params, blocks = silence.iter_wav(wav)
+        per_bucket = max(1, -(-params["nframes"] // buckets))
+        out = np.full((buckets, 2), [np.inf, -np.inf], dtype=np.float32)
+        offset = 0
+        carry = b""
+        bytes_per_frame = params["channels"] * params["sampwidth"]
+        for block in blocks:
+            block = carry + block
+            usable = len(block) - len(block) % bytes_per_frame
+            carry = block[usable:]
+            samples = silence.pcm_samples(block[:usable], params["sampwidth"]).reshape(-1, params["channels"]).mean(axis=1)
+
+            bucket_ix = (offset + np.arange(len(samples))) // per_bucket
+            starts = np.flatnonzero(np.r_[True, np.diff(bucket_ix) > 0])
+            mins = np.minimum.reduceat(samples, starts)
+            maxs = np.maximum.reduceat(samples, starts)
+            ix = bucket_ix[starts]
+            # A bucket can span two blocks
+            out[ix, 0] = np.minimum(out[ix, 0], mins)
+            out[ix, 1] = np.maximum(out[ix, 1], maxs)
+            offset += len(samples)
+        # Buckets past the end of a short file
+        out[~np.isfinite(out)] = 0
+
+        def write_fn(p: pathlib.Path):
+            with open(p, "wb") as f:
+                np.save(f, out)
+        self._put(key, write_fn)
+        return out
+
+    def b64(self, mp3: pathlib.Path, sha1: str=None) -> str:
+        """Base64 payload of an MP3 split. Pass `sha1` when already known (e.g. from the SplitCatalog)."""
+        key = f"b64/{sha1 if sha1 else self.source_hash(mp3)}.b64"
+        cached = self._get(key)
+        if cached:
+            return cached.read_text()
+
+        payload = base64.b64encode(mp3.read_bytes()).decode("utf-8")
+        self._put(key, lambda p: p.write_text(payload))
+        return payload
@@ -0,0 +1,438 @@
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import wave
+import numpy as np
+import pandas as pd
+# custom scripts
+import helpers
+import taxonomy
+import transcript
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: peak RSS is not recorded
+    resource = None
+
+
+HISTORY_PATH = helpers.BASE_PATH/"output/benchmarks/history.jsonl"
+# Current and peak RSS of the process on Linux
+PROC_STATUS = pathlib.Path("/proc/self/status")
+STAGES = ["scrape", "edit", "split_csv", "split_wav", "merge"]
+# Commands that must start fast (they don't need the heavy dependencies), with their budget in seconds
+STARTUP_COMMANDS = {
+    "main.py --help": (["main.py", "--help"], 0.5),
+    "main.py status": (["main.py", "status"], 0.5),
+    "main.py edit --dry-run": (["main.py", "edit", "--dry-run"], 0.5),
+    "main.py run --dry-run": (["main.py", "run", "--dry-run"], 0.5),
+    "classifier.py --help": (["classifier.py", "--help"], 0.5),
+}
+MAIN_CONTAINER_CLASSES = (
+    "wp-block-group__inner-container is-layout-constrained "
+    "wp-container-core-group-is-layout-5ca99053 wp-block-group-is-layout-constrained"
+)
+SPEAKERS = ["Gustave", "Maelle", "Lune", "Sciel", "Verso", "Monoco", "Esquie", "Noco", "Gestral warrior"]
+WORDS = (
+    "we fight for those who come after the paintress wakes tomorrow comes expedition "
+    "lumiere gommage canvas never again light shadow remember"
+).split()
+
+
+class SyntheticCorpus(object):
+    """
+    Generates a synthetic corpus with the same layout as `data/`: transcript HTML pages,
+    raw CSVs, edit and split rules and WAV files.
+    """
+    def __init__(self, root: pathlib.Path, chapters: int, lines: int, audio_hours: float,
+                 splits: int=3, framerate: int=22050, seed: int=33):
+        self.root = root
+        self.chapters = chapters
+        self.lines = lines
+        self.audio_seconds = int(audio_hours * 3600 / chapters)
+        self.splits = splits
+        self.framerate = framerate
+        self.rng = np.random.default_rng(seed)
+
+    def chapter_name(self, i: int) -> str:
+        return f"{i}_Synthetic_Chapter_{i}"
+
+    def generate(self) -> "SyntheticCorpus":
+        for folder in ["0_data_manip_cfg", "html", "csv/1_raw", "csv/2_edits/custom_inserts", "csv/3_splits",
+                       "audio/2_edits", "audio/3_splits"]:
+            (self.root/folder).mkdir(parents=True, exist_ok=True)
+
+        edit_rules = {"inserts": [], "deletes": []}
+        split_rules = []
+        for i in range(self.chapters):
+            df = self._transcript(i)
+            df.to_csv(self.root/f"csv/1_raw/{self.chapter_name(i)}.csv", index=False, **helpers.CSV_SETTINGS)
+            (self.root/f"html/{self.chapter_name(i)}.html").write_text(self._html(i, df), encoding="utf-8")
+
+            dialogues = int(df["dialogue_index"].max()) + 1
+            edit_rules["deletes"].append({
+                "source": self.chapter_name(i),
+                "ranges": [{"dial_s": 1, "line_s": 0, "dial_e": 1, "line_e": 1}]
+            })
+            split_rules.append(self._split_rule(i, dialogues))
+            self._wav(self.root/f"audio/2_edits/{self.chapter_name(i)}.wav")
+
+        json.dump(edit_rules, open(self.root/"0_data_manip_cfg/edit_rules.json", "w"), indent=2)
+        json.dump(split_rules, open(self.root/"0_data_manip_cfg/split_rules.json", "w"), indent=2)
+        # The emotions classified are those of the repository
+        shutil.copy(pathlib.Path(__file__).parent/"data"/taxonomy.TAXONOMY_FILE, self.root/taxonomy.TAXONOMY_FILE)
+        return self
+
+    def _transcript(self, chapter_ix: int) -> pd.DataFrame:
+        # Dialogues of 1 to 15 lines
+        lengths = self.rng.integers(1, 16, size=self.lines)
+        dialogue_index = np.repeat(np.arange(len(lengths)), lengths)[:self.lines]
+        line_index = pd.Series(dialogue_index).groupby(dialogue_index).cumcount().to_numpy()
+
+        words = self.rng.choice(WORDS, size=(self.lines, 12))
+        return pd.DataFrame({
+            "chapter_index": chapter_ix,
+            "chapter": f"Synthetic Chapter {chapter_ix}",
+            "dialogue_index": dialogue_index,
+            "line_index": line_index,
+            "speaker": self.rng.choice(SPEAKERS + ["narrator"], size=self.lines),
+            "line": [" ".join(w).capitalize() + "." for w in words],
+        })
+
+    def _html(self, chapter_ix: int, df: pd.DataFrame) -> str:
+        paragraphs = []
+        for _, dialogue in df.groupby("dialogue_index"):
+            children = []
+            last_speaker = None
+            for speaker, line in zip(dialogue["speaker"], dialogue["line"]):
+                if speaker == "narrator":
+                    children.append(f"<em>{line}</em>")
+                else:
+                    if speaker != last_speaker:
+                        children.append(f"<strong>{speaker}:</strong> ")
+                    children.append(line)
+                last_speaker = speaker
+                children.append("<br/>")
+            paragraphs.append(f"<p>{''.join(children)}</p>")
+
+        return textwrap.dedent(f"""
+            <html><body>
+            <h1 class="has-text-align-center">Synthetic Chapter {chapter_ix}</h1>
+            <div class="{MAIN_CONTAINER_CLASSES}">
+            {"".join(paragraphs)}
+            <p class="has-text-align-right"><a href="{self.chapter_name(chapter_ix + 1)}.html">Next Chapter</a></p>
+            </div>
+            </body></html>
+        """)
+
+    def _split_rule(self, chapter_ix: int, dialogues: int) -> dict:
+        bounds = np.linspace(0, dialogues, self.splits + 1).astype(int)
+        ranges = []
+        for s in range(self.splits):
+            last = s == self.splits - 1
+            ranges.append({
+                "dial_s": int(bounds[s]), "line_s": 0,
+                "dial_e": -1 if last else int(bounds[s + 1]) - 1, "line_e": -1 if last else 99
+            })
+
+        seconds = np.linspace(0, self.audio_seconds, self.splits + 1).astype(int)[1:-1]
+        return {
+            "source": self.chapter_name(chapter_ix),
+            "ranges": ranges,
+            "timestamps": [f"{s // 60:02d}:{s % 60:02d}" for s in seconds]
+        }
+
+    def _wav(self, path: pathlib.Path):
+        # Written in one-minute blocks, so that hours of audio don't need to fit in memory
+        with wave.open(path.as_posix(), "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(self.framerate)
+            for start in range(0, self.audio_seconds, 60):
+                t = np.arange(start * self.framerate, min(start + 60, self.audio_seconds) * self.framerate) / self.framerate
+                signal = 0.3 * np.sin(2 * np.pi * 220 * t) + 0.05 * self.rng.standard_normal(len(t))
+                w.writeframes((signal * 32767).astype(np.int16).tobytes())
+
+
+def _use_corpus(root: pathlib.Path):
+    # The pipeline modules resolve their folders through `helpers` at call time
+    helpers.BASE_PATH = root
+    helpers.CSV_PATH = root/"csv"
+    helpers.AUDIO_PATH = root/"audio"
+
+
+def _fake_response(df: pd.DataFrame, emotions: list[str], rng: np.random.Generator) -> dict:
+    ids = df["dialogue_index"].astype(str) + "_" + df["line_index"].astype(str)
+    scores = rng.dirichlet(np.ones(len(emotions)), size=len(df)).round(1)
+    content = {i: dict(zip(emotions, row.tolist())) for i, row in zip(ids, scores)}
+    return {"choices": [{"finish_reason": "stop", "message": {"content": json.dumps(content)}}]}
+
+
+def _stage_scrape(root: pathlib.Path) -> dict:
+    from scraper import Scraper
+
+    scraper = Scraper(parser="html.parser")
+    pages = sorted((root/"html").iterdir())
+    rows = 0
+    start = _start()
+    for page in pages:
+        scraper.load_html(page.read_text(encoding="utf-8"))
+        rows += len(scraper.parse_dialogues(chapter=page.stem))
+    return {"start": start, "items": len(pages), "rows": rows}
+
+
+def _stage_edit(root: pathlib.Path) -> dict:
+    from editor import Editor
+
+    editor = Editor(cmd_line_args=argparse.Namespace(keep_narrator=False, keep_gibberish=False))
+    start = _start()
+    editor.main()
+    return {"start": start, "items": len(list((root/"csv/2_edits").glob("*.csv")))}
+
+
+def _stage_split_csv(root: pathlib.Path) -> dict:
+    from splitter import Splitter
+
+    splitter = Splitter()
+    splitter.delete_existing_files()
+    csvs = sorted((root/"csv/2_edits").glob("*.csv"))
+    start = _start()
+    for csv in csvs:
+        splitter._split_csv(csv)
+    return {"start": start, "items": len(csvs)}
+
+
+def _stage_split_wav(root: pathlib.Path) -> dict:
+    from splitter import Splitter
+
+    # Keep the csv splits written by the previous stage
+    splitter = Splitter(delete_existing=False)
+    wavs = sorted((root/"audio/2_edits").glob("*.wav"))
+    start = _start()
+    for wav in wavs:
+        splitter._split_wav(wav)
+    return {"start": start, "items": len(wavs), "bytes": sum(w.stat().st_size for w in wavs)}
+
+
+def _stage_merge(root: pathlib.Path) -> dict:
+    from classifier import Classifier
+
+    classifier = Classifier()
+    emotions = classifier.target_emotions + ["neutral"]
+    rng = np.random.default_rng(33)
+
+    # Prepare dialogues and fake model responses outside of the timed section
+    chunks = []
+    for pair in classifier.pairs:
+        for _, csv_file, _ in pair:
+            df = transcript.read_transcript(csv_file)
+            classifier.prep_dialogue(df)
+            chunks.append((df, _fake_response(df, emotions, rng)))
+
+    rows = 0
+    start = _start()
+    for df, response in chunks:
+        rows += len(classifier.merge_response_and_dialogues(df, response))
+    return {"start": start, "items": len(chunks), "rows": rows}
+
+
+def _memory_mb() -> tuple[float, float]:
+    """Current and peak RSS of the process in MB (NaN when unknown)"""
+    if PROC_STATUS.exists():
+        status = dict(line.split(":", 1) for line in PROC_STATUS.read_text().splitlines() if ":" in line)
+        return int(status["VmRSS"].split()[0]) / 1024, int(status["VmHWM"].split()[0]) / 1024
+    if resource is None:
+        return float("nan"), float("nan")
+    # Only the peak is known: kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if platform.system() == "Darwin" else 1024)
+    return peak, peak
+
+
+def _start() -> tuple[float, float, float]:
+    """
+    Start of the timed section of a stage, after its imports and setup: wall time, CPU time and RSS baseline.
+    On Linux the peak RSS is reset, so that it only covers the timed section. Elsewhere the baseline is
+    the peak reached so far, and a stage is only measured when it goes over it.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        baseline = _memory_mb()[0]
+    except OSError:
+        baseline = _memory_mb()[1]
+    return time.perf_counter(), time.process_time(), baseline
+
+
+def _run_stage(stage: str, root: pathlib.Path) -> dict:
+    """Runs a single stage in the current process and returns its metrics"""
+    _use_corpus(root)
+    logging.disable(logging.INFO)
+
+    result = globals()[f"_stage_{stage}"](root)
+    wall_start, cpu_start, rss_start = result.pop("start")
+    result["wall_s"] = time.perf_counter() - wall_start
+    result["cpu_s"] = time.process_time() - cpu_start
+    # The RSS of the process is dominated by the imports: the stage is measured by its peak over the baseline
+    result["peak_rss_mb"] = _memory_mb()[1]
+    result["stage_rss_mb"] = result["peak_rss_mb"] - rss_start
+    return result
+
+
+def run_stage(stage: str, root: pathlib.Path) -> dict:
+    """
+    Runs a stage in a fresh process, so that its peak RSS is not inflated by the previous stages.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1) as pool:
+        return pool.apply(_run_stage, (stage, root))
+
+
+def startup_time(command: list[str], repeat: int=5) -> float:
+    """Median wall time of a command of the repo, run in a fresh interpreter"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, cwd=pathlib.Path(__file__).parent, capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def check_startup(history_path: pathlib.Path, repeat: int=5) -> bool:
+    """
+    Times the STARTUP_COMMANDS and appends them to the history.
+    Returns False when a command is over its budget.
+    """
+    scale = {"startup_repeat": repeat}
+    previous = previous_results(history_path, scale)
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    commit = git_commit()
+    ok = True
+    for name, (command, budget_s) in STARTUP_COMMANDS.items():
+        wall_s = startup_time(command, repeat)
+        record = {
+            "timestamp": now, "commit": commit, "python": platform.python_version(),
+            "platform": platform.platform(), "stage": f"startup {name}", "scale": scale, "wall_s": wall_s, "budget_s": budget_s
+        }
+        with open(history_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+        delta = ""
+        if record["stage"] in previous:
+            change = (wall_s - previous[record["stage"]]["wall_s"]) / previous[record["stage"]]["wall_s"]
+            delta = f" ({change:+.0%} vs {previous[record['stage']]['commit']})"
+        if wall_s > budget_s:
+            ok = False
+            logging.error(f"{name:<24} wall {wall_s:6.3f}s | over the {budget_s}s budget{delta}")
+        else:
+            logging.info(f"{name:<24} wall {wall_s:6.3f}s | budget {budget_s}s{delta}")
+    return ok
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=pathlib.Path(__file__).parent,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_results(history_path: pathlib.Path, scale: dict) -> dict:
+    """Latest recorded result of each stage at the same scale"""
+    previous = {}
+    if not history_path.exists():
+        return previous
+
+    for line in open(history_path, "r"):
+        record = json.loads(line)
+        if record["scale"] == scale:
+            previous[record["stage"]] = record
+    return previous
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(
+            """
+            Benchmark the pipeline stages on a synthetic corpus.
+            Wall time, CPU time and peak RSS of each stage are appended to 'output/benchmarks/history.jsonl'
+            and compared with the previous run at the same scale. The peak RSS of a stage only covers its
+            timed section (after its imports and setup), and the stage RSS is its growth over the RSS at the start.
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--chapters", type=int, default=5, help="Number of synthetic chapters")
+    parser.add_argument("--lines", type=int, default=300, help="Number of lines per chapter")
+    parser.add_argument("--audio-hours", type=float, default=0.25, help="Total hours of audio across all chapters")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to time")
+    parser.add_argument("--workdir", type=pathlib.Path, help="Where to generate the corpus (default: temporary folder)")
+    parser.add_argument("--keep", action="store_true", help="Do not delete the generated corpus")
+    parser.add_argument("--history", type=pathlib.Path, default=HISTORY_PATH, help="History file")
+    parser.add_argument(
+        "--startup", action="store_true",
+        help="Only time the startup of the CLIs ('--help', 'status', '--dry-run'). Exits with 1 when one is over its budget"
+    )
+    args = parser.parse_args()
+    logging.info(f"Running with arguments: {args}")
+
+    if args.startup:
+        if not args.history.parent.exists():
+            args.history.parent.mkdir(parents=True)
+        sys.exit(0 if check_startup(args.history) else 1)
+
+    scale = {"chapters": args.chapters, "lines": args.lines, "audio_hours": args.audio_hours}
+    root = args.workdir or pathlib.Path(tempfile.mkdtemp(prefix="e33_bench_"))
+
+    logging.info(f"Generating synthetic corpus in {root.as_posix()}")
+    SyntheticCorpus(root, args.chapters, args.lines, args.audio_hours).generate()
+
+    previous = previous_results(args.history, scale)
+    if not args.history.parent.exists():
+        args.history.parent.mkdir(parents=True)
+
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    commit = git_commit()
+    try:
+        last_stage = max(STAGES.index(s) for s in args.stages)
+        for stage in STAGES[:last_stage + 1]:
+            if stage not in args.stages:
+                # Each stage reads the outputs of the previous one: run it, but don't record it
+                logging.info(f"{stage:<10} (not timed, needed by the next stages)")
+                run_stage(stage, root)
+                continue
+
+            result = run_stage(stage, root)
+            record = {
+                "timestamp": now, "commit": commit, "python": platform.python_version(),
+                "platform": platform.platform(), "stage": stage, "scale": scale, **result
+            }
+            with open(args.history, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+            delta = ""
+            if stage in previous:
+                change = (result["wall_s"] - previous[stage]["wall_s"]) / previous[stage]["wall_s"]
+                delta = f" ({change:+.0%} vs {previous[stage]['commit']})"
+            logging.info(
+                f"{stage:<10} wall {result['wall_s']:8.3f}s | cpu {result['cpu_s']:8.3f}s | "
+                f"stage RSS {result.get('stage_rss_mb', float('nan')):+7.1f} MB "
+                f"(peak {result.get('peak_rss_mb', float('nan')):.1f} MB){delta}"
+            )
+    finally:
+        if not args.keep and args.workdir is None:
+            shutil.rmtree(root)
@@ -0,0 +1,157 @@
+import re
+import json
+import hashlib
+import logging
+import os
+import pathlib
+# custom scripts
+import helpers
+
+
+SPLIT_PATTERN = re.compile(r"(.+)_([0-9]+)$")
+SPLIT_TYPES = ["csv", "mp3"]
+
+
+def split_folders() -> dict[str, pathlib.Path]:
+    return {"csv": helpers.CSV_PATH/"3_splits", "mp3": helpers.AUDIO_PATH/"3_splits"}
+
+
+def chapter_splits(chapter: str, split_type: str) -> list[pathlib.Path]:
+    """Existing csv or mp3 splits of a chapter: `{chapter}.{split_type}` or `{chapter}_{i}.{split_type}`"""
+    folder = split_folders()[split_type]
+    pattern = re.compile(rf"{re.escape(chapter)}(_[0-9]+)?\.{split_type}")
+    return sorted(f for f in folder.iterdir() if pattern.fullmatch(f.name)) if folder.exists() else []
+
+
+def chapter_order(chapter: str) -> int:
+    """Chapters are prefixed by their index, e.g. '12_Old_Lumiere'"""
+    try:
+        return int(chapter.split("_")[0])
+    except ValueError:
+        return -1
+
+
+def file_hash(path: pathlib.Path) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class SplitCatalog(object):
+    """
+    Sorted index of `(chapter, split) -> {csv, mp3, sizes, hashes}` for the files in the `3_splits` folders.
+
+    The catalog is saved next to the csv splits. On `refresh()` only new or modified files
+    (by size and mtime) are hashed again.
+    """
+    def __init__(self, path: pathlib.Path=None):
+        self.path = path if path is not None else helpers.CSV_PATH/"3_splits/catalog.json"
+        self.entries: dict[tuple[str, int], dict] = {}
+        self.by_chapter: dict[str, list[int]] = {}
+        self._files: dict[str, dict] = {}
+
+        if self.path.exists():
+            saved = json.load(open(self.path, "r"))
+            self._files = saved.get("files", {})
+
+    def _known_chapters(self) -> set[str]:
+        # Unsplit chapters are copied as-is by the Splitter: their name must not be parsed as "{chapter}_{split}"
+        edits = helpers.CSV_PATH/"2_edits"
+        if not edits.exists():
+            return set()
+        return {f.stem for f in edits.iterdir() if f.suffix == ".csv"}
+
+    def parse_name(self, stem: str, known_chapters: set[str]) -> tuple[str, int]:
+        if stem in known_chapters:
+            return stem, 0
+
+        match = SPLIT_PATTERN.match(stem)
+        if match:
+            return match.group(1), int(match.group(2))
+        return stem, 0
+
+    def _file_info(self, path: pathlib.Path) -> dict:
+        key = path.relative_to(helpers.BASE_PATH).as_posix()
+        stat = path.stat()
+        cached = self._files.get(key)
+        if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached
+
+        info = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": file_hash(path)}
+        self._files[key] = info
+        return info
+
+    def refresh(self, save: bool=True) -> "SplitCatalog":
+        """
+        Scans the split folders, hashes new or modified files only, and saves the catalog (unless `save` is False).
+        """
+        known_chapters = self._known_chapters()
+        found: dict[tuple[str, int], dict] = {}
+        seen_files = set()
+
+        for split_type, folder in split_folders().items():
+            for f in folder.iterdir():
+                if not f.is_file() or f.suffix != f".{split_type}":
+                    continue
+
+                chapter, split = self.parse_name(f.stem, known_chapters)
+                info = self._file_info(f)
+                seen_files.add(f.relative_to(helpers.BASE_PATH).as_posix())
+
+                entry = found.setdefault((chapter, split), {"chapter": chapter, "split": split})
+                entry[split_type] = f
+                entry[f"{split_type}_size"] = info["size"]
+                entry[f"{split_type}_sha1"] = info["sha1"]
+
+        # Forget files that no longer exist
+        self._files = {k: v for k, v in self._files.items() if k in seen_files}
+
+        for key, entry in found.items():
+            missing = [t for t in SPLIT_TYPES if t not in entry]
+            if missing:
+                logging.warning(f"Split {key[0]} #{key[1]} has no {'/'.join(missing)} file. Skipped.")
+
+        complete = [k for k, e in found.items() if all(t in e for t in SPLIT_TYPES)]
+        complete.sort(key=lambda k: (chapter_order(k[0]), k[0], k[1]))
+        self.entries = {k: found[k] for k in complete}
+        self.by_chapter = {}
+        for chapter, split in complete:
+            self.by_chapter.setdefault(chapter, []).append(split)
+
+        if save:
+            self.save()
+        return self
+
+    def save(self):
+        if not self.path.parent.exists():
+            self.path.parent.mkdir(parents=True)
+
+        splits = []
+        for entry in self.entries.values():
+            out = dict(entry)
+            for split_type in SPLIT_TYPES:
+                out[split_type] = entry[split_type].relative_to(helpers.BASE_PATH).as_posix()
+            splits.append(out)
+
+        # Atomic replace: several worker processes can refresh the catalog at the same time
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"splits": splits, "files": self._files}, f, indent=2)
+        tmp_path.replace(self.path)
+
+    def chapters(self) -> list[str]:
+        return list(self.by_chapter.keys())
+
+    def splits(self, chapter: str) -> list[int]:
+        return self.by_chapter.get(chapter, [])
+
+    def get(self, chapter: str, split: int) -> dict:
+        return self.entries[(chapter, split)]
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
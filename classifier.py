@@ -1,49 +1,263 @@
-import openai
-import re
+from __future__ import annotations
+import argparse
+import textwrap
+import threading
 import datetime
 import json
 import logging
+import os
 import pathlib
 import base64
 import typing
-import curses
-import pandas as pd
-from typing import Dict, List, Set, Optional
+from typing import Dict, List, Set, Optional, TYPE_CHECKING
 from pprint import pprint
 # custom imports
 import helpers
+import catalog
+import instrumentation
+
+if TYPE_CHECKING:
+    import curses
+    import pandas as pd
+    import dedup
+    import journal
+    import planner
+
+# curses, numpy, pandas and the modules depending on them are imported where they are used:
+# '--help' and the argument errors don't load them
+
+
+class ClassificationStatus(object):
+    """
+    Classification status of each chapter and split, with the metadata of the last run.
+
+    Computing it needs to list and read the output folders, which can be slow on networked filesystems:
+    it is computed once in a background thread and cached on disk. A chapter is only recomputed when
+    its output folders or its splits change.
+    """
+    CACHE_PATH = helpers.BASE_PATH/"output/classification_status.json"
+
+    def __init__(self, pairs: list["Pair"]):
+        self.pairs: Dict[str, Pair] = {p.chapter: p for p in pairs}
+        self.chapters: Dict[str, dict] = {}
+        self.ready = threading.Event()
+
+    def load_async(self) -> "ClassificationStatus":
+        threading.Thread(target=self._load_in_background, daemon=True).start()
+        return self
+
+    def _load_in_background(self):
+        try:
+            self.load()
+        except Exception:
+            logging.exception("Loading the classification status failed")
+            self.chapters = self.chapters or {chapter: self._failed() for chapter in self.pairs}
+        finally:
+            # The UI waits for it: set even on failure
+            self.ready.set()
+
+    def load(self) -> Dict[str, dict]:
+        cache = {}
+        if self.CACHE_PATH.exists():
+            try:
+                cache = json.load(open(self.CACHE_PATH, "r"))
+            except (OSError, ValueError):
+                logging.warning("Classification status cache is corrupted. Rebuilding it.")
+
+        chapters = {}
+        for chapter, pair in self.pairs.items():
+            try:
+                signature = self._signature(chapter, pair)
+                cached = cache.get(chapter)
+                # Entries written by older versions are recomputed
+                if isinstance(cached, dict) and cached.get("signature") == signature and "splits" in cached:
+                    chapters[chapter] = cached
+                else:
+                    chapters[chapter] = self._compute(chapter, pair)
+                    chapters[chapter]["signature"] = signature
+            except Exception:
+                logging.exception(f"Classification status of '{chapter}' failed")
+                chapters[chapter] = self._failed()
+
+        self.chapters = chapters
+        self.ready.set()
+
+        try:
+            with open(self.CACHE_PATH, "w") as f:
+                # Failed chapters are computed again next time
+                json.dump({c: s for c, s in chapters.items() if not s.get("failed")}, f, indent=2)
+        except OSError as e:
+            logging.warning(f"Could not save the classification status cache: {e}")
+        return chapters
+
+    @staticmethod
+    def _failed() -> dict:
+        return {"classified": False, "failed": True, "runs": 0, "last_run": None, "tokens": None, "splits": {}}
+
+    def get(self, chapter: str) -> Optional[dict]:
+        """Returns None while the status is still loading"""
+        if not self.ready.is_set():
+            return None
+        return self.chapters.get(chapter)
+
+    def _signature(self, chapter: str, pair: "Pair") -> list[int]:
+        import stability
+
+        folders = [stability.EMOTIONS_SCORED_PATH/chapter, stability.API_RESPONSES_PATH/chapter]
+        return (
+            [f.stat().st_mtime_ns if f.exists() else 0 for f in folders] +
+            [f.stat().st_mtime_ns for f in pair.csv.splits]
+        )
+
+    def _compute(self, chapter: str, pair: "Pair") -> dict:
+        import pandas as pd
+        import comparison
+        import stability
+        import transcript
+
+        status = {"classified": False, "runs": 0, "last_run": None, "tokens": None, "splits": {}}
+        scored_dir = stability.EMOTIONS_SCORED_PATH/chapter
+        runs = [f for f in scored_dir.iterdir() if f.suffix == ".csv"] if scored_dir.exists() else []
+        if not runs:
+            status["splits"] = {str(i): False for i in pair.csv.indices}
+            return status
+
+        latest = max(runs, key=stability.run_time)
+        status["classified"] = True
+        status["runs"] = len(runs)
+        status["last_run"] = latest.stem.split("_")[0]
+
+        usage = stability.load_chapter_usage(chapter)
+        latest_usage = usage[usage["run"] == latest.stem]
+        if not latest_usage.empty:
+            status["tokens"] = int(latest_usage["prompt_tokens"].sum() + latest_usage["completion_tokens"].sum())
+
+        # A split is classified when every one of its lines was scored by at least one run
+        keys = ["dialogue_index", "line_index"]
+        scored = transcript.concat(transcript.read_transcript(r) for r in runs)
+        scored = scored.dropna(subset=comparison.emotion_columns(scored), how="all")
+        scored_keys = pd.MultiIndex.from_frame(scored[keys])
+        for i, split_csv in zip(pair.csv.indices, pair.csv.splits):
+            split_keys = pd.MultiIndex.from_frame(pd.read_csv(split_csv.as_posix(), usecols=keys, **helpers.CSV_SETTINGS))
+            status["splits"][str(i)] = bool(split_keys.isin(scored_keys).all())
+
+        return status
 
 
 class ChapterSelectionUI:
-    def __init__(self, data: Dict[str, List[str]]) -> None:
-        self.data: Dict[str, List[str]] = data
+    def __init__(self, data: Dict[str, List[int]], status: ClassificationStatus=None, planner: "planner.Planner"=None) -> None:
+        self.data: Dict[str, List[int]] = data
         self.chapters: List[str] = list(data.keys())
-        self.selections: Dict[str, Set[str]] = {ch: set() for ch in self.chapters}
+        self.selections: Dict[str, Set[int]] = {ch: set() for ch in self.chapters}
         self.idx: int = 0
+        self.status: Optional[ClassificationStatus] = status
+        self.planner = planner
+        # Plan summary and per-chapter estimates of the last selection
+        self._plan_key: tuple = None
+        self._plan_line: str = ""
+        self._plan_chapters: Optional["pd.DataFrame"] = None
+        # Screen row -> text currently drawn on it
+        self._rendered: Dict[int, str] = {}
 
     # Utility
     @staticmethod
     def wrap_index(idx: int, total: int) -> int:
         return idx % total
 
+    def _reset_screen(self, stdscr: curses.window):
+        stdscr.erase()
+        self._rendered = {}
+
+    def _draw(self, stdscr: curses.window, lines: List[str]):
+        """Redraws only the screen lines that changed since the last call"""
+        import curses
+
+        for row, text in enumerate(lines[:curses.LINES]):
+            text = text[:curses.COLS-1]
+            if self._rendered.get(row) != text:
+                stdscr.move(row, 0)
+                stdscr.clrtoeol()
+                stdscr.addstr(row, 0, text)
+                self._rendered[row] = text
+
+        for row in [r for r in self._rendered if r >= len(lines)]:
+            stdscr.move(row, 0)
+            stdscr.clrtoeol()
+            del self._rendered[row]
+
+        stdscr.refresh()
+
+    def _getch(self, stdscr: curses.window) -> int:
+        import curses
+
+        key: int = stdscr.getch()
+        if key == curses.KEY_RESIZE:
+            curses.update_lines_cols()
+            self._reset_screen(stdscr)
+        return key
+
+    def _chapter_status(self, chapter: str) -> tuple[str, str]:
+        """Returns the [C] marker and the last run description of a chapter"""
+        if self.status is None:
+            return "[ ]", ""
+
+        status = self.status.get(chapter)
+        if status is None:
+            return "[.]", ""
+        if status.get("failed"):
+            return "[!]", "(status failed, see the log)"
+        if not status["classified"]:
+            return "[ ]", ""
+
+        tokens = f", {status['tokens']/1000:.1f}k tokens" if status["tokens"] else ""
+        return "[C]", f"({status['runs']} runs, last {status['last_run']}{tokens})"
+
+    def _plan_summary(self) -> str:
+        """Estimate of the run of the current selection, recomputed only when the selection changed"""
+        if self.planner is None:
+            return ""
+        key = tuple((ch, tuple(sorted(items))) for ch, items in self.selections.items() if items)
+        if key != self._plan_key:
+            self._plan_key = key
+            self._plan_line = "Plan: " + self.planner.describe(self.planner.summary(dict(key))) if key else ""
+            self._plan_chapters = None
+        return self._plan_line
+
+    def _chapter_estimates(self) -> Optional["pd.DataFrame"]:
+        """Requests, audio and cost of each selected chapter, recomputed only when the selection changed"""
+        self._plan_summary()
+        if self._plan_chapters is None and self._plan_key:
+            plan = self.planner.plan(dict(self._plan_key))
+            self._plan_chapters = plan.groupby("chapter")[["request", "audio_s", "cost"]].sum()
+        return self._plan_chapters
+
+    def _split_classified(self, chapter: str, split: int) -> bool:
+        status = self.status.get(chapter) if self.status else None
+        return bool(status and status["splits"].get(str(split)))
+
     # Subchapter selection screen (scrollable)
     def select_subchapters(
         self,
         stdscr: curses.window,
         chapter: str,
-        selected: Set[str],
-        choices: List[str]
-    ) -> Set[str]:
+        selected: Set[int],
+        choices: List[int]
+    ) -> Set[int]:
+        import curses
+
         idx: int = 0
         n: int = len(choices)
-        max_lines: int = curses.LINES - 5  # reserve lines for header
         offset: int = 0
+        self._reset_screen(stdscr)
 
         while True:
-            stdscr.clear()
-            stdscr.addstr(0, 0, "Arrow keys: navigate | s: toggle | a: all | d: none | q: back"[:curses.COLS-1])
-            stdscr.addstr(1, 0, f"Chapter: {chapter}"[:curses.COLS-1])
-            stdscr.addstr(2, 0, "-" * (curses.COLS-1))
+            max_lines: int = curses.LINES - 5  # reserve lines for header
+            lines: List[str] = [
+                "Arrow keys: navigate | s: toggle | a: all | d: none | q: back",
+                f"Chapter: {chapter}",
+                "-" * (curses.COLS-1),
+                "",
+            ]
 
             # adjust scroll offset
             if idx < offset:
@@ -54,16 +268,18 @@ class ChapterSelectionUI:
             visible_choices = choices[offset:offset + max_lines]
             for display_idx, item in enumerate(visible_choices):
                 mark: str = "[x]" if item in selected else "[ ]"
+                completed: str = "[C]" if self._split_classified(chapter, item) else "[ ]"
                 hl: str = ">" if display_idx + offset == idx else " "
-                stdscr.addstr(4 + display_idx, 0, f"{hl} {mark} {item}"[:curses.COLS-1])
+                lines.append(f"{hl} {mark} {completed} {item}")
+            self._draw(stdscr, lines)
 
-            key: int = stdscr.getch()
+            key: int = self._getch(stdscr)
             if key == curses.KEY_UP:
                 idx = self.wrap_index(idx - 1, n)
             elif key == curses.KEY_DOWN:
                 idx = self.wrap_index(idx + 1, n)
             elif key == ord('s'):
-                item: str = choices[idx]
+                item: int = choices[idx]
                 if item in selected:
                     selected.remove(item)
                 else:
@@ -74,39 +290,52 @@ class ChapterSelectionUI:
             elif key == ord('d'):
                 selected.clear()
             elif key == ord('q'):
+                self._reset_screen(stdscr)
                 return selected
 
     # Confirmation screen
     def confirm_screen(self, stdscr: curses.window) -> bool:
+        import curses
+
+        self._reset_screen(stdscr)
         while True:
-            stdscr.clear()
-            stdscr.addstr(0, 0, "Enter: confirm | q: back"[:curses.COLS-1])
-            stdscr.addstr(1, 0, "Selected items:"[:curses.COLS-1])
+            lines: List[str] = ["Enter: confirm | q: back", self._plan_summary(), "Selected items:", ""]
 
-            max_lines: int = curses.LINES - 3
+            plan = self._chapter_estimates()
+            max_lines: int = curses.LINES - 4
             visible_items = list(self.selections.items())[:max_lines]
-
-            line: int = 3
             for chap, items in visible_items:
-                stdscr.addstr(line, 0, f"- {chap}: {list(items) if items else 'NONE'}"[:curses.COLS-1])
-                line += 1
-
-            key: int = stdscr.getch()
+                estimate = ""
+                if plan is not None and chap in plan.index:
+                    row = plan.loc[chap]
+                    estimate = f" ({int(row['request'])} requests, {row['audio_s'] / 60:.1f} min audio, ~${row['cost']:.2f})"
+                lines.append(f"- {chap}: {sorted(items) if items else 'NONE'}{estimate}")
+            self._draw(stdscr, lines)
+
+            key: int = self._getch(stdscr)
             if key == ord('q'):
+                self._reset_screen(stdscr)
                 return False
             if key in (10, 13):
                 return True
 
     # Main curses loop (scrollable)
-    def run_curses(self, stdscr: curses.window) -> Optional[Dict[str, List[str]]]:
+    def run_curses(self, stdscr: curses.window) -> Optional[Dict[str, List[int]]]:
+        import curses
+
         curses.curs_set(0)
+        # Wake up periodically, so the status markers appear as soon as they are loaded
+        stdscr.timeout(250)
         offset: int = 0
-        max_lines: int = curses.LINES - 3
+        self._reset_screen(stdscr)
 
         while True:
-            stdscr.clear()
-            stdscr.addstr(0, 0, "Arrow keys: move | S: select/open | A: all (current) | D: none (current) | T: all (global) | R: none (global) | Enter: confirm | q: quit"[:curses.COLS-1])
-            stdscr.addstr(1, 0, "(selected/total) | [C] = already classified")
+            max_lines: int = curses.LINES - 3
+            lines: List[str] = [
+                "Arrow keys: move | S: select/open | A: all (current) | D: none (current) | T: all (global) | R: none (global) | Enter: confirm | q: quit",
+                "(selected/total) | [C] = already classified | [.] = loading status | [!] = status failed",
+                self._plan_summary(),
+            ]
 
             # aDjust scroll offset
             if self.idx < offset:
@@ -121,15 +350,13 @@ class ChapterSelectionUI:
                     mark: str = "[x]" if self.selections[chap] else "[ ]"
                 else:
                     mark = f"({len(self.selections[chap])}/{total})"
-                
-                # Check if there are existing files in the output folder
-                output_folder = helpers.BASE_PATH/f"output/emotions_scored/{chap}/"
-                completed_prefix = "[C]" if output_folder.exists() and any(list(output_folder.iterdir())) else "[ ]"
 
+                completed_prefix, last_run = self._chapter_status(chap)
                 hl: str = ">" if display_idx + offset == self.idx else " "
-                stdscr.addstr(3 + display_idx, 0, f"{hl} {mark}\t{completed_prefix}\t{chap}"[:curses.COLS-1])
+                lines.append(f"{hl} {mark}\t{completed_prefix}\t{chap} {last_run}")
+            self._draw(stdscr, lines)
 
-            key: int = stdscr.getch()
+            key: int = self._getch(stdscr)
             if key == curses.KEY_UP:
                 self.idx = self.wrap_index(self.idx - 1, len(self.chapters))
             elif key == curses.KEY_DOWN:
@@ -137,7 +364,7 @@ class ChapterSelectionUI:
             elif key == ord('s'):
                 # Perform single selection
                 chapter: str = self.chapters[self.idx]
-                items: List[str] = self.data[chapter]
+                items: List[int] = self.data[chapter]
                 if len(items) == 1:
                     if items[0] in self.selections[chapter]:
                         self.selections[chapter].clear()
@@ -160,7 +387,7 @@ class ChapterSelectionUI:
                 confirmed: bool = self.confirm_screen(stdscr)
                 if confirmed:
                     curses.endwin()
-                    return {k: list(v) for k, v in self.selections.items() if v}
+                    return {k: sorted(v) for k, v in self.selections.items() if v}
             elif key == ord('t'):
                 # Select all chapters and all their subchapters
                 for ch, items in self.data.items():
@@ -174,29 +401,31 @@ class ChapterSelectionUI:
                 return None
 
     # Run the UI
-    def main(self) -> Optional[Dict[str, List[str]]]:
+    def main(self) -> Optional[Dict[str, List[int]]]:
+        import curses
+
         return curses.wrapper(self.run_curses)
 
 
 class Chapter:
-    def __init__(self, name:str, splits: list[pathlib.Path], type=typing.Literal["csv", "mp3"]):
+    def __init__(self, name:str, splits: list[pathlib.Path], type=typing.Literal["csv", "mp3"], indices: list[int]=None):
         self.name = name
         self.splits = splits
         self.type = type
+        # Split number of each file, as parsed from the file name
+        self.indices = indices if indices is not None else list(range(len(splits)))
 
     def keep_splits(self, ixs: list[int]) -> list[pathlib.Path]:
         if len(self.splits) == 1:
             # Do not try to filter anything: current Chapter only has one split
             return self.splits
         else:
-            splits = []
-            for i in ixs:
-                for split in self.splits:
-                    if split.stem.endswith(str(i)):
-                        splits.append(split)
+            keep = set(ixs)
+            kept = [(i, split) for i, split in zip(self.indices, self.splits) if i in keep]
 
-            self.splits = splits
-            return splits
+            self.indices = [i for i, _ in kept]
+            self.splits = [split for _, split in kept]
+            return self.splits
 
     def __len__(self):
         return len(self.splits)
@@ -217,41 +446,66 @@ class Pair:
 
     def to_aux_dict(self) -> dict:
         return {
-            self.chapter: [i for i in range(len(self.csv.splits))]
+            self.chapter: list(self.csv.indices)
         }
 
     def __iter__(self):
-        return zip(range(len(self.csv.splits)), iter(self.csv.splits), iter(self.mp3.splits))
-
-    def __len__(self):
-        return len(self.mp3)
+        return zip(iter(self.csv.indices), iter(self.csv.splits), iter(self.mp3.splits))
 
     def __len__(self):
         return len(self.csv)
 
     def __repr__(self):
-        return f"Pair(chapter='{self.chapter}', csv={self.mp3}, mp3={self.mp3})"
+        return f"Pair(chapter='{self.chapter}', csv={self.csv}, mp3={self.mp3})"
+
+
+# Transcript encodings sent to the model, see `Classifier.prep_dialogue`
+TRANSCRIPT_ENCODINGS = ["full", "compact"]
 
 
 class Classifier(object):
-    def __init__(self):
+    def __init__(self, transcript_encoding: str="full", max_line_chars: int=None, prompt_cache_key: str=None,
+                 structured_output: bool=False, taxonomy_name: str=None):
+        if transcript_encoding not in TRANSCRIPT_ENCODINGS:
+            raise ValueError(f"Unknown transcript encoding '{transcript_encoding}', expected one of {TRANSCRIPT_ENCODINGS}")
+        self.transcript_encoding = transcript_encoding
+        self.max_line_chars = max_line_chars
+        self.prompt_cache_key = prompt_cache_key
+        self.structured_output = structured_output
+
+        import audio_cache
+        import taxonomy
+
+        # Scanned, not saved: the splitter and the pipeline keep 'catalog.json' up to date
+        self.catalog = catalog.SplitCatalog().refresh(save=False)
+        self.audio_cache = audio_cache.AudioCache()
         self.pairs = self.csv_mp3_split_pairs()
         self.csv_settings = helpers.CSV_SETTINGS
-
-        # Target emotions
-        self._negative_emotions = ["anger", "sadness", "fear"]
-        self._positive_emotions = ["happiness", "ambitious", "surprise"]
-        self.target_emotions = self._negative_emotions + self._positive_emotions
-
-        # Prompt
-        self.system_message = f"""
+        self.journal: journal.RunJournal = None
+        # Lines already classified elsewhere (see dedup.py). With `reuse_coverage`, splits with at least
+        # this share of known lines reuse their scores instead of prompting the model
+        self.dedup: dedup.LineIndex = None
+        self.reuse_coverage: float = None
+        # Refuse to classify chapters with integrity errors (see integrity.py)
+        self.integrity_check: bool = True
+
+        # Target emotions, from 'taxonomy.json'
+        self.taxonomy = taxonomy.load(taxonomy_name)
+        self._negative_emotions = self.taxonomy.negative
+        self._positive_emotions = self.taxonomy.positive
+        self.target_emotions = self.taxonomy.target
+        # Columns of the scored DataFrames
+        self.scored_emotions = self.taxonomy.scored
+
+        # Prompt. Static and sent first, so that the provider can cache it as a prompt prefix
+        self.system_message = textwrap.dedent(f"""
         ## TASK
         Evaluate the likelihood of the emotions in the audio dialogue.
         Consider the actor's interpretation, the background music and the meaning of the words.
         Only classify the following emotions:
         - positive: [{', '.join(self._positive_emotions)}]
         - negative: [{', '.join(self._negative_emotions)}]
-        - neutral: [neutral]
+        - neutral: [{', '.join(self.taxonomy.neutral)}]
 
         ## REQUIREMENTS
         - You will have the transcript of the dialogue. Use the row index as key when returning the estimate for the voice line.
@@ -260,94 +514,158 @@ class Classifier(object):
         - Make sure to not classify any other emotion apart from those listed.
         - Don't mix positive and negative emotions in a single voice line.
         - Your estimate should be between 0 and 1, and the total should add up to 1.
-        - If an emotion has a score lower than 0.1 , ignore it and add that score to the highest valued emotions.
+        - If an emotion has a score lower than {self.taxonomy.threshold} , ignore it and add that score to the highest valued emotions.
         - If an emotion is not scored, return it with a score of 0.0
         - When you reply, do not add any other text. Just reply with a JSON formatted string.
-        """
+        """).strip()
 
     def csv_mp3_split_pairs(self) -> list[Pair]:
-        def list_files(path: pathlib.Path) -> list[dict]:
-            pattern = r"(.+)_([0-9]+)$"
-            ls = []
-            for f in (path).iterdir():
-                if f.is_file():
-                    match = re.match(pattern, f.stem)
-                    if match:
-                        ls.append({
-                            "stem": match.group(1),
-                            "part": match.group(2),
-                            "path": f,
-                        })
-                    else:
-                        ls.append({
-                            "stem": f.stem,
-                            "part": 0,
-                            "path": f,
-                        })
-            
-            return ls
-
-        csvs = list_files(helpers.CSV_PATH/"3_splits")
-        mp3s = list_files(helpers.AUDIO_PATH/"3_splits")
-
-        csvs_df = pd.DataFrame(csvs).groupby("stem").agg({"path": list})
-        mp3s_df = pd.DataFrame(mp3s).groupby("stem").agg({"path": list})
-
-        merged_df = pd.merge(
-            left=csvs_df,
-            right=mp3s_df,
-            on="stem",
-            how="inner",
-            suffixes=["_csv", "_mp3"]
-        ).reset_index()
-
+        """
+        Pairs the csv and mp3 splits of each chapter, sorted by chapter and split number.
+        """
         pairs = []
-        for _, row in merged_df.iterrows():
-            stem = row["stem"]
-            csv_parts = Chapter(name=stem, splits=row["path_csv"], type="csv")
-            mp3_parts = Chapter(name=stem, splits=row["path_mp3"], type="mp3")
-            pair = Pair(chapter=stem, csv=csv_parts, mp3=mp3_parts)
-            pairs.append(pair)
+        for chapter in self.catalog.chapters():
+            indices = self.catalog.splits(chapter)
+            entries = [self.catalog.get(chapter, i) for i in indices]
+
+            csv_parts = Chapter(name=chapter, splits=[e["csv"] for e in entries], type="csv", indices=indices)
+            mp3_parts = Chapter(name=chapter, splits=[e["mp3"] for e in entries], type="mp3", indices=list(indices))
+            pairs.append(Pair(chapter=chapter, csv=csv_parts, mp3=mp3_parts))
 
         return pairs
 
     def authorize(self, key: str=None):
+        if not key:
+            key = os.environ.get("OPENAI_API_KEY")
         if not key:
             key = open(helpers.BASE_PATH/"open_ai_token.txt", "r").read()
+        # Imported on first use: it is most of the startup time of the classifier
+        import openai
         self.__openai_client = openai.OpenAI(api_key = key)
 
+    def check_integrity(self, chapters: list[str]):
+        """Raises ValueError when the splits of `chapters` have integrity errors, i.e. would be classified wrong"""
+        if not self.integrity_check:
+            return
+        import integrity
+
+        found = integrity.errors(integrity.IntegrityIndex().check(chapters))
+        if found:
+            for i in found:
+                logging.error(f"{i['chapter']}: {i['check']}: {i['detail']}")
+            raise ValueError(
+                f"Integrity errors in {sorted({i['chapter'] for i in found})}: fix the splits, or pass --ignore-integrity"
+            )
+
     def main(self):
-        logging.info("Beginning classification")
+        import journal
+
+        self.check_integrity([p.chapter for p in self.pairs])
+        if self.journal is None:
+            self.journal = journal.RunJournal.new(self.taxonomy)
+            self.journal.write_selection({p.chapter: list(p.csv.indices) for p in self.pairs})
+
+        logging.info(f"Beginning classification (run '{self.journal.run_id}')")
         logging.info("---")
         for pair in self.pairs:
-            chapter = pair.chapter
+            self.classify_chapter(pair)
+            logging.info("---")
+
+    def classify_chapter(self, pair: Pair):
+        """Classifies the splits of a chapter in the current run and writes its outputs"""
+        chapter = pair.chapter
 
-            logging.info(chapter)
-            out_dfs = []
-            out_responses = []
-            for i, csv_file, mp3_file in pair:
-                logging.info(f"Opening dataframe and audio for split #{i}")
-                dialogues_df: pd.DataFrame = pd.read_csv(csv_file.as_posix(), **self.csv_settings)
-                audio_data = open(mp3_file.as_posix(), "rb").read()
+        logging.info(chapter)
+        out_dfs = []
+        out_responses = []
+        for i, csv_file, mp3_file in pair:
+            chunk_response, chunk_df = self.classify_split(chapter, i, csv_file, mp3_file)
+            out_dfs.append(chunk_df)
+            out_responses.append(chunk_response)
 
-                logging.info(f"Preparing concat dialogue text and base64 audio for split #{i}")
-                dialogue = self.prep_dialogue(dialogues_df)
-                audio_b64 = self.prep_audio(audio_data)
+        logging.info(f"Writing outputs")
+        self.write_outputs(out_responses, out_dfs, chapter, fname=self.journal.run_id)
+
+    def classify_split(self, chapter: str, i: int, csv_file: pathlib.Path, mp3_file: pathlib.Path) -> tuple[dict, pd.DataFrame]:
+        """
+        Classifies a single split of the current run and journals the response and the merged DataFrame.
+        Splits already in the journal are not sent to the model again.
+        """
+        import transcript
+
+        chunk_response = self.journal.load_response(chapter, i)
+        chunk_df = self.journal.load_frame(chapter, i)
+        if chunk_response is not None and chunk_df is not None:
+            logging.info(f"Split #{i} already classified in this run. Skipped.")
+            return chunk_response, chunk_df
+
+        with instrumentation.stage("classify", chapter=chapter, split=i) as event:
+            logging.info(f"Opening dataframe and audio for split #{i}")
+            dialogues_df: pd.DataFrame = transcript.read_transcript(csv_file)
+            event["rows_in"] = len(dialogues_df)
+            event["bytes_read"] = instrumentation.file_size(csv_file)
+
+            logging.info(f"Preparing concat dialogue text and base64 audio for split #{i}")
+            # A journaled response is keyed by the ids of the encoding it was prompted with
+            encoding = chunk_response.get("transcript_encoding", "full") if chunk_response is not None else self.transcript_encoding
+            dialogue = self.prep_dialogue(dialogues_df, encoding=encoding, max_line_chars=self.max_line_chars)
+
+            if chunk_response is None and self._reusable(dialogues_df, chapter):
+                logging.info(f"Split #{i} is covered by already classified lines. Reusing their scores.")
+                chunk_response = {"choices": [{"finish_reason": "stop", "message": {"content": "{}"}}], "reused": True}
+                chunk_response["transcript_encoding"] = encoding
+                self.journal.save_response(chapter, i, chunk_response)
+
+            elif chunk_response is None:
+                # The base64 payload is cached by mp3 hash: resumed and repeated runs don't encode it again
+                audio_b64 = self.audio_cache.b64(mp3_file, sha1=self.catalog.get(chapter, i)["mp3_sha1"])
+                event["bytes_read"] += instrumentation.file_size(mp3_file)
 
                 logging.info(f"Prompting GPT for split #{i}")
-                chunk_response = self.prompt_model(dialogue, audio_b64)
-                chunk_df = self.merge_response_and_dialogues(dialogues_df, chunk_response)
-                out_dfs.append(chunk_df)
-                out_responses.append(chunk_response)
+                chunk_response = self.prompt_model(dialogue, audio_b64, ids=dialogues_df["id"].to_list())
+                chunk_response["transcript_encoding"] = encoding
+                self.journal.save_response(chapter, i, chunk_response)
+                event["usage"] = chunk_response.get("usage")
+            else:
+                logging.info(f"Reusing journaled response for split #{i}")
 
-            logging.info(f"Writing outputs")
-            self.write_outputs(out_responses, out_dfs, chapter)
-            logging.info("---")
+            chunk_df = self.merge_response_and_dialogues(dialogues_df, chunk_response, chapter=chapter)
+            self.journal.save_frame(chapter, i, chunk_df)
+            event["rows_out"] = len(chunk_df)
 
-    def set_chapters(self, chapters:typing.Union[list[str], dict]) -> list[Pair]:
+        return chunk_response, chunk_df
+
+    def check_taxonomy(self, run_id: str):
+        """Raises ValueError when the run was started with the emotions of another taxonomy (named in its id)"""
+        if not run_id.endswith(f"_{self.taxonomy.abbreviation}"):
+            raise ValueError(f"Run '{run_id}' was not classified with the emotions of taxonomy '{self.taxonomy.name}', use --taxonomy")
+
+    def resume(self, run_id: str):
+        """
+        Resumes a journaled run: the splits already classified are not sent to the model again.
+        """
+        import journal
+
+        self.check_taxonomy(run_id)
+        self.journal = journal.RunJournal.open(run_id)
+        selection = self.journal.read_selection()
+        logging.info(f"Resuming run '{run_id}' with chapters and splits: {selection}")
+
+        self.set_chapters(selection)
+        self.main()
+
+    def _reusable(self, dialogues_df: pd.DataFrame, chapter: str) -> bool:
+        if self.dedup is None or self.reuse_coverage is None or dialogues_df.empty:
+            return False
+        return (self.dedup.lookup(dialogues_df, chapter) >= 0).mean() >= self.reuse_coverage
+
+    def set_chapters(self, chapters:typing.Union[list[str], dict], skip_covered: float=None) -> list[Pair]:
         """
         (Optional) Manually define which chapters to classify.
 
+        With `skip_covered` (and a `dedup` index), splits with at least this share of lines already
+        classified elsewhere are left out.
+
         If `chapters` is a list of strings: keep only the chapters that match the same name and all its splits.
         
         If `chapters` is a dict: must be in the form of `{"chapter_name": [list_of_split_indexes]}`
@@ -385,28 +703,63 @@ class Classifier(object):
                             found_match = True
                         
                     if not found_match:
-                        logging.warning(f"Chapter '{chapt}' unknown")
+                        logging.warning(f"Chapter '{chapter}' unknown")
                 
                 logging.info(f"Chapters and splits set correctely: {sub_pairs}")
 
             else:
                 raise ValueError("`chapters` must be a list of chapter names, or a dict like {'chapter1': [0,1...], 'chapter2': [1,2...]}")
 
+            if skip_covered is not None and self.dedup is not None:
+                coverage = self.dedup.coverage(sub_pairs)
+                uncovered = []
+                for pair in sub_pairs:
+                    chapter_cov = coverage[coverage["chapter"] == pair.chapter]
+                    keep = chapter_cov.loc[~(chapter_cov["coverage"] >= skip_covered), "split"].to_list()
+                    if len(keep) < len(pair):
+                        logging.info(f"Chapter '{pair.chapter}': skipping splits {sorted(set(pair.csv.indices) - set(keep))}, already covered")
+                    if keep:
+                        pair.keep_only_splits(keep)
+                        uncovered.append(pair)
+                sub_pairs = uncovered
+
             self.pairs: list[Pair] = sub_pairs
             return sub_pairs
 
         else:
             raise ValueError("`chapters` can not be empty or null")
 
-    def prep_dialogue(self, df: pd.DataFrame) -> str:
+    def prep_dialogue(self, df: pd.DataFrame, encoding: str="full", max_line_chars: int=None) -> str:
         """
         Prepares the input DataFrame to return the dialogues to be passed to the OpenAI chat model.
+        Sets the `id` column, used as key of the lines in the response.
+
+        - `full`: one `{dialogue}_{line} | {speaker}: {line}` row per line
+        - `compact`: a `LEGEND` of speaker codes, then one `{row} {code}: {line}` row per line,
+          where `row` is the position of the line in the split
+
+        `max_line_chars` truncates the text of the lines: the model only uses it to map the audio to the rows.
         """
+        import pandas as pd
+
         df.sort_values(by=["chapter_index", "dialogue_index", "line_index"], inplace=True)
         df.reset_index(drop=True, inplace=True)
 
+        lines = df["line"].astype(str)
+        if max_line_chars:
+            lines = lines.str.slice(0, max_line_chars)
+        speakers = df["speaker"].astype(str)
+
+        if encoding == "compact":
+            # Speaker codes by order of appearance
+            codes = {s: f"S{i}" for i, s in enumerate(pd.unique(speakers))}
+            df["id"] = df.index.astype(str)
+            df["outc"] = df["id"] + " " + speakers.map(codes) + ": " + lines
+            legend = "LEGEND: " + "; ".join(f"{c}={s}" for s, c in codes.items())
+            return "\n".join([legend] + df["outc"].to_list())
+
         df["id"] = df["dialogue_index"].astype(str) +"_"+ df["line_index"].astype(str)
-        df["outc"] = df["id"] + " | " + df["speaker"] + ": " + df["line"]
+        df["outc"] = df["id"] + " | " + speakers + ": " + lines
 
         return "\n".join(df["outc"].to_list())
 
@@ -416,15 +769,24 @@ class Classifier(object):
         """
         return base64.b64encode(audio_data).decode("utf-8")
 
-    def prompt_model(self, dialogues_text: str, audio_b64: str) -> dict:
+    def prompt_model(self, dialogues_text: str, audio_b64: str, ids: list[str]=None) -> dict:
         """
-        Prompts the model and returns its response as dict
+        Prompts the model and returns its response as dict.
+        With `structured_output`, the response is constrained to the JSON schema of the line `ids`.
 
         Output structure: https://platform.openai.com/docs/api-reference/chat/object
         """
 
+        import responses
+
+        # Requests sharing a cache key are routed to the same prompt cache for the static system message
+        extra = {"prompt_cache_key": self.prompt_cache_key} if self.prompt_cache_key else {}
+        if self.structured_output and ids:
+            extra["response_format"] = responses.response_format(ids, self.scored_emotions)
+
         # https://platform.openai.com/docs/api-reference/chat/create
         response = self.__openai_client.chat.completions.create(
+            **extra,
             model="gpt-audio",
             temperature=0.1,
             max_completion_tokens=16384,
@@ -459,27 +821,61 @@ class Classifier(object):
 
         return res_dict
 
-    def merge_response_and_dialogues(self, dialogues_df: pd.DataFrame, res_dict: dict) -> pd.DataFrame:
-        out_content = json.loads(res_dict['choices'][0]['message']['content'])
-        emotions_df = pd.DataFrame.from_dict(out_content, orient='index')
-
-        joined_df = pd.merge(
-            dialogues_df,
-            emotions_df,
-            "left",
-            left_on="id",
-            right_on=emotions_df.index
+    def merge_response_and_dialogues(self, dialogues_df: pd.DataFrame, res_dict: dict, chapter: str=None) -> pd.DataFrame:
+        """
+        Joins the scores of the model response to the lines of `dialogues_df` (prepared by `prep_dialogue`).
+        Scores are validated (see `responses.validate_scores`), thresholded and renormalised by the taxonomy,
+        and the problems found in each line are listed in the `flags` column.
+        """
+        import numpy as np
+        import pandas as pd
+        import comparison
+        import responses
+
+        content = responses.parse_content(res_dict)
+        scores, flags = responses.validate_scores(
+            content, dialogues_df["id"].to_list(), self.scored_emotions, self._positive_emotions, self._negative_emotions
         )
-        joined_df.drop(["outc", "id"], axis=1, inplace=True)
+        scores = self.taxonomy.process(scores)
+        if self.dedup is not None:
+            # Lines left out by the model are taken from their duplicates when possible
+            missing = np.flatnonzero(flags & responses.FLAG_BITS["missing"])
+            # From other chapters: not the previous runs of this one
+            reused, matched = self.dedup.reuse(dialogues_df.iloc[missing], self.scored_emotions, chapter)
+            ix = missing[matched]
+            scores[ix] = reused[matched]
+            flags[ix] = (flags[ix] & ~responses.FLAG_BITS["missing"]) | responses.FLAG_BITS["reused"]
+            if len(ix):
+                logging.info(f"Reused the scores of {len(ix)} already classified lines")
+
+        flagged = {f: n for f, n in responses.summarise(flags).items() if f != "reused"}
+        if flagged:
+            logging.warning(f"Lines flagged in the model response: {flagged}")
+
+        joined_df = dialogues_df.drop(["outc", "id"], axis=1)
+        scores_df = pd.DataFrame(scores, columns=self.scored_emotions, index=joined_df.index)
+        joined_df = pd.concat([joined_df, scores_df], axis=1)
+        joined_df[comparison.FLAGS_COLUMN] = responses.flag_names(flags)
         return joined_df
 
-    def write_outputs(self, responses_list:list[dict], df_list: list[pd.DataFrame], chapter:str):
-        emotions_short = "-".join([e[:3] for e in self.target_emotions])
-        now = datetime.datetime.now().strftime("%d-%m-%YT%H-%M")
-        fname = f"{now}_{emotions_short}"
+    @staticmethod
+    def output_paths(chapter: str, fname: str) -> tuple[pathlib.Path, pathlib.Path]:
+        """API responses and classified csv of a chapter, as written by `write_outputs`"""
+        return (
+            helpers.BASE_PATH/f"./output/api_responses/{chapter}/{fname}.json",
+            helpers.BASE_PATH/f"./output/emotions_scored/{chapter}/{fname}.csv"
+        )
+
+    def write_outputs(self, responses_list:list[dict], df_list: list[pd.DataFrame], chapter:str, fname: str=None):
+        import pandas as pd
+
+        if fname is None:
+            emotions_short = self.taxonomy.abbreviation
+            now = datetime.datetime.now().strftime("%d-%m-%YT%H-%M")
+            fname = f"{now}_{emotions_short}"
+        api_response_path, emotions_df_path = self.output_paths(chapter, fname)
 
         # Write API response
-        api_response_path = helpers.BASE_PATH/f"./output/api_responses/{chapter}/{fname}.json"
         if not api_response_path.parent.exists():
             api_response_path.parent.mkdir()
 
@@ -488,7 +884,6 @@ class Classifier(object):
             logging.info(f"Written API response '{fname}.json'")
 
         # Write dataframe
-        emotions_df_path = helpers.BASE_PATH/f"./output/emotions_scored/{chapter}/{fname}.csv"
         if not emotions_df_path.parent.exists():
             emotions_df_path.parent.mkdir()
 
@@ -498,34 +893,175 @@ class Classifier(object):
         logging.info(f"Written file '{fname}.csv'")
 
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger(__name__)
+def parse_selection(values: list[str], pairs: list[Pair]) -> Dict[str, List[int]]:
+    """
+    Parses `--select` values in the form `CHAPTER` (all splits) or `CHAPTER:0,2` (only some splits).
+    """
+    available = {p.chapter: p.csv.indices for p in pairs}
+    selection = {}
+    for value in values:
+        chapter, _, splits = value.partition(":")
+        if chapter not in available:
+            raise ValueError(f"Chapter '{chapter}' unknown")
+
+        if splits:
+            indices = [int(s) for s in splits.split(",")]
+            unknown = [i for i in indices if i not in available[chapter]]
+            if unknown:
+                raise ValueError(f"Chapter '{chapter}' has no splits {unknown}")
+        else:
+            indices = list(available[chapter])
+        selection[chapter] = indices
+
+    return selection
+
+
+def cli(argv: list[str]=None, prog: str=None):
+    """Command-line interface of the classifier (also `python main.py classify`)"""
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description=textwrap.dedent(
+            """
+            Classify the emotions of the dialogue splits. Without arguments, opens a cmd-line UI to select
+            the chapters and splits to classify.
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "--select", nargs="+", metavar="CHAPTER[:SPLITS]",
+        help=textwrap.dedent(
+            """
+            Non-interactive selection: skips the UI and the confirmation.
+            E.g. --select 0_The_Gommage:0,2 2_The_Beach
+            """
+        )
+    )
+    parser.add_argument(
+        "--resume", metavar="RUN_ID",
+        help="Resume a failed run from its journal in 'output/journal', e.g. --resume 14-11-2025T19-51_ang-sad-fea-hap-amb-sur"
+    )
+    parser.add_argument(
+        "--transcript-encoding", choices=TRANSCRIPT_ENCODINGS, default="full",
+        help="'compact' numbers the lines by row and replaces the speakers with the codes of a legend"
+    )
+    parser.add_argument("--max-line-chars", type=int, metavar="N", help="Only send the first N characters of each line")
+    parser.add_argument("--prompt-cache-key", help="Provider-side prompt cache key for the system message")
+    parser.add_argument("--structured-output", action="store_true", help="Constrain the response to the JSON schema of the split")
+    parser.add_argument("--taxonomy", help="Emotions to classify, from 'taxonomy.json' (default: 'default', see 'python taxonomy.py --list')")
+    parser.add_argument(
+        "--reuse-duplicates", type=float, nargs="?", const=1.0, metavar="MIN_COVERAGE",
+        help=textwrap.dedent(
+            """
+            Reuse the scores of lines already classified in other chapters (see dedup.py): for the lines
+            missing in a response, and for whole splits with at least MIN_COVERAGE (default: 1.0) known lines
+            """
+        )
+    )
+    parser.add_argument("--skip-covered", type=float, metavar="COVERAGE", help="Leave out the selected splits with at least this share of known lines")
+    parser.add_argument("--dedup-similarity", type=float, help="Also match similar lines (trigram Jaccard similarity, e.g. 0.8)")
+    parser.add_argument("--ignore-integrity", action="store_true", help="Classify even the chapters with integrity errors (see integrity.py)")
+    parser.add_argument(
+        "--plan", action="store_true",
+        help="Only estimate the run of the selection (--select, --resume or all the splits): audio, tokens, requests, time and cost"
+    )
+    parser.add_argument("--concurrency", type=int, default=1, help="Concurrent requests, for the time estimate (default: 1)")
+    parser.add_argument(
+        "--prices", type=float, nargs=3, metavar=("TEXT_IN", "AUDIO_IN", "OUTPUT"),
+        help="USD per 1M tokens, for the cost estimate (default: the gpt-audio list prices of planner.py)"
+    )
+    args = parser.parse_args(argv)
+    if args.select and args.resume:
+        parser.error("--select and --resume can not be used together")
+
+    import pandas as pd
+    import dedup
+    import journal
+    import planner
+
+    try:
+        classifier = Classifier(
+            transcript_encoding=args.transcript_encoding,
+            max_line_chars=args.max_line_chars,
+            prompt_cache_key=args.prompt_cache_key,
+            structured_output=args.structured_output,
+            taxonomy_name=args.taxonomy
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    classifier.integrity_check = not args.ignore_integrity
+    if args.reuse_duplicates is not None or args.skip_covered is not None:
+        classifier.dedup = dedup.LineIndex.open(similarity=args.dedup_similarity)
+        classifier.reuse_coverage = args.reuse_duplicates
+    run_planner = planner.Planner(
+        classifier, concurrency=args.concurrency, prices=dict(zip(planner.PRICES, args.prices)) if args.prices else None
+    )
+
+    if args.plan:
+        if args.resume:
+            classifier.journal = journal.RunJournal.open(args.resume)
+            selection = classifier.journal.read_selection()
+        elif args.select:
+            try:
+                selection = parse_selection(args.select, classifier.pairs)
+            except ValueError as e:
+                parser.error(str(e))
+        else:
+            selection = {p.chapter: list(p.csv.indices) for p in classifier.pairs}
+        if args.skip_covered is not None:
+            selection = {p.chapter: list(p.csv.indices) for p in classifier.set_chapters(selection, skip_covered=args.skip_covered)}
+
+        plan = run_planner.plan(selection)
+        with pd.option_context("display.max_rows", None, "display.width", 200, "display.float_format", "{:.2f}".format):
+            print(plan.drop(columns=["latency_s"]).to_string(index=False))
+        print(f"\n{planner.Planner.describe(run_planner.summary(selection))} (concurrency {args.concurrency})")
+        return
 
-    classifier = Classifier()
     classifier.authorize()
 
-    # Get a dictionary of all chapters and sub-chapters
-    # in the form of {"chapter": [0,1,2]}
-    d = {}
-    for p in classifier.csv_mp3_split_pairs():
-        d.update(p.to_aux_dict())
+    order_fn = lambda x: catalog.chapter_order(x[0])
 
-    order_fn = lambda x: int(x[0].split("_")[0])
-    d = dict(sorted(d.items(), key=order_fn))
+    if args.resume:
+        classifier.resume(args.resume)
+
+    elif args.select:
+        try:
+            selected_chapters = parse_selection(args.select, classifier.pairs)
+        except ValueError as e:
+            parser.error(str(e))
 
-    curses_ui = ChapterSelectionUI(data=d)
-    selected_chapters = curses_ui.main()
-    if selected_chapters:
         selected_chapters = dict(sorted(selected_chapters.items(), key=order_fn))
+        logging.info(f"Selected chapters and splits: {selected_chapters}")
+        classifier.set_chapters(selected_chapters, skip_covered=args.skip_covered)
+        classifier.main()
+
+    else:
+        # Get a dictionary of all chapters and sub-chapters
+        # in the form of {"chapter": [0,1,2]}
+        d = {}
+        for p in classifier.pairs:
+            d.update(p.to_aux_dict())
+
+        status = ClassificationStatus(classifier.pairs).load_async()
+        curses_ui = ChapterSelectionUI(data=d, status=status, planner=run_planner)
+        selected_chapters = curses_ui.main()
+        if selected_chapters:
+            selected_chapters = dict(sorted(selected_chapters.items(), key=order_fn))
+
+            print("Selected chapters and splits:")
+            pprint(selected_chapters)
+            print()
+
+            y_n = input("Proceed with classification? (y): ")
+            if y_n.lower() == "y":
+                classifier.set_chapters(selected_chapters, skip_covered=args.skip_covered)
+                classifier.main()
+            else:
+                print("Exiting...")
 
-        print("Selected chapters and splits:")
-        pprint(selected_chapters)
-        print()
 
-        y_n = input("Proceed with classification? (y): ")
-        if y_n.lower() == "y":
-            classifier.set_chapters(selected_chapters)
-            classifier.main()
-        else:
-            print("Exiting...")
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    cli()
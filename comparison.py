@@ -0,0 +1,147 @@
+import pathlib
+import functools
+import numpy as np
+import pandas as pd
+# custom scripts
+import transcript
+
+
+KEY_COLUMNS = ["dialogue_index", "line_index"]
+TRANSCRIPT_COLUMNS = ["chapter_index", "chapter", "dialogue_index", "line_index", "speaker", "line", "id"]
+# Validation flags of each line, set by Classifier.merge_response_and_dialogues
+FLAGS_COLUMN = "flags"
+# Columns added by Taxonomy.frame (see taxonomy.py)
+DERIVED_COLUMNS = ["valence", "arousal", "dominant_emotion"]
+
+
+def emotion_columns(df: pd.DataFrame) -> list[str]:
+    """
+    Returns the emotion score columns of a classified DataFrame, i.e. every column that is not
+    part of the transcript, the validation flags or derived from the scores.
+    """
+    return [c for c in df.columns if c not in TRANSCRIPT_COLUMNS and c != FLAGS_COLUMN and c not in DERIVED_COLUMNS]
+
+
+def align(selection_df: pd.DataFrame, comparison_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Outer-joins two classification runs on `(dialogue_index, line_index)`.
+
+    Emotion columns get a `_sel` / `_cmp` suffix, and the `_merge` column tells which run
+    each line comes from ("both", "left_only", "right_only").
+    """
+    emotions = [e for e in emotion_columns(selection_df) if e in comparison_df.columns]
+    transcript_cols = [c for c in TRANSCRIPT_COLUMNS if c in selection_df.columns and c != "id"]
+
+    left = selection_df[transcript_cols + emotions].drop_duplicates(KEY_COLUMNS)
+    right = comparison_df[[c for c in transcript_cols if c in comparison_df.columns] + emotions].drop_duplicates(KEY_COLUMNS)
+
+    aligned = pd.merge(
+        left,
+        right,
+        on=KEY_COLUMNS,
+        how="outer",
+        suffixes=("_sel", "_cmp"),
+        indicator=True
+    )
+    # Transcript columns come from the selection when available, from the comparison otherwise
+    for col in transcript_cols:
+        if col in KEY_COLUMNS or f"{col}_sel" not in aligned.columns:
+            continue
+        aligned[col] = aligned[f"{col}_sel"].combine_first(aligned[f"{col}_cmp"])
+        aligned.drop([f"{col}_sel", f"{col}_cmp"], axis=1, inplace=True)
+
+    aligned.sort_values(KEY_COLUMNS, inplace=True)
+    aligned.reset_index(drop=True, inplace=True)
+    return aligned
+
+
+def line_metrics(selection_df: pd.DataFrame, comparison_df: pd.DataFrame, aligned: pd.DataFrame=None) -> pd.DataFrame:
+    """
+    Per-line distances between two classification runs. Only lines present in both runs are scored.
+    Pass `aligned` when the runs were already aligned with `align`.
+
+    Output columns: the transcript columns, `id`, `dominant_sel`, `dominant_cmp`, `argmax_agree`,
+    `l1`, `cosine` (cosine distance) and one `diff_<emotion>` column per emotion (comparison - selection).
+    """
+    emotions = [e for e in emotion_columns(selection_df) if e in comparison_df.columns]
+    if aligned is None:
+        aligned = align(selection_df, comparison_df)
+    both = aligned[aligned["_merge"] == "both"].reset_index(drop=True)
+
+    a = both[[f"{e}_sel" for e in emotions]].to_numpy(dtype=float, na_value=0.0)
+    b = both[[f"{e}_cmp" for e in emotions]].to_numpy(dtype=float, na_value=0.0)
+
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    dots = np.einsum("ij,ij->i", a, b)
+    cosine_sim = np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+
+    emotions_arr = np.array(emotions, dtype=object)
+    metrics = both[[c for c in both.columns if c in TRANSCRIPT_COLUMNS]].copy()
+    metrics["id"] = metrics["dialogue_index"].astype(int).astype(str) + "_" + metrics["line_index"].astype(int).astype(str)
+    metrics["dominant_sel"] = emotions_arr[a.argmax(axis=1)] if len(emotions) else None
+    metrics["dominant_cmp"] = emotions_arr[b.argmax(axis=1)] if len(emotions) else None
+    metrics["argmax_agree"] = metrics["dominant_sel"] == metrics["dominant_cmp"]
+    metrics["l1"] = np.abs(a - b).sum(axis=1)
+    metrics["cosine"] = 1 - cosine_sim
+
+    diffs = pd.DataFrame(b - a, columns=[f"diff_{e}" for e in emotions], index=metrics.index)
+    return pd.concat([metrics, diffs], axis=1)
+
+
+def summary(
+    selection_df: pd.DataFrame,
+    comparison_df: pd.DataFrame,
+    metrics: pd.DataFrame=None,
+    aligned: pd.DataFrame=None
+) -> pd.DataFrame:
+    """
+    Chapter-level agreement summary between two runs: one row per chapter with lines in both runs.
+    Pass `metrics` and `aligned` when already computed, to avoid aligning the runs again.
+    """
+    if aligned is None:
+        aligned = align(selection_df, comparison_df)
+    if metrics is None:
+        metrics = line_metrics(selection_df, comparison_df, aligned)
+
+    coverage = aligned.groupby("chapter", observed=True)["_merge"].value_counts().unstack(fill_value=0)
+    diff_cols = [c for c in metrics.columns if c.startswith("diff_")]
+    abs_diffs = metrics[["chapter"] + diff_cols].copy()
+    abs_diffs[diff_cols] = abs_diffs[diff_cols].abs()
+
+    out = metrics.groupby("chapter", observed=True).agg(
+        lines_compared=("l1", "size"),
+        argmax_agreement=("argmax_agree", "mean"),
+        mean_l1=("l1", "mean"),
+        max_l1=("l1", "max"),
+        mean_cosine=("cosine", "mean"),
+    )
+    coverage = coverage.reindex(out.index, fill_value=0)
+    out["only_in_selection"] = coverage.get("left_only", 0)
+    out["only_in_comparison"] = coverage.get("right_only", 0)
+    out = out.join(
+        abs_diffs.groupby("chapter", observed=True).mean().rename(columns=lambda c: c.replace("diff_", "mean_abs_diff_"))
+    )
+    return out.reset_index()
+
+
+@functools.lru_cache(maxsize=32)
+def _compare_cached(selection: str, selection_mtime: int, comparison: str, comparison_mtime: int):
+    selection_df = transcript.read_transcript(selection)
+    comparison_df = transcript.read_transcript(comparison)
+    aligned = align(selection_df, comparison_df)
+    metrics = line_metrics(selection_df, comparison_df, aligned)
+    return metrics, summary(selection_df, comparison_df, metrics, aligned)
+
+
+def compare_files(selection: pathlib.Path, comparison: pathlib.Path) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Compares two classification files and returns `(line_metrics, summary)`.
+
+    Results are cached per pair of files, and invalidated when either file is modified.
+    """
+    metrics, summ = _compare_cached(
+        selection.as_posix(), selection.stat().st_mtime_ns,
+        comparison.as_posix(), comparison.stat().st_mtime_ns
+    )
+    # Callers may sort or filter the frames: don't hand out the cached objects
+    return metrics.copy(), summ.copy()
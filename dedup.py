@@ -0,0 +1,287 @@
+import argparse
+import logging
+import pathlib
+import textwrap
+import numpy as np
+import pandas as pd
+# custom scripts
+import helpers
+import comparison
+import stability
+import transcript
+
+
+DEDUP_PATH = helpers.BASE_PATH/"output/index/dedup.pkl"
+# A line is reused when the dominant emotion of its previous classifications has at least this score
+DEFAULT_MIN_CONFIDENCE = 0.7
+NGRAM = 3
+
+
+def normalise(lines: pd.Series) -> pd.Series:
+    """Case, punctuation and whitespace insensitive form of the lines"""
+    return (
+        lines.astype(str)
+        .str.normalize("NFKC")
+        .str.casefold()
+        .str.replace(r"[^\w\s]", "", regex=True)
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+    )
+
+
+def ngrams(text: str) -> set[str]:
+    padded = f" {text} "
+    return {padded[i:i + NGRAM] for i in range(len(padded) - NGRAM + 1)}
+
+
+def latest_runs(scored_path: pathlib.Path=None) -> list[pathlib.Path]:
+    """Latest classification file of every chapter"""
+    scored_path = scored_path if scored_path is not None else stability.EMOTIONS_SCORED_PATH
+    runs = []
+    for chapter_dir in sorted(scored_path.iterdir()):
+        files = [f for f in chapter_dir.iterdir() if f.suffix == ".csv"] if chapter_dir.is_dir() and chapter_dir.stem != "Z_Final" else []
+        if files:
+            runs.append(max(files, key=stability.run_time))
+    return runs
+
+
+class LineIndex(object):
+    """
+    Index of the lines already classified, keyed by `(speaker, normalised line)`, with the mean scores
+    of all their classifications. Built from the latest run of every chapter (flagged lines excluded)
+    and persisted in `output/index/dedup.pkl`. `LineIndex.open()` rebuilds it when a run changed.
+
+    The scores are kept per source chapter (`sources`: sum and count of the scores of every key in every
+    chapter), so that a chapter's lookups leave out its own previous runs and only reuse the lines
+    repeated in other chapters.
+
+    Lookups match the exact key, or with `similarity` the most similar line of the same speaker by
+    Jaccard similarity of character trigrams. A match is only returned when its dominant emotion
+    has a score of at least `min_confidence`.
+    """
+    def __init__(self, sources: pd.DataFrame, emotions: list[str], signature: list[tuple[str, int]],
+                 min_confidence: float=DEFAULT_MIN_CONFIDENCE, similarity: float=None):
+        self.sources = sources.reset_index(drop=True)
+        self.emotions = emotions
+        self.signature = signature
+        self.min_confidence = min_confidence
+        self.similarity = similarity
+
+        counts = [f"{e}_count" for e in emotions]
+        grouped = self.sources.groupby(["speaker", "text"], sort=True)
+        totals = grouped[emotions + counts + ["lines"]].sum()
+        self.keys = totals.index.to_frame(index=False)
+        self.occurrences = totals["lines"].to_numpy(dtype=np.int32)
+        self._sums = totals[emotions].to_numpy(dtype=np.float64)
+        self._counts = totals[counts].to_numpy(dtype=np.float64)
+        self.scores = self._mean(self._sums, self._counts)
+
+        # Key and chapter of every source row, to take a chapter out of the totals
+        self._source_keys = grouped.ngroup().to_numpy()
+        self._source_chapters = self.sources["chapter"].astype(str).to_numpy()
+        self._source_sums = self.sources[emotions].to_numpy(dtype=np.float64)
+        self._source_counts = self.sources[counts].to_numpy(dtype=np.float64)
+
+        self._key_index = pd.MultiIndex.from_frame(self.keys)
+        self._views: dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        self._postings: dict[str, np.ndarray] = None
+
+    @staticmethod
+    def _mean(sums: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        return np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0).astype(np.float32)
+
+    def _view(self, chapter: str=None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Scores of every key, and masks of the keys classified and confidently classified,
+        leaving out the classifications of `chapter`
+        """
+        if chapter not in self._views:
+            sums, counts = self._sums, self._counts
+            rows = self._source_chapters == chapter
+            if chapter is not None and rows.any():
+                sums, counts = sums.copy(), counts.copy()
+                # One source row per key and chapter: no repeated keys
+                sums[self._source_keys[rows]] -= self._source_sums[rows]
+                counts[self._source_keys[rows]] -= self._source_counts[rows]
+            scores = self._mean(sums, counts) if counts is not self._counts else self.scores
+            classified = counts.sum(axis=1) > 0
+            confident = classified & (scores.max(axis=1, initial=0.0) >= self.min_confidence)
+            self._views[chapter] = (scores, classified, confident)
+        return self._views[chapter]
+
+    @staticmethod
+    def runs_signature(runs: list[pathlib.Path]) -> list[tuple[str, int]]:
+        return [(r.as_posix(), r.stat().st_mtime_ns) for r in runs]
+
+    @classmethod
+    def build(cls, scored_path: pathlib.Path=None, **kwargs) -> "LineIndex":
+        runs = latest_runs(scored_path)
+        logging.info(f"Building line index from {len(runs)} classification runs")
+        # Source chapter of the lines: the folder name of the run, as in the classifier pairs
+        frames = [transcript.read_transcript(r).assign(chapter=r.parent.name) for r in runs]
+        emotions = sorted({e for df in frames for e in comparison.emotion_columns(df)})
+        df = transcript.concat(frames) if frames else pd.DataFrame(columns=transcript.TRANSCRIPT_COLUMNS + emotions)
+
+        if comparison.FLAGS_COLUMN in df.columns:
+            df = df[df[comparison.FLAGS_COLUMN].isna() | (df[comparison.FLAGS_COLUMN] == "")]
+        df = df.dropna(subset=emotions, how="all")
+        df = df.assign(speaker=df["speaker"].astype(str), text=normalise(df["line"]), chapter=df["chapter"].astype(str))
+        df = df[df["text"] != ""]
+
+        grouped = df.groupby(["speaker", "text", "chapter"], sort=True)
+        sources = grouped[emotions].sum().join(grouped[emotions].count().add_suffix("_count"))
+        sources["lines"] = grouped.size()
+        return cls(sources=sources.reset_index(), emotions=emotions, signature=cls.runs_signature(runs), **kwargs)
+
+    def save(self, path: pathlib.Path=DEDUP_PATH) -> pathlib.Path:
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        pd.to_pickle({
+            "sources": self.sources,
+            "emotions": self.emotions,
+            "signature": self.signature
+        }, path)
+        logging.info(f"Written line index at {path.as_posix()}")
+        return path
+
+    @classmethod
+    def load(cls, path: pathlib.Path=DEDUP_PATH, **kwargs) -> "LineIndex":
+        saved = pd.read_pickle(path)
+        return cls(saved["sources"], saved["emotions"], saved["signature"], **kwargs)
+
+    @classmethod
+    def open(cls, path: pathlib.Path=DEDUP_PATH, **kwargs) -> "LineIndex":
+        """Loads the persisted index, rebuilding it if a classification run was added or modified"""
+        if path.exists():
+            try:
+                index = cls.load(path, **kwargs)
+            except KeyError:
+                logging.info("The line index was built by an older version")
+            else:
+                if index.signature == cls.runs_signature(latest_runs()):
+                    return index
+                logging.info("Classification runs changed since the line index was built")
+
+        index = cls.build(**kwargs)
+        index.save(path)
+        return index
+
+    def _ngram_postings(self) -> dict[str, np.ndarray]:
+        """Inverted index: trigram -> keys containing it"""
+        if self._postings is None:
+            postings: dict[str, list[int]] = {}
+            for k, text in enumerate(self.keys["text"]):
+                for g in ngrams(text):
+                    postings.setdefault(g, []).append(k)
+            self._postings = {g: np.array(ks, dtype=np.int32) for g, ks in postings.items()}
+            self._ngram_counts = np.array([len(ngrams(t)) for t in self.keys["text"]], dtype=np.int32)
+            self._speaker_codes = pd.Categorical(self.keys["speaker"])
+        return self._postings
+
+    def _similar(self, speaker: str, text: str, candidates: np.ndarray) -> int:
+        """Most similar key of the same speaker among `candidates` (mask), -1 if none reaches `similarity`"""
+        postings = self._ngram_postings()
+        grams = [g for g in ngrams(text) if g in postings]
+        if not grams or speaker not in self._speaker_codes.categories:
+            return -1
+        shared = np.bincount(np.concatenate([postings[g] for g in grams]), minlength=len(self.keys))
+        jaccard = shared / (len(ngrams(text)) + self._ngram_counts - shared)
+        jaccard[self._speaker_codes.codes != self._speaker_codes.categories.get_loc(speaker)] = 0
+        jaccard[~candidates] = 0
+        best = int(jaccard.argmax())
+        return best if jaccard[best] >= self.similarity else -1
+
+    def lookup(self, df: pd.DataFrame, chapter: str=None) -> np.ndarray:
+        """
+        Position of the confident match of every line of `df` in the index, -1 when there is none.
+        The classifications of `chapter` (the one `df` comes from) are left out.
+        """
+        if df.empty or self.keys.empty:
+            return np.full(len(df), -1, dtype=np.int64)
+
+        _, classified, confident = self._view(chapter)
+        texts = normalise(df["line"])
+        speakers = df["speaker"].astype(str)
+        matches = self._key_index.get_indexer(pd.MultiIndex.from_arrays([speakers, texts]))
+
+        if self.similarity is not None:
+            # Lines without a key, or whose key was only classified in `chapter`
+            for i in np.flatnonzero((matches == -1) | ~classified[matches]):
+                if texts.iat[i]:
+                    matches[i] = self._similar(speakers.iat[i], texts.iat[i], classified)
+
+        hit = (matches >= 0) & (texts.to_numpy() != "")
+        hit[hit] = confident[matches[hit]]
+        matches[~hit] = -1
+        return matches
+
+    def reuse(self, df: pd.DataFrame, emotions: list[str], chapter: str=None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        `(lines, emotions)` scores of the confident matches of `df` (NaN elsewhere) and the mask of matched lines,
+        leaving out the classifications of `chapter`. Emotions that were never classified are 0.
+        """
+        scores_by_key, _, _ = self._view(chapter)
+        matches = self.lookup(df, chapter)
+        matched = matches >= 0
+        found = np.zeros((int(matched.sum()), len(emotions)))
+        for j, e in enumerate(emotions):
+            if e in self.emotions:
+                found[:, j] = scores_by_key[matches[matched], self.emotions.index(e)]
+
+        scores = np.full((len(df), len(emotions)), np.nan)
+        scores[matched] = found
+        return scores, matched
+
+    def coverage(self, pairs: list) -> pd.DataFrame:
+        """Share of the lines of every split of `pairs` that have a confident match in other chapters"""
+        rows = []
+        for pair in pairs:
+            for i, csv_file, _ in pair:
+                df = transcript.read_transcript(csv_file)
+                covered = int((self.lookup(df, pair.chapter) >= 0).sum())
+                rows.append({"chapter": pair.chapter, "split": i, "lines": len(df), "covered": covered})
+
+        df = pd.DataFrame(rows, columns=["chapter", "split", "lines", "covered"])
+        df["coverage"] = df["covered"] / df["lines"].where(df["lines"] > 0)
+        return df
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(
+            """
+            Index of the lines already classified (latest run of each chapter), keyed by speaker and
+            normalised line, to find the lines that repeat across chapters (barks, greetings, gibberish...).
+
+            'report' lists how much of each split is already classified with a high confidence in other chapters,
+            least covered first: the splits worth a fresh classification. Use classifier.py --reuse-duplicates / --skip-covered
+            to reuse the scores.
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--min-confidence", type=float, default=DEFAULT_MIN_CONFIDENCE, help="Minimum score of the dominant emotion of a match")
+    parser.add_argument("--similarity", type=float, help="Also match similar lines, with a trigram Jaccard similarity of at least this (e.g. 0.8)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="Rebuild the index")
+    report_parser = subparsers.add_parser("report", help="Coverage of each split by the index")
+    report_parser.add_argument("--chapters", nargs="*", help="Only these chapters (folder names)")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        LineIndex.build(min_confidence=args.min_confidence, similarity=args.similarity).save()
+
+    elif args.command == "report":
+        from classifier import Classifier
+
+        index = LineIndex.open(min_confidence=args.min_confidence, similarity=args.similarity)
+        classifier = Classifier()
+        if args.chapters:
+            classifier.set_chapters(args.chapters)
+        report = index.coverage(classifier.pairs).sort_values(["coverage", "chapter", "split"], kind="stable")
+
+        with pd.option_context("display.max_rows", None, "display.width", 200, "display.float_format", "{:.2f}".format):
+            print(report.to_string(index=False))
+        print(f"\n{report['covered'].sum()} of {report['lines'].sum()} lines already classified with confidence >= {args.min_confidence}")
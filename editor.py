@@ -1,11 +1,105 @@
 import logging
-import csv
 import os
+import re
 import json
+import pathlib
+import numpy as np
 import pandas as pd
 from argparse import Namespace
 # custom scripts
 import helpers
+import instrumentation
+import transcript
+
+
+INSERT_DTYPES = {"chapter_index": "int32", "dialogue_index": "int32", "line_index": "int32"}
+
+
+class EditRules(object):
+    """
+    Rules from edit_rules.json, compiled once: delete ranges indexed by source chapter,
+    narrator and gibberish speakers as sets and the gibberish speaker classes as a single regex.
+    """
+    def __init__(self, rules: dict, keep_narrator: bool=False, keep_gibberish: bool=False):
+        self.inserts: dict[str, dict] = helpers.edit_inserts(rules)
+
+        deletes: dict[str, list] = {}
+        for rule in rules["deletes"]:
+            deletes.setdefault(rule["source"], []).extend(
+                [r["dial_s"], r["line_s"], r["dial_e"], r["line_e"]] for r in rule["ranges"]
+            )
+        self.deletes: dict[str, np.ndarray] = {k: np.array(v, dtype=np.int64) for k, v in deletes.items()}
+
+        self.narrator_speakers: frozenset = frozenset()
+        if not keep_narrator:
+            self.narrator_speakers = frozenset(rules.get("narrator_speakers", ["narrator"]))
+
+        self.gibberish_prefix: str = None
+        self.gibberish_speakers: frozenset = frozenset()
+        self.gibberish_classes: re.Pattern = None
+        if not keep_gibberish and "gibberish" in rules:
+            gibberish = rules["gibberish"]
+            self.gibberish_prefix = gibberish["prefix"]
+            self.gibberish_speakers = frozenset(gibberish["speakers"])
+            if gibberish["speaker_classes"]:
+                self.gibberish_classes = re.compile(
+                    "|".join(re.escape(c) for c in gibberish["speaker_classes"]), re.IGNORECASE
+                )
+
+    @classmethod
+    def load(cls, path: pathlib.Path, keep_narrator: bool=False, keep_gibberish: bool=False) -> "EditRules":
+        with open(path, "r") as f:
+            return cls(json.load(f), keep_narrator, keep_gibberish)
+
+    def is_gibberish_speaker(self, speaker) -> bool:
+        if not isinstance(speaker, str):
+            return False
+        return speaker in self.gibberish_speakers or bool(
+            self.gibberish_classes and self.gibberish_classes.search(speaker)
+        )
+
+    def apply(self, df: pd.DataFrame, source: str) -> pd.DataFrame:
+        """
+        Applies every rule of `source` in a single pass: one keep-mask for the deleted ranges and
+        the narrator, and the gibberish prefix. The input DataFrame is modified in place.
+        """
+        keep = np.ones(len(df), dtype=bool)
+
+        # 1. Delete custom row ranges
+        ranges = self.deletes.get(source)
+        if ranges is not None:
+            logging.info(f"Deleting rows from {source} based on ranges:\n{ranges.tolist()}")
+            dialogues = df["dialogue_index"].to_numpy(dtype=np.int64)
+            lines = df["line_index"].to_numpy(dtype=np.int64)
+
+            # (dialogue, line) flattened to a single ordered key
+            width = max(lines.max(initial=0), ranges[:, [1, 3]].max()) + 1
+            keys = dialogues * width + lines
+            starts = ranges[:, 0] * width + ranges[:, 1]
+            ends = ranges[:, 2] * width + ranges[:, 3]
+            keep &= ~((keys[:, None] >= starts) & (keys[:, None] <= ends)).any(axis=1)
+
+        # Speaker rules are evaluated once per distinct speaker, not once per line
+        codes, speakers = pd.factorize(df["speaker"])
+        codes_ok = codes >= 0
+
+        # 2. Delete narrator
+        if self.narrator_speakers:
+            logging.info(f"Removing narrator dialogues from {source}")
+            is_narrator = np.array([s in self.narrator_speakers for s in speakers], dtype=bool)
+            keep &= ~(codes_ok & is_narrator[codes])
+
+        # 3. Prefix gibberish
+        if self.gibberish_prefix is not None:
+            logging.info(f"Prefixing gibberish lines in {source}")
+            is_gibberish = np.array([self.is_gibberish_speaker(s) for s in speakers], dtype=bool)
+            to_prefix = keep & codes_ok & is_gibberish[codes]
+            candidates = df["line"][to_prefix]
+            already_prefixed = candidates.str.contains(self.gibberish_prefix, case=False, na=False, regex=False)
+            to_prefix[to_prefix] = ~already_prefixed.to_numpy()
+            df.loc[to_prefix, "line"] = self.gibberish_prefix + df.loc[to_prefix, "line"]
+
+        return df[keep].reset_index(drop=True)
 
 
 class Editor(object):
@@ -13,118 +107,82 @@ class Editor(object):
         self.cmd_line_args: Namespace = cmd_line_args
         self.csv_settings = helpers.CSV_SETTINGS
 
-        self.delete_existing_csvs()
-
     def delete_existing_csvs(self):
         for f in (helpers.CSV_PATH/"2_edits").iterdir():
             if f.is_file() and ".csv" in f.name:
                 os.remove(f.as_posix())
 
+    def load_rules(self) -> EditRules:
+        return EditRules.load(
+            helpers.BASE_PATH/"0_data_manip_cfg/edit_rules.json",
+            keep_narrator=self.cmd_line_args.keep_narrator,
+            keep_gibberish=self.cmd_line_args.keep_gibberish
+        )
+
     def main(self):
-        edit_rules = json.load(open(helpers.BASE_PATH/"0_data_manip_cfg/edit_rules.json", "r"))
+        self.delete_existing_csvs()
+        edit_rules = self.load_rules()
 
         logging.info("Beginning custom edits")
         for chapter_csv in (helpers.CSV_PATH/"1_raw").iterdir():
-            fname = chapter_csv.stem
-            logging.info(fname)
-            df = pd.read_csv(chapter_csv.as_posix(), **self.csv_settings)
-
-            # 1. Delete custom row ranges
-            for split_rule in edit_rules["deletes"]:
-                if fname == split_rule["source"]:
-                    ranges = split_rule['ranges']
-                    logging.info(f"Deleting rows from {fname} based on ranges:\n{ranges}")
-                    df = self._deletes(df, ranges)
-
-            # 2. Delete narrator
-            if self.cmd_line_args.keep_narrator is False:
-                logging.info(f"Removing narrator dialogues from {fname}")
-                df = self._delete_narrator(df)
-
-            # 3. Prefix gibberish
-            if self.cmd_line_args.keep_gibberish is False:
-                logging.info(f"Prefixing gibberish lines in {fname}")
-                df = self._prefix_gibberish(df)
-
-            df.to_csv(helpers.CSV_PATH/f"2_edits/{fname}.csv", index=False, **self.csv_settings)
+            self.edit_chapter(chapter_csv, edit_rules)
             logging.info("---")
         
-        # Handle custom inserts
-        logging.info("Beginning custom inserts")
-        self._inserts(edit_rules["inserts"])
-
-    def _inserts(self, inserts: list):
-        for i in inserts:
-            fname = i+".csv"
-            logging.info(f"Copying file {fname}")
-
-            in_path = (helpers.CSV_PATH/"2_edits/custom_inserts"/fname).as_posix()
-            in_file = open(in_path, "r", encoding="utf-8", newline="")
-            reader = csv.reader(in_file, **self.csv_settings)
-
-            out_path = (helpers.CSV_PATH/"2_edits"/fname).as_posix()
-            out_file = open(out_path, "w", encoding="utf-8", newline="")
-            writer = csv.writer(out_file, **self.csv_settings)
-
-            # Track the last dialogue index and current line index across rows
-            last_dialogue_index = None
-            line_index = 0
-            for i, row in enumerate(list(reader)):
-                if i == 0:
-                    # Insert header
-                    row.insert(3, "line_index")
-                else:
-                    curr_dialogue_index = row[2]
-                    if last_dialogue_index is None or curr_dialogue_index != last_dialogue_index:
-                        # New dialogue: reset counter
-                        line_index = 0
-                    else:
-                        # Same dialogue: increment
-                        line_index += 1
-
-                    row.insert(3, str(line_index))
-                    last_dialogue_index = curr_dialogue_index
-
-                writer.writerow(row)   
-
-    def _deletes(self, df: pd.DataFrame, ranges: list[dict]):
-        del_ranges = pd.DataFrame(ranges)
-
-        mask = pd.Series(True, index=df.index)
-        for _, r in del_ranges.iterrows():
-            to_delete = (
-                ((df["dialogue_index"] > r["dial_s"]) |
-                ((df["dialogue_index"] == r["dial_s"]) & (df["line_index"] >= r["line_s"])))
-                &
-                ((df["dialogue_index"] < r["dial_e"]) |
-                ((df["dialogue_index"] == r["dial_e"]) & (df["line_index"] <= r["line_e"])))
-            )
-            mask &= ~to_delete  # remove these rows
-
-        df_filtered = df[mask].reset_index(drop=True)
-        return df_filtered
-
-    def _delete_narrator(self, df: pd.DataFrame):
-        return df[df["speaker"] != "narrator"]
-
-    def _prefix_gibberish(self, df: pd.DataFrame):
-        gibberish_classes = [
-            'fading', 'gestral', 'grandis', 'faceless'
-        ]
-        gibberish_speakers = [
-            'The Curator', 'Noco', 'Young boy', 'Lady of Sap', 'Golgra', 'Jar', '???',
-            'Karatom', 'Tropa', 'Peron', 'Olivierso', 'Jujubree', 'Berrami',
-            'Eesda', 'Alexcyclo', 'Victorifo', 'Limonsol'
-        ]
-
-        # Add "(gibberish) " prefix to lines where speaker is in gibberish_speakers
-        # or contains any word in speaker_classes
-        prefix = "(gibberish) "
-        mask = ((
-                df["speaker"].isin(gibberish_speakers) |
-                df["speaker"].str.contains('|'.join(gibberish_classes), case=False, na=False)
-            ) &
-            ~df["line"].str.contains(prefix, case=False, na=False, regex=False)
-        )
-        df.loc[mask, "line"] = prefix + df.loc[mask, "line"]
+        # Handle custom inserts of chapters that were not scraped
+        scraped = {f.stem for f in (helpers.CSV_PATH/"1_raw").iterdir()}
+        for target in edit_rules.inserts:
+            if target not in scraped:
+                self.write_custom_chapter(target, edit_rules)
+
+    def edit_chapter(self, chapter_csv: pathlib.Path, edit_rules: EditRules) -> pathlib.Path:
+        """Applies the rules to a raw chapter and writes it to '2_edits'"""
+        fname = chapter_csv.stem
+        logging.info(fname)
+        with instrumentation.stage("edit", chapter=fname) as event:
+            df = transcript.read_transcript(chapter_csv)
+            event["rows_in"] = len(df)
+            event["bytes_read"] = instrumentation.file_size(chapter_csv)
+
+            df = edit_rules.apply(df, fname)
+            if fname in edit_rules.inserts:
+                df = self._inserts(edit_rules.inserts[fname], df)
+
+            out_path = helpers.CSV_PATH/f"2_edits/{fname}.csv"
+            df.to_csv(out_path, index=False, **self.csv_settings)
+            event["rows_out"] = len(df)
+            event["bytes_written"] = instrumentation.file_size(out_path)
+        return out_path
+
+    def write_custom_chapter(self, target: str, edit_rules: EditRules) -> pathlib.Path:
+        """Writes a chapter that was not scraped from its custom inserts"""
+        logging.info(f"Writing custom chapter {target}")
+        out_path = helpers.CSV_PATH/f"2_edits/{target}.csv"
+        df = self._inserts(edit_rules.inserts[target])
+        df.to_csv(out_path, index=False, **self.csv_settings)
+        return out_path
+
+    def _read_insert(self, name: str) -> pd.DataFrame:
+        path = helpers.CSV_PATH/"2_edits/custom_inserts"/f"{name}.csv"
+        df = transcript.read_transcript(path, dtype=INSERT_DTYPES)
+
+        if "line_index" not in df.columns:
+            # Line index restarts every time the dialogue index changes
+            dialogue_runs = (df["dialogue_index"] != df["dialogue_index"].shift()).cumsum()
+            df.insert(3, "line_index", df.groupby(dialogue_runs).cumcount().astype(np.int32))
         return df
+
+    def _inserts(self, insert: dict, df: pd.DataFrame=None) -> pd.DataFrame:
+        """
+        Builds a chapter from its custom inserts.
+
+        In "replace" mode the custom inserts replace the whole chapter. In "merge" mode they replace only the
+        scraped dialogues with the same `dialogue_index`, the other scraped dialogues are kept.
+        """
+        logging.info(f"Inserting {insert['sources']} ({insert['mode']})")
+        inserts = transcript.concat(self._read_insert(s) for s in insert["sources"])
+        if insert["mode"] == "replace" or df is None:
+            return inserts
+
+        kept = df[~df["dialogue_index"].isin(inserts["dialogue_index"])]
+        merged = transcript.concat([kept, inserts])
+        return merged.sort_values(["dialogue_index", "line_index"], kind="stable").reset_index(drop=True)
@@ -6,3 +6,16 @@ BASE_PATH = pathlib.Path(__file__).parent/"data"
 CSV_PATH = BASE_PATH/"csv"
 AUDIO_PATH = BASE_PATH/"audio"
 CSV_SETTINGS = {'quotechar': '"', 'quoting': csv.QUOTE_ALL}
+
+
+def edit_inserts(rules: dict) -> dict[str, dict]:
+    """
+    Custom inserts of edit_rules.json by target chapter: `{"mode": "replace" | "merge", "sources": [custom insert names]}`.
+    A plain string is a custom insert replacing the chapter with the same name.
+    """
+    inserts = {}
+    for insert in rules["inserts"]:
+        if isinstance(insert, str):
+            insert = {"target": insert, "sources": [insert], "mode": "replace"}
+        inserts[insert["target"]] = {"mode": insert.get("mode", "replace"), "sources": insert["sources"]}
+    return inserts
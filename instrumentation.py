@@ -0,0 +1,136 @@
+import json
+import time
+import logging
+import pathlib
+import pstats
+import cProfile
+import datetime
+import threading
+import functools
+import contextlib
+import tracemalloc
+# custom scripts
+import helpers
+
+
+# Structured events are emitted on their own logger, so they can be routed to a file
+EVENTS_LOGGER = logging.getLogger("pipeline.events")
+
+_profile_dir: pathlib.Path = None
+# Stages are nested per thread: sources can be scraped concurrently
+_local = threading.local()
+
+
+def _stack() -> list[dict]:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def enable_profiling(out_dir: pathlib.Path=None) -> pathlib.Path:
+    """
+    Enables cProfile and tracemalloc snapshots for every top-level stage.
+    Profiles are written to `output/profiles/{timestamp}/` unless `out_dir` is given.
+    """
+    global _profile_dir
+    if out_dir is None:
+        out_dir = helpers.BASE_PATH/f"output/profiles/{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    _profile_dir = out_dir
+    return out_dir
+
+
+def log_events_to(path: pathlib.Path):
+    """Appends the structured events, one JSON object per line, to `path`"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    handler = logging.FileHandler(path.as_posix(), encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    EVENTS_LOGGER.addHandler(handler)
+
+
+def file_size(path: pathlib.Path) -> int:
+    return path.stat().st_size if path.exists() else 0
+
+
+@contextlib.contextmanager
+def stage(name: str, chapter: str=None, **fields):
+    """
+    Times a pipeline stage and emits a JSON event when it ends.
+
+    The yielded dict can be filled with `rows_in`, `rows_out`, `bytes_read`, `bytes_written`
+    or any other counter. Stages can be nested: top-level stages are also profiled when
+    profiling is enabled.
+
+    ```
+    with instrumentation.stage("edit", chapter=fname) as event:
+        event["rows_in"] = len(df)
+    ```
+    """
+    stack = _stack()
+    event = {
+        "stage": name,
+        "chapter": chapter,
+        "parent": stack[-1]["stage"] if stack else None,
+        "rows_in": None,
+        "rows_out": None,
+        "bytes_read": None,
+        "bytes_written": None,
+        **fields
+    }
+    # tracemalloc is process-wide: only stages of the main thread are profiled
+    top_level = not stack and threading.current_thread() is threading.main_thread()
+    profile = _profile_dir is not None and top_level
+    stack.append(event)
+
+    if profile:
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    event["status"] = "ok"
+    try:
+        yield event
+    except BaseException as e:
+        event["status"] = "error"
+        event["error"] = repr(e)
+        raise
+    finally:
+        event["duration_s"] = round(time.perf_counter() - wall_start, 6)
+        event["cpu_s"] = round(time.process_time() - cpu_start, 6)
+
+        if profile:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            event["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 3)
+            tracemalloc.stop()
+            _write_profile(name, chapter, profiler, snapshot)
+
+        stack.pop()
+        EVENTS_LOGGER.info(json.dumps(event, default=str))
+
+
+def instrumented(name: str):
+    """Decorator version of `stage()`, for functions without per-chapter counters"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _write_profile(name: str, chapter: str, profiler: cProfile.Profile, snapshot: tracemalloc.Snapshot):
+    stem = name if chapter is None else f"{name}_{chapter}"
+    profiler.dump_stats((_profile_dir/f"{stem}.prof").as_posix())
+
+    with open(_profile_dir/f"{stem}.txt", "w") as f:
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats("cumulative").print_stats(30)
+
+        f.write("\nTop memory allocations\n")
+        for stat in snapshot.statistics("lineno")[:20]:
+            f.write(f"{stat}\n")
+
+    logging.info(f"Written profile of stage '{stem}' at {_profile_dir.as_posix()}")
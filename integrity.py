@@ -0,0 +1,212 @@
+import json
+import wave
+import argparse
+import logging
+import pathlib
+import textwrap
+import numpy as np
+import pandas as pd
+# custom scripts
+import helpers
+import catalog
+import comparison
+import planner
+import silence
+import stability
+
+
+INTEGRITY_PATH = helpers.BASE_PATH/"output/index/integrity.pkl"
+# Allowed difference between the duration of a wav and the total of its mp3 splits (encoder padding)
+DURATION_TOLERANCE_S = 1.0
+# Severity of each check. Errors block the classification of the chapter.
+CHECKS = {
+    "split_rule": "error",          # the split rule has not one more csv range than audio timestamps
+    "split_count": "error",         # the chapter has not as many csv as mp3 splits: csv and audio would be paired wrong
+    "duplicate_lines": "error",     # lines in several splits, or twice in a file
+    "timestamps": "error",          # audio timestamps after the end of the wav
+    "lines_not_split": "warning",   # edited lines in no split
+    "duration": "warning",          # the mp3 splits don't add up to the wav
+    "unscored_lines": "warning",    # lines of the splits without scores in the latest run
+    "stale_scores": "warning",      # scored lines that are no longer in the splits
+}
+# Text columns, not read when indexing a file
+_TEXT_COLUMNS = {"chapter", "speaker", "line", comparison.FLAGS_COLUMN}
+
+
+def pack_ids(dialogue_index: np.ndarray, line_index: np.ndarray) -> np.ndarray:
+    """`(dialogue_index, line_index)` line ids as single int64 values"""
+    return (dialogue_index.astype(np.int64) << 20) | line_index.astype(np.int64)
+
+
+def unpack_ids(ids: np.ndarray) -> list[str]:
+    return [f"{i >> 20}_{i & 0xFFFFF}" for i in ids.tolist()]
+
+
+def wav_duration(path: pathlib.Path) -> float:
+    """Duration in seconds read from the wav header, None when it isn't a wav (e.g. a git LFS pointer)"""
+    try:
+        with wave.open(path.as_posix(), "rb") as f:
+            return f.getnframes() / f.getframerate()
+    except (wave.Error, EOFError):
+        return None
+
+
+class IntegrityIndex(object):
+    """
+    Row counts, line ids, split counts and durations of every chapter at each stage (edited csv, csv and
+    mp3 splits, wav, latest classification), checked against each other and the split rules.
+
+    Files are summarised once and cached by size and mtime in `output/index/integrity.pkl`:
+    checking again only reads the files that changed.
+    """
+    def __init__(self, path: pathlib.Path=None):
+        self.path = path if path is not None else INTEGRITY_PATH
+        self._files: dict[str, dict] = pd.read_pickle(self.path) if self.path.exists() else {}
+        self._changed = False
+        self.split_rules = {
+            r["source"]: r for r in json.load(open(helpers.BASE_PATH/"0_data_manip_cfg/split_rules.json", "r"))
+        }
+
+    def save(self):
+        if self._changed:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            pd.to_pickle(self._files, self.path)
+            self._changed = False
+
+    def summary(self, path: pathlib.Path) -> dict:
+        """Rows, line ids and unscored rows of a csv, duration of an mp3 or a wav"""
+        key = path.relative_to(helpers.BASE_PATH).as_posix()
+        stat = path.stat()
+        cached = self._files.get(key)
+        if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached
+
+        summary = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        if path.suffix == ".csv":
+            df = pd.read_csv(path.as_posix(), usecols=lambda c: c not in _TEXT_COLUMNS, **helpers.CSV_SETTINGS)
+            emotions = comparison.emotion_columns(df)
+            summary["ids"] = pack_ids(df["dialogue_index"].to_numpy(), df["line_index"].to_numpy())
+            summary["unscored"] = df[emotions].isna().all(axis=1).to_numpy() if emotions else None
+        elif path.suffix == ".mp3":
+            summary["duration"] = planner.mp3_duration(path)
+        elif path.suffix == ".wav":
+            summary["duration"] = wav_duration(path)
+
+        self._files[key] = summary
+        self._changed = True
+        return summary
+
+    def chapters(self) -> list[str]:
+        names = {f.stem for f in (helpers.CSV_PATH/"2_edits").glob("*.csv")}
+        names |= {f.stem for f in (helpers.AUDIO_PATH/"2_edits").glob("*.wav")}
+        for split_type, folder in catalog.split_folders().items():
+            names |= {f.stem if f.stem in names else catalog.SPLIT_PATTERN.sub(r"\1", f.stem) for f in folder.glob(f"*.{split_type}")}
+        return sorted(names, key=lambda c: (catalog.chapter_order(c), c))
+
+    def check_chapter(self, chapter: str) -> list[dict]:
+        issues = []
+
+        def issue(check: str, detail: str, **fields):
+            issues.append({"chapter": chapter, "check": check, "severity": CHECKS[check], "detail": detail, **fields})
+
+        csv_splits = catalog.chapter_splits(chapter, "csv")
+        mp3_splits = catalog.chapter_splits(chapter, "mp3")
+        if csv_splits and mp3_splits and len(csv_splits) != len(mp3_splits):
+            issue("split_count", f"{len(csv_splits)} csv splits, {len(mp3_splits)} mp3 splits", csv=len(csv_splits), mp3=len(mp3_splits))
+
+        rule = self.split_rules.get(chapter)
+        timestamps = [silence.time_to_seconds(t) for t in rule["timestamps"]] if rule else []
+        if rule and len(rule["ranges"]) != len(timestamps) + 1:
+            issue(
+                "split_rule", f"{len(rule['ranges'])} csv ranges for {len(timestamps)} audio timestamps",
+                ranges=len(rule["ranges"]), timestamps=len(timestamps)
+            )
+
+        # Lines of the splits
+        split_ids = [self.summary(f)["ids"] for f in csv_splits]
+        all_split_ids = np.concatenate(split_ids) if split_ids else np.zeros(0, dtype=np.int64)
+        unique_ids, counts = np.unique(all_split_ids, return_counts=True)
+        if (counts > 1).any():
+            duplicated = unique_ids[counts > 1]
+            issue("duplicate_lines", f"{len(duplicated)} lines in more than one split", lines=unpack_ids(duplicated[:20]))
+
+        edit_csv = helpers.CSV_PATH/f"2_edits/{chapter}.csv"
+        if edit_csv.exists() and csv_splits:
+            not_split = np.setdiff1d(self.summary(edit_csv)["ids"], unique_ids)
+            if len(not_split):
+                issue("lines_not_split", f"{len(not_split)} edited lines in no split", lines=unpack_ids(not_split[:20]))
+
+        # Audio
+        wav = helpers.AUDIO_PATH/f"2_edits/{chapter}.wav"
+        wav_s = self.summary(wav)["duration"] if wav.exists() else None
+        if wav_s is not None and timestamps and max(timestamps) >= wav_s:
+            issue("timestamps", f"timestamp {max(timestamps):.1f}s after the end of the wav ({wav_s:.1f}s)", wav_s=wav_s)
+
+        mp3_s = [self.summary(f)["duration"] for f in mp3_splits]
+        if wav_s is not None and mp3_s and None not in mp3_s and abs(sum(mp3_s) - wav_s) > DURATION_TOLERANCE_S:
+            issue("duration", f"mp3 splits last {sum(mp3_s):.1f}s, the wav {wav_s:.1f}s", mp3_s=round(sum(mp3_s), 3), wav_s=wav_s)
+
+        # Scores of the latest run
+        scored_dir = stability.EMOTIONS_SCORED_PATH/chapter
+        runs = list(scored_dir.glob("*.csv")) if scored_dir.exists() else []
+        if runs and csv_splits:
+            latest = self.summary(max(runs, key=stability.run_time))
+            scored_ids = latest["ids"] if latest["unscored"] is None else latest["ids"][~latest["unscored"]]
+            unscored = np.setdiff1d(unique_ids, scored_ids)
+            if len(unscored):
+                issue("unscored_lines", f"{len(unscored)} lines without scores in the latest run", lines=unpack_ids(unscored[:20]))
+            stale = np.setdiff1d(latest["ids"], unique_ids)
+            if len(stale):
+                issue("stale_scores", f"{len(stale)} scored lines no longer in the splits", lines=unpack_ids(stale[:20]))
+
+        return issues
+
+    def check(self, chapters: list[str]=None) -> dict:
+        """Machine-readable report of every chapter (or only of `chapters`)"""
+        chapters = chapters if chapters is not None else self.chapters()
+        issues = [i for chapter in chapters for i in self.check_chapter(chapter)]
+        self.save()
+        return {
+            "chapters": len(chapters),
+            "errors": sum(i["severity"] == "error" for i in issues),
+            "warnings": sum(i["severity"] == "warning" for i in issues),
+            "issues": issues,
+        }
+
+
+def errors(report: dict) -> list[dict]:
+    return [i for i in report["issues"] if i["severity"] == "error"]
+
+
+def describe(report: dict) -> list[str]:
+    lines = [f"{i['severity']:>7}  {i['chapter']}  {i['check']}: {i['detail']}" for i in report["issues"]]
+    lines.append(f"{report['chapters']} chapters checked: {report['errors']} errors, {report['warnings']} warnings")
+    return lines
+
+
+def cli(argv: list[str]=None, prog: str=None):
+    """Command-line interface of the checker (also `python main.py check`)"""
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description=textwrap.dedent(
+            """
+            Checks that the stages of every chapter line up: split rules, csv and mp3 split counts,
+            lines lost or duplicated by the splits, audio durations and the scores of the latest run.
+            Exits with 1 when there are errors (the classifier refuses these chapters).
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("chapters", nargs="*", metavar="CHAPTER", help="Only check these chapters")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = IntegrityIndex().check(args.chapters or None)
+    print(json.dumps(report, indent=2) if args.json else "\n".join(describe(report)))
+    if report["errors"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    cli()
@@ -0,0 +1,92 @@
+import json
+import logging
+import pathlib
+import datetime
+import pandas as pd
+from typing import Optional, TYPE_CHECKING
+# custom scripts
+import helpers
+import transcript
+
+if TYPE_CHECKING:
+    import taxonomy
+
+
+JOURNAL_PATH = helpers.BASE_PATH/"output/journal"
+
+
+class RunJournal(object):
+    """
+    Write-ahead journal of a classification run.
+
+    Each split's raw API response and merged DataFrame are saved as soon as they are available,
+    so that a failed run can be resumed without paying again for the splits already classified.
+
+    Layout: `output/journal/{run_id}/run.json` (selected chapters and splits) and
+    `output/journal/{run_id}/{chapter}/{split}.json|.csv`
+    """
+    def __init__(self, run_id: str):
+        self.run_id = run_id
+        self.path = JOURNAL_PATH/run_id
+        self.csv_settings = helpers.CSV_SETTINGS
+
+    @classmethod
+    def new(cls, taxonomy: "taxonomy.Taxonomy") -> "RunJournal":
+        # Same naming used for the output files, so the run id is also the output file name
+        now = datetime.datetime.now().strftime("%d-%m-%YT%H-%M")
+        journal = cls(f"{now}_{taxonomy.abbreviation}")
+
+        if journal.path.exists():
+            raise FileExistsError(f"Run '{journal.run_id}' already exists. Use --resume {journal.run_id} to resume it.")
+        journal.path.mkdir(parents=True)
+        logging.info(f"Journaling run '{journal.run_id}' at {journal.path.as_posix()}")
+        return journal
+
+    @classmethod
+    def open(cls, run_id: str) -> "RunJournal":
+        journal = cls(run_id)
+        if not (journal.path/"run.json").exists():
+            raise FileNotFoundError(f"Run '{run_id}' not found in {JOURNAL_PATH.as_posix()}")
+        return journal
+
+    def write_selection(self, selection: dict[str, list[int]]):
+        with open(self.path/"run.json", "w") as f:
+            json.dump({"run_id": self.run_id, "selection": selection}, f, indent=2)
+
+    def read_selection(self) -> dict[str, list[int]]:
+        return json.load(open(self.path/"run.json", "r"))["selection"]
+
+    def _split_path(self, chapter: str, split: int, suffix: str) -> pathlib.Path:
+        return self.path/chapter/f"{split}{suffix}"
+
+    def _write(self, path: pathlib.Path, write_fn):
+        # Write to a temporary file first: a crash mid-write must not leave a truncated entry behind
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        write_fn(tmp_path)
+        tmp_path.replace(path)
+
+    def save_response(self, chapter: str, split: int, response: dict):
+        def write_fn(p: pathlib.Path):
+            with open(p, "w") as f:
+                json.dump(response, f, indent=2)
+        self._write(self._split_path(chapter, split, ".json"), write_fn)
+
+    def save_frame(self, chapter: str, split: int, df: pd.DataFrame):
+        self._write(
+            self._split_path(chapter, split, ".csv"),
+            lambda p: df.to_csv(p.as_posix(), **self.csv_settings, index=False)
+        )
+
+    def load_response(self, chapter: str, split: int) -> Optional[dict]:
+        path = self._split_path(chapter, split, ".json")
+        if not path.exists():
+            return None
+        return json.load(open(path, "r"))
+
+    def load_frame(self, chapter: str, split: int) -> Optional[pd.DataFrame]:
+        path = self._split_path(chapter, split, ".csv")
+        if not path.exists():
+            return None
+        return transcript.read_transcript(path)
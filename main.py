@@ -1,51 +1,244 @@
 import argparse
+import json
 import logging
+import pathlib
+import sys
 import textwrap
 # custom scripts
-from editor import Editor
-from scraper import Scraper
-from splitter import Splitter
+import helpers
+import instrumentation
 
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger(__name__)
+# Stages of the data preparation pipeline, in order. Their modules (pandas, bs4, requests, lameenc...)
+# are only imported when the stage runs: --help, status and dry runs start without them.
+PIPELINE_STAGES = ["scrape", "edit", "split"]
+COMMANDS = PIPELINE_STAGES + ["run", "classify", "check", "taxonomy", "status"]
+
+
+def run_scrape(args: argparse.Namespace):
+    import scraper
+
+    unknown = [s for s in args.sources if s not in scraper.ADAPTERS]
+    if unknown:
+        raise SystemExit(f"Unknown sources {unknown}. Available: {list(scraper.ADAPTERS)}")
+    scraper.scrape_sources(args.sources, parser="html.parser", use_cache=not args.refresh_cache)
+
+
+def run_edit(args: argparse.Namespace):
+    from editor import Editor
+
+    Editor(cmd_line_args=args).main()
+
+
+def run_split(args: argparse.Namespace):
+    from splitter import Splitter
+
+    Splitter(snap_tolerance=args.snap_splits).main()
+
+
+def _files(folder: pathlib.Path, suffix: str=None) -> list[pathlib.Path]:
+    if not folder.exists():
+        return []
+    return [f for f in folder.iterdir() if f.is_file() and (suffix is None or f.suffix == suffix)]
+
+
+def plan(stages: list[str]) -> list[str]:
+    """What each stage would read, delete and write, without running it"""
+    raw = _files(helpers.CSV_PATH/"1_raw", ".csv")
+    edits = _files(helpers.CSV_PATH/"2_edits", ".csv")
+    csv_splits = _files(helpers.CSV_PATH/"3_splits", ".csv")
+    mp3_splits = _files(helpers.AUDIO_PATH/"3_splits")
+    wavs = _files(helpers.AUDIO_PATH/"2_edits", ".wav")
+
+    lines = []
+    if "scrape" in stages:
+        lines.append(f"scrape: download (or read from 'html_cache') the transcript pages, overwrite {len(raw)} csv in 'csv/1_raw'")
+    if "edit" in stages:
+        lines.append(f"edit:   delete {len(edits)} csv in 'csv/2_edits', apply 'edit_rules.json' to the raw csv")
+    if "split" in stages:
+        lines.append(
+            f"split:  delete {len(csv_splits)} csv and {len(mp3_splits)} mp3 splits, "
+            f"split {len(wavs)} wav with 'split_rules.json'"
+        )
+    return lines
+
+
+def graph_stages(args: argparse.Namespace) -> list[str]:
+    """Stages of the task graph run by 'run': up to `--until`, without the ones turned off"""
+    import pipeline
+
+    until = {"split": "split_wav", "classify": "classify", "publish": "publish"}[args.until]
+    stages = pipeline.STAGES[:pipeline.STAGES.index(until) + 1]
+    off = {"scrape": args.no_scrape, "edit": args.no_edit, "split_csv": args.no_split, "split_wav": args.no_split}
+    return [s for s in stages if not off.get(s)]
+
+
+def run_graph(args: argparse.Namespace):
+    """Runs the stale per-chapter tasks of the pipeline, see pipeline.py"""
+    import pipeline
+
+    if args.profile:
+        # Only the stages of the main thread are profiled: the tasks run one at a time, in the main thread
+        args.workers = 1
+        profile_dir = instrumentation.enable_profiling()
+        logging.info(f"Profiling enabled: writing profiles to {profile_dir.as_posix()}")
+    if args.events_file:
+        instrumentation.log_events_to(args.events_file)
+
+    graph = pipeline.Pipeline(args, graph_stages(args), chapters=args.chapters).build()
+    status = graph.run()
+    print("\n".join(graph.report()))
+    if not args.dry_run:
+        import integrity
+
+        # The splits just built, checked against each other before they are classified
+        report = integrity.IntegrityIndex().check(args.chapters or None)
+        print(integrity.describe(report)[-1] + (": see 'python main.py check'" if report["issues"] else ""))
+    if "failed" in status.values():
+        raise SystemExit(1)
+
+
+def run(args: argparse.Namespace):
+    stages = [s for s in PIPELINE_STAGES if s in args.stages and not getattr(args, f"no_{s}", False)]
+    if args.dry_run:
+        print("\n".join(plan(stages)) if stages else "Nothing to run")
+        return
+
+    if args.profile:
+        profile_dir = instrumentation.enable_profiling()
+        logging.info(f"Profiling enabled: writing profiles to {profile_dir.as_posix()}")
+    if args.events_file:
+        instrumentation.log_events_to(args.events_file)
 
+    runners = {"scrape": run_scrape, "edit": run_edit, "split": run_split}
+    names = {"scrape": "scraper", "edit": "editor", "split": "splitter"}
+    for stage in stages:
+        logging.info(f"### BEGIN {names[stage].upper()} ###")
+        with instrumentation.stage(names[stage]):
+            runners[stage](args)
+
+
+def status(args: argparse.Namespace):
+    """Files at each step of the pipeline and classification runs, read from the folders only"""
+    print(f"Raw transcripts:     {len(_files(helpers.CSV_PATH/'1_raw', '.csv'))} csv")
+    print(f"Edited transcripts:  {len(_files(helpers.CSV_PATH/'2_edits', '.csv'))} csv, {len(_files(helpers.AUDIO_PATH/'2_edits', '.wav'))} wav")
+    print(f"Splits:              {len(_files(helpers.CSV_PATH/'3_splits', '.csv'))} csv, {len(_files(helpers.AUDIO_PATH/'3_splits', '.mp3'))} mp3")
+
+    catalog_path = helpers.CSV_PATH/"3_splits/catalog.json"
+    if catalog_path.exists():
+        splits = json.load(open(catalog_path, "r")).get("splits", [])
+        print(f"Split catalog:       {len(splits)} splits of {len({s['chapter'] for s in splits})} chapters")
+    else:
+        print("Split catalog:       not built yet")
+
+    scored = helpers.BASE_PATH/"output/emotions_scored"
+    chapters = [d for d in scored.iterdir() if d.is_dir() and d.stem != "Z_Final"] if scored.exists() else []
+    classified = [d for d in chapters if _files(d, ".csv")]
+    print(f"Classified chapters: {len(classified)} ({sum(len(_files(d, '.csv')) for d in classified)} runs)")
+
+    journal_path = helpers.BASE_PATH/"output/journal"
+    runs = [d for d in journal_path.iterdir() if d.is_dir()] if journal_path.exists() else []
+    print(f"Journaled runs:      {len(runs)}")
+
+    results = sorted((helpers.BASE_PATH/"output/result").glob("*.csv"))
+    print(f"Latest result:       {results[-1].name if results else 'none'}")
+
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description=textwrap.dedent(
             """
             Run the data preparation pipeline. Does not include classification (i.e. model prompting).
-            To run the data classification, use 'python classifier.py' which will have a cmd-line UI
+            To run the data classification, use 'python main.py classify' (or 'python classifier.py')
+            which will have a cmd-line UI.
+
+            'run' builds the pipeline as a graph of per-chapter tasks (scrape, edit, split, classify), running
+            independent chapters in parallel and only the tasks whose inputs changed. The stage commands
+            ('scrape', 'edit', 'split') run a whole stage for every chapter.
+
+            Without a command, runs the whole pipeline: 'python main.py --no-scraper' is 'python main.py run --no-scraper'.
             """
         ),
         formatter_class=argparse.RawTextHelpFormatter
     )
-    parser.add_argument("--no-scraper", action="store_true", help="Do not run the Scraper")
-    parser.add_argument("--no-editor", action="store_true", help="Do not run the Editor")
-    parser.add_argument("--no-splitter", action="store_true", help="Do not run the Splitter")
-    parser.add_argument("--keep-narrator", action="store_true", help="Keep the narrator lines")
-    parser.add_argument("--keep-gibberish", action="store_true", help="Do not add a \"(gibberish)\" prefix to all the lines in gibberish")
-    args = parser.parse_args()
-    logging.info(f"Running with arguments: {args}")
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
 
-    starting_webpage = (
-        "https://www.dawnborn.com/game-transcripts/"
-        "clair-obscur-expedition-33-game-transcript-all-dialogues/"
-        "clair-obscur-expedition-33-the-gommage-dawnborn/"
+    # Options of each stage, shared by its own command and by 'run'
+    scrape_options = argparse.ArgumentParser(add_help=False)
+    scrape_options.add_argument("--sources", nargs="+", default=["dawnborn"], help="Transcript websites to scrape")
+    scrape_options.add_argument("--refresh-cache", action="store_true", help="Download the pages again instead of reading them from 'html_cache'")
+    edit_options = argparse.ArgumentParser(add_help=False)
+    edit_options.add_argument("--keep-narrator", action="store_true", help="Keep the narrator lines")
+    edit_options.add_argument("--keep-gibberish", action="store_true", help="Do not add a \"(gibberish)\" prefix to all the lines in gibberish")
+    split_options = argparse.ArgumentParser(add_help=False)
+    split_options.add_argument("--snap-splits", type=float, metavar="SECONDS", help="Move the audio split timestamps to the nearest silence, up to SECONDS away")
+    run_options = argparse.ArgumentParser(add_help=False)
+    run_options.add_argument("--dry-run", action="store_true", help="Print what the stages (or the stale tasks of 'run') would do, without running them")
+    run_options.add_argument("--profile", action="store_true", help="Write cProfile and tracemalloc snapshots of each stage to 'output/profiles'")
+    run_options.add_argument("--events-file", type=pathlib.Path, help="Append the structured timing events (JSON lines) to this file")
+
+    run_parser = subparsers.add_parser(
+        "run", parents=[scrape_options, edit_options, split_options, run_options], help="Run the whole pipeline (default)"
+    )
+    run_parser.add_argument("--no-scraper", dest="no_scrape", action="store_true", help="Do not run the Scraper")
+    run_parser.add_argument("--no-editor", dest="no_edit", action="store_true", help="Do not run the Editor")
+    run_parser.add_argument("--no-splitter", dest="no_split", action="store_true", help="Do not run the Splitter")
+    run_parser.add_argument("chapters", nargs="*", metavar="CHAPTER", help="Only build these chapters, e.g. 12_Old_Lumiere")
+    run_parser.add_argument(
+        "--until", choices=["split", "classify", "publish"], default="split",
+        help="Last stage to build (default: split). 'classify' prompts the model for the stale chapters, check them with --dry-run first (see --adopt)"
+    )
+    run_parser.add_argument("--workers", type=int, help="Tasks running at the same time (default: number of CPUs)")
+    run_parser.add_argument("--force", action="store_true", help="Build every task, even when its outputs are up to date")
+    run_parser.add_argument(
+        "--adopt", action="store_true",
+        help="Take the existing outputs of the tasks never run by 'run' as up to date, instead of building them again"
     )
+    run_parser.set_defaults(stages=PIPELINE_STAGES)
+
+    stage_options = {"scrape": scrape_options, "edit": edit_options, "split": split_options}
+    for stage in PIPELINE_STAGES:
+        stage_parser = subparsers.add_parser(stage, parents=[stage_options[stage], run_options], help=f"Only run the {stage} stage")
+        stage_parser.set_defaults(stages=[stage])
+
+    subparsers.add_parser("classify", add_help=False, help="Classify the splits: same arguments as classifier.py")
+    subparsers.add_parser("check", add_help=False, help="Check the consistency of the stages: same arguments as integrity.py")
+    subparsers.add_parser("taxonomy", add_help=False, help="Reprocess classified runs with a taxonomy: same arguments as taxonomy.py")
+    subparsers.add_parser("status", help="Files at each step of the pipeline")
+    return parser
+
+
+def main(argv: list[str]=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ["-h", "--help"]):
+        # Backward compatible: no command runs the whole pipeline
+        argv = ["run"] + argv
+
+    if argv[0] == "classify":
+        # classifier.py has its own arguments
+        import classifier
+        return classifier.cli(argv[1:], prog="main.py classify")
+    if argv[0] == "check":
+        import integrity
+        return integrity.cli(argv[1:], prog="main.py check")
+    if argv[0] == "taxonomy":
+        import taxonomy
+        return taxonomy.cli(argv[1:], prog="main.py taxonomy")
+
+    args = build_parser().parse_args(argv)
+    if args.command == "status":
+        status(args)
+        return
+
+    logging.info(f"Running with arguments: {args}")
+    if args.command == "run":
+        run_graph(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
 
-    if args.no_scraper is False:
-        logging.info("### BEGIN SCRAPER ###")
-        parser = Scraper(parser="html.parser")
-        parser.load_page(starting_webpage)
-        parser.main()
-
-    if args.no_editor is False:
-        logging.info("### BEGIN EDITOR ###")
-        editor = Editor(cmd_line_args=args)
-        editor.main()
-
-    if args.no_splitter is False:
-        logging.info("### BEGIN SPLITTER ###")
-        splitter = Splitter()
-        splitter.main()
+    main()
@@ -0,0 +1,492 @@
+import os
+import json
+import queue
+import logging
+import pathlib
+import threading
+from argparse import Namespace
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+# custom scripts
+import helpers
+import catalog
+import instrumentation
+
+
+# Stages of the task graph, in data flow order:
+# scrape (per source) → edit → split_csv / split_wav → classify (per chapter) → merge → publish (all chapters)
+STAGES = ["scrape", "edit", "split_csv", "split_wav", "classify", "merge", "publish"]
+# Tasks of these stages run one at a time: they share the classifier (and its run journal) or the result store
+SERIAL_STAGES = {"classify", "merge", "publish"}
+# Statuses of the tasks that don't block their dependents ("stale": would be built, in a dry run)
+DONE = {"built", "fresh", "stale"}
+
+
+class Task(object):
+    """
+    Node of the task graph: `fn` builds the files of `outputs()` from the files of `inputs()`, once the
+    tasks in `deps` are done. Dependencies that are not in the graph (e.g. of a stage left out) are done.
+
+    A task without `fn` is a milestone: done with its dependencies, or earlier with `Executor.resolve()`.
+    """
+    def __init__(self, name: str, stage: str, chapter: str=None, fn: Callable[[], None]=None, deps: list[str]=None,
+                 inputs: Callable[[], list[pathlib.Path]]=None, outputs: Callable[[], list[pathlib.Path]]=None, always: bool=False):
+        self.name = name
+        self.stage = stage
+        self.chapter = chapter
+        self.fn = fn
+        self.deps = list(deps or [])
+        self.inputs = inputs if inputs is not None else list
+        self.outputs = outputs if outputs is not None else list
+        # Run even when the outputs are up to date (e.g. scraping with a refreshed cache)
+        self.always = always
+
+    def __repr__(self):
+        return f"Task('{self.name}', deps={self.deps})"
+
+
+class BuildState(object):
+    """
+    sha1 of the inputs of every task at its last successful run, in `output/pipeline_state.json`.
+    A task is up to date when its outputs exist and its inputs have the same hashes: rewriting a file
+    with the same content (e.g. editing again a chapter whose rules did not change) does not rebuild
+    the next stages. Files are hashed again only when their size or mtime change.
+
+    A task never run by the pipeline is stale, even when its outputs exist: they may come from older rules.
+    With `adopt`, its existing outputs are taken as up to date instead and its current inputs are recorded
+    (e.g. on a fresh checkout, to avoid classifying every chapter again).
+    """
+    def __init__(self, path: pathlib.Path=None, adopt: bool=False):
+        self.path = path if path is not None else helpers.BASE_PATH/"output/pipeline_state.json"
+        self.adopt = adopt
+        self._lock = threading.Lock()
+        saved = json.load(open(self.path, "r")) if self.path.exists() else {}
+        self._files: dict[str, dict] = saved.get("files", {})
+        self._tasks: dict[str, dict[str, str]] = saved.get("tasks", {})
+
+    @staticmethod
+    def _key(path: pathlib.Path) -> str:
+        try:
+            return path.relative_to(helpers.BASE_PATH).as_posix()
+        except ValueError:
+            return path.as_posix()
+
+    def _hash(self, path: pathlib.Path) -> str:
+        key = self._key(path)
+        stat = path.stat()
+        cached = self._files.get(key)
+        if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached["sha1"]
+
+        sha1 = catalog.file_hash(path)
+        with self._lock:
+            self._files[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": sha1}
+        return sha1
+
+    def signature(self, paths: list[pathlib.Path]) -> dict[str, str]:
+        return {self._key(p): self._hash(p) for p in sorted(set(paths)) if p.exists()}
+
+    def fresh(self, task: Task, record: bool=True) -> bool:
+        outputs = task.outputs()
+        if not outputs or not all(p.exists() for p in outputs):
+            return False
+
+        recorded = self._tasks.get(task.name)
+        if recorded is None:
+            if not self.adopt:
+                return False
+            # Adopted: the current inputs are the reference of the next runs
+            if record:
+                self.record(task, self.signature(task.inputs()))
+            return True
+        return recorded == self.signature(task.inputs())
+
+    def record(self, task: Task, signature: dict[str, str]):
+        with self._lock:
+            self._tasks[task.name] = signature
+            self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"files": self._files, "tasks": self._tasks}, f, indent=2)
+        tmp_path.replace(self.path)
+
+
+class Executor(object):
+    """
+    Runs a task graph on a pool of `workers` threads. A task starts as soon as its dependencies are done,
+    so a chapter can go through every stage while the others are still scraping. Ready tasks of the later
+    stages go first. Up to date tasks are not run (see BuildState) and the dependents of a failed task
+    are skipped. Tasks can be added while the graph runs (e.g. chapters found by the scraper).
+
+    With `dry_run`, no task is run: the tasks that would be built are "stale", and so are their dependents.
+    """
+    def __init__(self, workers: int=None, state: BuildState=None, force: bool=False, dry_run: bool=False):
+        self.workers = workers or os.cpu_count() or 1
+        self.state = state if state is not None else BuildState()
+        self.force = force
+        self.dry_run = dry_run
+
+        self.tasks: dict[str, Task] = {}
+        # Task name -> pending | running | built | fresh | stale | failed | skipped
+        self.status: dict[str, str] = {}
+        self.errors: dict[str, str] = {}
+        self._lock = threading.RLock()
+        # Wakes up the scheduler: a task ended, or the graph changed
+        self._events = queue.Queue()
+
+    def add(self, task: Task) -> Task:
+        with self._lock:
+            if task.name not in self.tasks:
+                self.tasks[task.name] = task
+                self.status[task.name] = "pending"
+        self._events.put(task.name)
+        return self.tasks[task.name]
+
+    def add_deps(self, name: str, deps: list[str]):
+        """Adds dependencies to a task of the graph, e.g. of a chapter found while the graph runs"""
+        with self._lock:
+            self.tasks[name].deps.extend(d for d in deps if d not in self.tasks[name].deps)
+        self._events.put(name)
+
+    def resolve(self, name: str):
+        """Marks a pending milestone as done, before its dependencies"""
+        with self._lock:
+            if self.status.get(name) == "pending" and self.tasks[name].fn is None:
+                self.status[name] = "built"
+        self._events.put(name)
+
+    def _dep_status(self, name: str) -> str:
+        return self.status.get(name, "fresh")
+
+    def _schedule(self) -> list[Task]:
+        """Pending tasks that can start now. Updates the milestones and the skipped tasks."""
+        busy = {self.tasks[n].stage for n, s in self.status.items() if s == "running"} & SERIAL_STAGES
+        ready = []
+        changed = True
+        while changed:
+            changed = False
+            for name, task in self.tasks.items():
+                if self.status[name] != "pending":
+                    continue
+                deps = [self._dep_status(d) for d in task.deps]
+                if any(d in ("failed", "skipped") for d in deps):
+                    self.status[name] = "skipped"
+                    changed = True
+                elif all(d in DONE for d in deps) and task.fn is None:
+                    self.status[name] = "stale" if "stale" in deps else "built"
+                    changed = True
+                elif all(d in DONE for d in deps) and task not in ready:
+                    ready.append(task)
+
+        ready.sort(key=lambda t: -STAGES.index(t.stage))
+        scheduled = []
+        for task in ready:
+            if self.status[task.name] != "pending" or task.stage in busy:
+                continue
+            if task.stage in SERIAL_STAGES:
+                busy.add(task.stage)
+            scheduled.append(task)
+        return scheduled
+
+    def _run(self, task: Task):
+        try:
+            with self._lock:
+                stale_deps = any(self._dep_status(d) == "stale" for d in task.deps)
+            if self.dry_run:
+                fresh = not (self.force or task.always or stale_deps) and self.state.fresh(task, record=False)
+                status = "fresh" if fresh else "stale"
+            elif not (self.force or task.always) and self.state.fresh(task):
+                status = "fresh"
+            else:
+                signature = self.state.signature(task.inputs())
+                logging.info(f"Running task '{task.name}'")
+                task.fn()
+                self.state.record(task, signature)
+                status = "built"
+        except Exception as e:
+            logging.exception(f"Task '{task.name}' failed")
+            self.errors[task.name] = repr(e)
+            status = "failed"
+
+        with self._lock:
+            self.status[task.name] = status
+        self._events.put(task.name)
+
+    def run(self) -> dict[str, str]:
+        """Runs the graph, returns the status of every task. With one worker, tasks run in the calling thread."""
+        if self.workers == 1:
+            while True:
+                with self._lock:
+                    scheduled = self._schedule()[:1]
+                if not scheduled:
+                    break
+                self.status[scheduled[0].name] = "running"
+                self._run(scheduled[0])
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                while True:
+                    with self._lock:
+                        for task in self._schedule():
+                            self.status[task.name] = "running"
+                            pool.submit(self._run, task)
+                        if "running" not in self.status.values():
+                            break
+                    self._events.get()
+
+        # Tasks waiting on a dependency cycle or on a milestone that was never resolved
+        for name, status in self.status.items():
+            if status == "pending":
+                self.status[name] = "skipped"
+        return dict(self.status)
+
+
+def _latest_file(folder: pathlib.Path, suffix: str) -> list[pathlib.Path]:
+    """Latest file of a folder (by ctime, as in prep_for_dashboard.py), as a list"""
+    files = [f for f in folder.iterdir() if f.suffix == suffix] if folder.exists() else []
+    return [max(files, key=lambda f: f.stat().st_ctime)] if files else []
+
+
+def _stems(folder: pathlib.Path, suffix: str) -> set[str]:
+    return {f.stem for f in folder.iterdir() if f.is_file() and f.suffix == suffix} if folder.exists() else set()
+
+
+class Pipeline(object):
+    """
+    Task graph of the pipeline, with a task per chapter and stage (see STAGES). Only the `stages` are
+    built, for the `chapters` targets (all the chapters by default). The stage modules are imported by
+    the tasks that run.
+    """
+    def __init__(self, cmd_line_args: Namespace, stages: list[str], chapters: list[str]=None):
+        self.cmd_line_args = cmd_line_args
+        self.stages = [s for s in STAGES if s in stages]
+        self.targets = set(chapters) if chapters else None
+        self.executor = Executor(
+            workers=cmd_line_args.workers, state=BuildState(adopt=getattr(cmd_line_args, "adopt", False)),
+            force=cmd_line_args.force, dry_run=cmd_line_args.dry_run
+        )
+
+        self._lock = threading.Lock()
+        self._editor = None
+        self._edit_rules = None
+        self._inserts = None
+        self._splitter = None
+        self._classifier = None
+        self._adapters = None
+
+        self.edit_rules_path = helpers.BASE_PATH/"0_data_manip_cfg/edit_rules.json"
+        self.split_rules_path = helpers.BASE_PATH/"0_data_manip_cfg/split_rules.json"
+
+    # Shared state of the tasks, created on first use
+    def edit_rules(self):
+        with self._lock:
+            if self._edit_rules is None:
+                from editor import Editor
+                self._editor = Editor(cmd_line_args=self.cmd_line_args)
+                self._edit_rules = self._editor.load_rules()
+        return self._edit_rules
+
+    def inserts(self) -> dict[str, dict]:
+        """Custom inserts of the edit rules by target chapter, read without the editor (pandas)"""
+        with self._lock:
+            if self._inserts is None:
+                self._inserts = helpers.edit_inserts(json.load(open(self.edit_rules_path, "r")))
+        return self._inserts
+
+    def splitter(self):
+        with self._lock:
+            if self._splitter is None:
+                from splitter import Splitter
+                self._splitter = Splitter(delete_existing=False, snap_tolerance=self.cmd_line_args.snap_splits)
+        return self._splitter
+
+    def classifier(self):
+        # Only called by the classify tasks, that run one at a time
+        if self._classifier is None:
+            import journal
+            from classifier import Classifier
+
+            self._classifier = Classifier()
+            self._classifier.authorize()
+            self._classifier.journal = journal.RunJournal.new(self._classifier.taxonomy)
+            self._classifier.journal.write_selection({})
+        return self._classifier
+
+    def source(self, chapter: str) -> str:
+        """Scraped source of a chapter: the one with the longest matching raw csv prefix"""
+        if self._adapters is None:
+            import scraper
+            self._adapters = {s: scraper.ADAPTERS[s].output_prefix for s in self.cmd_line_args.sources}
+        matches = [s for s, prefix in self._adapters.items() if chapter.startswith(prefix)]
+        return max(matches, key=lambda s: len(self._adapters[s])) if matches else None
+
+    def chapters(self) -> list[str]:
+        """Chapters known before scraping: raw and edited transcripts, custom inserts and wavs"""
+        chapters = (
+            _stems(helpers.CSV_PATH/"1_raw", ".csv")
+            | _stems(helpers.CSV_PATH/"2_edits", ".csv")
+            | _stems(helpers.AUDIO_PATH/"2_edits", ".wav")
+        )
+        if "edit" in self.stages:
+            chapters |= set(self.inserts())
+
+        if self.targets is not None:
+            unknown = self.targets - chapters
+            if unknown and "scrape" not in self.stages:
+                logging.warning(f"Unknown chapters {sorted(unknown)}. Skipped.")
+            chapters &= self.targets
+        return sorted(chapters, key=lambda c: (catalog.chapter_order(c), c))
+
+    # Tasks
+    def _scrape(self, source: str):
+        import scraper
+
+        scraper.scrape_sources(
+            [source], use_cache=not self.cmd_line_args.refresh_cache, on_chapter=lambda path: self._scraped(path.stem)
+        )
+
+    def _scraped(self, chapter: str):
+        if self.targets is not None and chapter not in self.targets:
+            return
+        if f"raw:{chapter}" not in self.executor.tasks:
+            logging.info(f"New chapter '{chapter}'")
+            self.add_chapter(chapter)
+        self.executor.resolve(f"raw:{chapter}")
+
+    def _edit(self, chapter: str):
+        edit_rules = self.edit_rules()
+        raw = helpers.CSV_PATH/f"1_raw/{chapter}.csv"
+        if raw.exists():
+            self._editor.edit_chapter(raw, edit_rules)
+        else:
+            self._editor.write_custom_chapter(chapter, edit_rules)
+
+    def _insert_paths(self, chapter: str) -> list[pathlib.Path]:
+        """Custom insert files of a chapter"""
+        insert = self.inserts().get(chapter)
+        return [helpers.CSV_PATH/"2_edits/custom_inserts"/f"{s}.csv" for s in insert["sources"]] if insert else []
+
+    def _classify(self, chapter: str):
+        classifier = self.classifier()
+        classifier.check_integrity([chapter])
+        classifier.catalog.refresh()
+        pair = next((p for p in classifier.csv_mp3_split_pairs() if p.chapter == chapter), None)
+        if pair is None:
+            raise FileNotFoundError(f"Chapter '{chapter}' has no complete csv and mp3 splits")
+
+        selection = classifier.journal.read_selection()
+        selection[chapter] = list(pair.csv.indices)
+        classifier.journal.write_selection(selection)
+        classifier.classify_chapter(pair)
+
+    @instrumentation.instrumented("merge")
+    def _merge(self):
+        import prep_for_dashboard
+
+        prep_for_dashboard.write_store(prep_for_dashboard.merge(prep_for_dashboard.latest_runs()))
+
+    @instrumentation.instrumented("publish")
+    def _publish(self):
+        import prep_for_dashboard
+        import result_store
+
+        prep_for_dashboard.publish(result_store.ResultStore.open())
+
+    def _latest_store(self) -> list[pathlib.Path]:
+        import result_store
+
+        available = result_store.versions()
+        return [result_store.STORE_PATH/available[-1]/"manifest.json"] if available else []
+
+    def _scored_runs(self) -> list[pathlib.Path]:
+        scored = helpers.BASE_PATH/"output/emotions_scored"
+        chapters = [d for d in scored.iterdir() if d.is_dir() and d.stem != "Z_Final"] if scored.exists() else []
+        return [f for d in chapters for f in _latest_file(d, ".csv")]
+
+    def add_chapter(self, chapter: str):
+        add = self.executor.add
+        raw = helpers.CSV_PATH/f"1_raw/{chapter}.csv"
+        edit_csv = helpers.CSV_PATH/f"2_edits/{chapter}.csv"
+        wav = helpers.AUDIO_PATH/f"2_edits/{chapter}.wav"
+
+        if "scrape" in self.stages and self.source(chapter):
+            add(Task(f"raw:{chapter}", "scrape", chapter, deps=[f"scrape:{self.source(chapter)}"]))
+
+        if "edit" in self.stages and (f"raw:{chapter}" in self.executor.tasks or raw.exists() or chapter in self.inserts()):
+            add(Task(
+                f"edit:{chapter}", "edit", chapter, fn=lambda: self._edit(chapter), deps=[f"raw:{chapter}"],
+                inputs=lambda: [raw, self.edit_rules_path] + self._insert_paths(chapter),
+                outputs=lambda: [edit_csv]
+            ))
+
+        if "split_csv" in self.stages and (f"edit:{chapter}" in self.executor.tasks or edit_csv.exists()):
+            add(Task(
+                f"split_csv:{chapter}", "split_csv", chapter, fn=lambda: self.splitter().split_chapter_csv(edit_csv),
+                deps=[f"edit:{chapter}"], inputs=lambda: [edit_csv, self.split_rules_path],
+                outputs=lambda: catalog.chapter_splits(chapter, "csv")
+            ))
+
+        if "split_wav" in self.stages and wav.exists():
+            add(Task(
+                f"split_wav:{chapter}", "split_wav", chapter, fn=lambda: self.splitter().split_chapter_wav(wav),
+                inputs=lambda: [wav, self.split_rules_path], outputs=lambda: catalog.chapter_splits(chapter, "mp3")
+            ))
+
+        has_splits = all(
+            f"split_{t}:{chapter}" in self.executor.tasks or catalog.chapter_splits(chapter, t) for t in catalog.SPLIT_TYPES
+        )
+        if "classify" in self.stages and has_splits:
+            add(Task(
+                f"classify:{chapter}", "classify", chapter, fn=lambda: self._classify(chapter),
+                deps=[f"split_csv:{chapter}", f"split_wav:{chapter}"],
+                inputs=lambda: catalog.chapter_splits(chapter, "csv") + catalog.chapter_splits(chapter, "mp3"),
+                outputs=lambda: _latest_file(helpers.BASE_PATH/f"output/emotions_scored/{chapter}", ".csv")
+            ))
+            if "merge" in self.executor.tasks:
+                self.executor.add_deps("merge", [f"classify:{chapter}"])
+
+    def build(self):
+        chapters = self.chapters()
+        if "scrape" in self.stages:
+            for source in self.cmd_line_args.sources:
+                self.executor.add(Task(
+                    f"scrape:{source}", "scrape", fn=lambda source=source: self._scrape(source),
+                    outputs=lambda source=source: sorted(
+                        f for f in (helpers.CSV_PATH/"1_raw").glob("*.csv") if self.source(f.stem) == source
+                    ),
+                    always=self.cmd_line_args.refresh_cache
+                ))
+
+        if "merge" in self.stages:
+            # After the scrapers too: they can add chapters to classify
+            self.executor.add(Task(
+                "merge", "merge", fn=self._merge, deps=[f"scrape:{s}" for s in self.cmd_line_args.sources],
+                inputs=self._scored_runs, outputs=self._latest_store
+            ))
+        if "publish" in self.stages:
+            self.executor.add(Task(
+                "publish", "publish", fn=self._publish, deps=["merge"], inputs=self._latest_store,
+                outputs=lambda: [helpers.BASE_PATH/f"output/result/{m.parent.name}.csv" for m in self._latest_store()]
+            ))
+
+        for chapter in chapters:
+            self.add_chapter(chapter)
+        return self
+
+    def run(self) -> dict[str, str]:
+        status = self.executor.run()
+        if any(status[n] == "built" for n, t in self.executor.tasks.items() if t.stage in ("split_csv", "split_wav")):
+            logging.info("Refreshing split catalog")
+            catalog.SplitCatalog().refresh()
+        return status
+
+    def report(self) -> list[str]:
+        """Status of every task with a function, by chapter and stage"""
+        lines = []
+        for name, task in self.executor.tasks.items():
+            if task.fn is not None:
+                error = f" ({self.executor.errors[name]})" if name in self.executor.errors else ""
+                lines.append(f"{self.executor.status[name]:>8}  {name}{error}")
+        return lines
@@ -0,0 +1,243 @@
+import heapq
+import logging
+import math
+import pathlib
+import pandas as pd
+# custom scripts
+import stability
+import transcript
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# Defaults when the history of `api_responses` can't calibrate them
+AUDIO_TOKENS_PER_S = 10
+COMPLETION_TOKENS_PER_LINE = 60
+# Latency model of a request: fixed overhead + generation of the completion
+REQUEST_OVERHEAD_S = 3.0
+OUTPUT_TOKENS_PER_S = 50
+# Text sent before the transcript in the user message (see Classifier.prompt_model)
+TRANSCRIPT_HEADER = "TRANSCRIPT (DO NOT USE FOR CLASSIFICATION):\n"
+# gpt-audio list prices, USD per 1M tokens
+PRICES = {"text_input": 2.5, "audio_input": 32.0, "output": 10.0}
+
+# MPEG audio layer III tables, indexed by the version bits of the frame header (3: MPEG-1, 2: MPEG-2, 0: MPEG-2.5)
+_BITRATES_KBPS = {
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_BITRATES_KBPS[0] = _BITRATES_KBPS[2]
+_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+# Memo of mp3_duration: (path, size, mtime_ns) -> seconds
+_durations: dict[tuple[str, int, int], float] = {}
+# tiktoken encoder, loaded on first use (its BPE file is downloaded the first time). False: not available
+_encoder = None
+
+
+def count_tokens(text: str) -> int:
+    global _encoder
+    if _encoder is None:
+        try:
+            _encoder = tiktoken.get_encoding("o200k_base") if tiktoken is not None else False
+        except Exception as e:
+            # e.g. offline, before the encoding was ever downloaded
+            logging.warning(f"tiktoken encoding not available ({e!r}): estimating the tokens from the characters")
+            _encoder = False
+    if _encoder:
+        return len(_encoder.encode(text))
+    # Rough estimate: ~4 characters per token in English
+    return math.ceil(len(text) / 4)
+
+
+def _frame_header(data: bytes, pos: int) -> tuple[int, int, int, int]:
+    """`(frame_length, samples, sample_rate, version)` of the layer III frame at `pos`, None if there is none"""
+    if pos + 4 > len(data) or data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0:
+        return None
+    version = (data[pos + 1] >> 3) & 0x3
+    layer = (data[pos + 1] >> 1) & 0x3
+    bitrate_ix = data[pos + 2] >> 4
+    rate_ix = (data[pos + 2] >> 2) & 0x3
+    if version == 1 or layer != 1 or bitrate_ix in (0, 15) or rate_ix == 3:
+        return None
+
+    bitrate = _BITRATES_KBPS[version][bitrate_ix] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_ix]
+    padding = (data[pos + 2] >> 1) & 0x1
+    samples = 1152 if version == 3 else 576
+    return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate, version
+
+
+def mp3_duration(path: pathlib.Path) -> float:
+    """
+    Duration in seconds of an MP3 (layer III) file, read from its frame headers without decoding:
+    from the frame count of the Xing/Info header when there is one, by walking the frame headers otherwise.
+    None when the file has no MP3 frames (e.g. a git LFS pointer).
+    """
+    stat = path.stat()
+    key = (path.as_posix(), stat.st_size, stat.st_mtime_ns)
+    if key in _durations:
+        return _durations[key]
+
+    data = path.read_bytes()
+    pos = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        # ID3v2 tag: syncsafe size, plus a footer when flagged
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        pos = 10 + size + (10 if data[5] & 0x10 else 0)
+
+    header = _frame_header(data, pos)
+    while header is None and pos < len(data):
+        # Resync on the next frame
+        pos = data.find(b"\xff", pos + 1)
+        if pos == -1:
+            return None
+        header = _frame_header(data, pos)
+    if header is None:
+        return None
+
+    _, samples, sample_rate, version = header
+    mono = (data[pos + 3] >> 6) == 3
+    xing_at = pos + 4 + (17 if mono else 32) if version == 3 else pos + 4 + (9 if mono else 17)
+    if data[xing_at:xing_at + 4] in (b"Xing", b"Info") and len(data) >= xing_at + 12 and data[xing_at + 7] & 0x1:
+        frames = int.from_bytes(data[xing_at + 8:xing_at + 12], "big")
+        duration = frames * samples / sample_rate
+    else:
+        frames = 0
+        while header is not None:
+            frames += 1
+            pos += header[0]
+            header = _frame_header(data, pos)
+        duration = frames * samples / sample_rate
+
+    _durations[key] = duration
+    return duration
+
+
+def calibrate() -> dict:
+    """
+    Completion tokens per scored line, from the usage stored in `api_responses`.
+    Falls back on COMPLETION_TOKENS_PER_LINE without history.
+    """
+    lines = completion = 0
+    if stability.API_RESPONSES_PATH.exists():
+        for chapter_dir in stability.API_RESPONSES_PATH.iterdir():
+            if chapter_dir.is_dir():
+                usage = stability.load_chapter_usage(chapter_dir.name)
+                usage = usage[usage["lines"] > 0]
+                lines += int(usage["lines"].sum())
+                completion += int(usage["completion_tokens"].sum())
+    return {"completion_tokens_per_line": completion / lines if lines else COMPLETION_TOKENS_PER_LINE, "history_lines": lines}
+
+
+class Planner(object):
+    """
+    Plan of a classification run before any request: audio duration of each split (from the MP3 headers),
+    prompt tokens (system message and transcript as sent by `prep_dialogue`), expected completion tokens,
+    requests, wall time and cost. Splits that won't be sent to the model are counted as hits:
+    already in the journal of the run, or reused from their duplicates (see dedup.py).
+
+    Split estimates are memoised by the hashes of the catalog: re-planning after a selection change is cheap.
+    """
+    def __init__(self, classifier, concurrency: int=1, prices: dict=None):
+        self.classifier = classifier
+        self.concurrency = concurrency
+        self.prices = {**PRICES, **(prices or {})}
+        self.calibration = calibrate()
+        self.system_tokens = count_tokens(classifier.system_message)
+        self._splits: dict[tuple, dict] = {}
+        self._previous_runs = {}
+
+    def _previous(self, chapter: str) -> int:
+        """Number of previous runs of a chapter in `api_responses`"""
+        if chapter not in self._previous_runs:
+            chapter_dir = stability.API_RESPONSES_PATH/chapter
+            self._previous_runs[chapter] = len(list(chapter_dir.glob("*.json"))) if chapter_dir.exists() else 0
+        return self._previous_runs[chapter]
+
+    def split_plan(self, chapter: str, split: int) -> dict:
+        entry = self.classifier.catalog.get(chapter, split)
+        csv_file, mp3_file = entry["csv"], entry["mp3"]
+        key = (entry["csv_sha1"], entry["mp3_sha1"], self.classifier.transcript_encoding, self.classifier.max_line_chars,
+               self.classifier.reuse_coverage)
+        if key in self._splits:
+            return dict(self._splits[key])
+
+        df = transcript.read_transcript(csv_file)
+        dialogue = self.classifier.prep_dialogue(
+            df, encoding=self.classifier.transcript_encoding, max_line_chars=self.classifier.max_line_chars
+        )
+        audio_s = mp3_duration(mp3_file)
+        plan = {
+            "chapter": chapter,
+            "split": split,
+            "lines": len(df),
+            "audio_s": audio_s,
+            "text_tokens": self.system_tokens + count_tokens(TRANSCRIPT_HEADER + dialogue),
+            "audio_tokens": round(audio_s * AUDIO_TOKENS_PER_S) if audio_s is not None else None,
+            "completion_tokens": round(len(df) * self.calibration["completion_tokens_per_line"]),
+            "reused": self.classifier._reusable(df),
+        }
+        self._splits[key] = plan
+        return dict(plan)
+
+    def plan(self, selection: dict[str, list[int]]) -> pd.DataFrame:
+        """One row per selected split"""
+        run_journal = self.classifier.journal
+        rows = []
+        for chapter, splits in selection.items():
+            for split in splits:
+                plan = self.split_plan(chapter, split)
+                plan["journaled"] = run_journal is not None and run_journal.load_response(chapter, split) is not None
+                plan["previous_runs"] = self._previous(chapter)
+                rows.append(plan)
+
+        df = pd.DataFrame(rows, columns=[
+            "chapter", "split", "lines", "audio_s", "text_tokens", "audio_tokens", "completion_tokens",
+            "reused", "journaled", "previous_runs"
+        ])
+        # Unknown audio durations are NaN
+        df[["audio_s", "audio_tokens"]] = df[["audio_s", "audio_tokens"]].astype(float)
+        df["request"] = ~(df["reused"].astype(bool) | df["journaled"].astype(bool))
+        df["latency_s"] = REQUEST_OVERHEAD_S + df["completion_tokens"] / OUTPUT_TOKENS_PER_S
+        df["cost"] = (
+            df["text_tokens"] * self.prices["text_input"]
+            + df["audio_tokens"].fillna(0) * self.prices["audio_input"]
+            + df["completion_tokens"] * self.prices["output"]
+        ) / 1_000_000
+        df.loc[~df["request"], ["latency_s", "cost"]] = 0.0
+        return df
+
+    def wall_time(self, latencies: list[float]) -> float:
+        """Makespan of the requests on `concurrency` workers, longest first to the least loaded worker"""
+        workers = [0.0] * max(1, self.concurrency)
+        for latency in sorted(latencies, reverse=True):
+            heapq.heappush(workers, heapq.heappop(workers) + latency)
+        return max(workers)
+
+    def summary(self, selection: dict[str, list[int]]) -> dict:
+        df = self.plan(selection)
+        requests = df[df["request"]]
+        return {
+            "splits": len(df),
+            "requests": len(requests),
+            "hits": int((~df["request"]).sum()),
+            "audio_s": float(df["audio_s"].sum()),
+            "unknown_audio": int(df["audio_s"].isna().sum()),
+            "prompt_tokens": int(requests["text_tokens"].sum() + requests["audio_tokens"].fillna(0).sum()),
+            "completion_tokens": int(requests["completion_tokens"].sum()),
+            "wall_s": self.wall_time(requests["latency_s"].to_list()),
+            "cost": float(df["cost"].sum()),
+        }
+
+    @staticmethod
+    def describe(summary: dict) -> str:
+        """One-line description of a summary"""
+        unknown = f" ({summary['unknown_audio']} unknown)" if summary["unknown_audio"] else ""
+        return (
+            f"{summary['requests']} requests ({summary['hits']} hits) | audio {summary['audio_s'] / 60:.1f} min{unknown} | "
+            f"~{summary['prompt_tokens'] / 1000:.1f}k in / {summary['completion_tokens'] / 1000:.1f}k out tokens | "
+            f"~{summary['wall_s'] / 60:.1f} min | ~${summary['cost']:.2f}"
+        )
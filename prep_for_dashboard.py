@@ -5,52 +5,72 @@ import io
 import pandas as pd
 # custom scripts
 import helpers
+import query
+import result_store
+import transcript
 
 
-logging.basicConfig(level=logging.INFO)
-logging.getLogger(__name__)
+def emotions_scored_dir() -> pathlib.Path:
+    return helpers.BASE_PATH/"output/emotions_scored/"
 
 
-emotions_scored_dir = helpers.BASE_PATH/"output/emotions_scored/"
+def latest_runs() -> list[pathlib.Path]:
+    """Latest classification file of each chapter"""
+    runs = []
+    for item in emotions_scored_dir().iterdir():
+        if item.is_dir() and item.stem != "Z_Final":
+            chapter = item.stem
+            files = list(item.iterdir())
 
-dfs = []
-logging.info("Beginning selection of latest classification file for each chapter")
-logging.info("---")
-for item in emotions_scored_dir.iterdir():
-    if item.is_dir() and item.stem != "Z_Final":
-        chapter = item.stem
-        files = list((emotions_scored_dir/item).iterdir())
+            if len(files) > 0:
+                most_recent_file = max(files, key=lambda f: f.stat().st_ctime)
+                logging.info(f"Chapter '{chapter}': selected file '{most_recent_file.name}'")
+                runs.append(most_recent_file)
+            else:
+                logging.warning(f"Chapter '{chapter}' does not have any classification file. Skipped.")
+    return runs
 
-        if len(files) > 0:
-            most_recent_file = max(files, key=lambda f: f.stat().st_ctime)
-            logging.info(f"Chapter '{chapter}': selected file '{most_recent_file.name}'")
 
-            df = pd.read_csv(most_recent_file.as_posix(), **helpers.CSV_SETTINGS)
-            dfs.append(df)
-        else:
-            logging.warning(f"Chapter '{chapter}' does not have any classification file. Skipped.")
+def merge(runs: list[pathlib.Path]) -> pd.DataFrame:
+    """
+    Concatenates the classification files, with the act of each chapter.
+    The index (exported as `row_index`) is the row of each line in its chapter file.
+    """
+    full_df = transcript.concat([transcript.read_transcript(f) for f in runs], ignore_index=False)
+    full_df.sort_values(["chapter_index", "dialogue_index", "line_index"], inplace=True)
+    logging.info("Concatenated all files into one.")
 
-full_df = pd.concat(dfs)
-full_df.sort_values(["chapter_index", "dialogue_index", "line_index"], inplace=True)
-logging.info("Concatenated all files into one.")
+    logging.info("Adding 'Act Number' column")
+    full_df.insert(0, "Act Number", query.chapter_act(full_df["chapter_index"]))
 
-logging.info("Adding 'Act Number' column")
-def determine_act(chapter_index):
-    if 0 <= chapter_index <= 8:
-        return 1
-    elif 9 <= chapter_index <= 16:
-        return 2
-    else:
-        return 3
+    logging.info("Summary:\n")
+    buffer = io.StringIO()
+    full_df.info(buf=buffer)
+    logging.info(buffer.getvalue())
+    return full_df
 
-full_df.insert(0, "Act Number", full_df["chapter_index"].apply(determine_act))
 
-logging.info("Summary:\n")
-buffer = io.StringIO()
-full_df.info(buf=buffer)
-info_str = buffer.getvalue()
-logging.info(info_str)
+def write_store(full_df: pd.DataFrame) -> result_store.ResultStore:
+    version = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    return result_store.ResultStore(result_store.write(full_df, version))
 
-out_path = emotions_scored_dir.parent/f"result/{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.csv"
-full_df.to_csv(out_path.as_posix(), **helpers.CSV_SETTINGS, index_label="row_index")
-logging.info(f"File exported at {out_path.as_posix()}")
+
+def publish(store: result_store.ResultStore) -> pathlib.Path:
+    """Exports the result csv of a store version"""
+    out_path = emotions_scored_dir().parent/f"result/{store.version}.csv"
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    store.to_csv(out_path)
+    logging.info(f"File exported at {out_path.as_posix()}")
+    return out_path
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger(__name__)
+
+    logging.info("Beginning selection of latest classification file for each chapter")
+    logging.info("---")
+    store = write_store(merge(latest_runs()))
+
+    # The csv is exported from the store
+    publish(store)
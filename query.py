@@ -0,0 +1,288 @@
+import argparse
+import logging
+import pathlib
+import textwrap
+import numpy as np
+import pandas as pd
+from typing import Union
+# custom scripts
+import helpers
+import comparison
+import transcript
+
+
+RESULT_PATH = helpers.BASE_PATH/"output/result"
+INDEX_PATH = helpers.BASE_PATH/"output/index"
+# First chapter index of acts 2 and 3
+ACT_STARTS = [9, 17]
+# Columns added by prep_for_dashboard that are not emotions
+RESULT_COLUMNS = ["row_index", "Act Number", "act"]
+GROUP_KEYS = {
+    "act": ["act"],
+    "chapter": ["chapter_index", "chapter"],
+    "dialogue": ["chapter_index", "chapter", "dialogue_index"],
+}
+
+
+def chapter_act(chapter_index) -> np.ndarray:
+    """Act number (1, 2 or 3) of each chapter index"""
+    return np.searchsorted(ACT_STARTS, np.asarray(chapter_index), side="right") + 1
+
+
+def latest_result() -> pathlib.Path:
+    """Most recent file written by prep_for_dashboard.py"""
+    results = sorted(RESULT_PATH.glob("*.csv"))
+    if not results:
+        raise FileNotFoundError(f"No result file in {RESULT_PATH.as_posix()}. Run prep_for_dashboard.py first.")
+    return results[-1]
+
+
+class EmotionIndex(object):
+    """
+    Index of the classified lines by speaker, chapter, act and dialogue.
+
+    Lines are kept in story order with their scores in a float32 matrix. Chapters and acts are
+    contiguous ranges of that order, and every speaker has its own precomputed list of positions,
+    so filtered queries only touch the matching rows.
+
+    The index is built from a result file of prep_for_dashboard.py and persisted in `output/index`.
+    `EmotionIndex.open()` reuses it as long as the result file did not change.
+    """
+    def __init__(self, frame: pd.DataFrame, emotions: list[str], source: pathlib.Path=None, source_mtime_ns: int=None):
+        self.frame = frame.sort_values(["chapter_index", "dialogue_index", "line_index"], kind="stable").reset_index(drop=True)
+        self.emotions = emotions
+        self.source = source
+        self.source_mtime_ns = source_mtime_ns
+
+        self.scores: np.ndarray = self.frame[emotions].to_numpy(dtype=np.float32, na_value=np.nan)
+        self.chapter_index: np.ndarray = self.frame["chapter_index"].to_numpy(dtype=np.int32)
+        self.dialogue_index: np.ndarray = self.frame["dialogue_index"].to_numpy(dtype=np.int32)
+        self.act: np.ndarray = self.frame["act"].to_numpy(dtype=np.int8)
+        self.chapters: dict[str, int] = dict(zip(self.frame["chapter"].astype(str), self.chapter_index))
+
+        # Stable sort on the speaker codes: each speaker is a contiguous run, still in story order
+        codes = self.frame["speaker"].cat.codes.to_numpy()
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(self.frame["speaker"].cat.categories) + 1))
+        self.speaker_rows: dict[str, np.ndarray] = {
+            speaker: order[bounds[i]:bounds[i + 1]] for i, speaker in enumerate(self.frame["speaker"].cat.categories)
+        }
+
+    @classmethod
+    def build(cls, source: pathlib.Path=None) -> "EmotionIndex":
+        source = source if source is not None else latest_result()
+        logging.info(f"Building emotion index from {source.as_posix()}")
+        from result_store import STORE_PATH, ResultStore
+        if (STORE_PATH/source.stem/"manifest.json").exists():
+            # Same rows, without parsing the csv
+            df = ResultStore(STORE_PATH/source.stem).frame()
+        else:
+            df = transcript.read_transcript(source)
+
+        if "Act Number" in df.columns:
+            df["act"] = df["Act Number"].astype(np.int8)
+        else:
+            df["act"] = chapter_act(df["chapter_index"]).astype(np.int8)
+        if not isinstance(df["speaker"].dtype, pd.CategoricalDtype):
+            df["speaker"] = df["speaker"].astype("category")
+
+        emotions = [e for e in comparison.emotion_columns(df) if e not in RESULT_COLUMNS]
+        frame = df[transcript.TRANSCRIPT_COLUMNS + ["act"] + emotions]
+        return cls(frame, emotions, source=source, source_mtime_ns=source.stat().st_mtime_ns)
+
+    @staticmethod
+    def index_path(source: pathlib.Path) -> pathlib.Path:
+        return INDEX_PATH/f"{source.stem}.pkl"
+
+    def save(self, path: pathlib.Path=None) -> pathlib.Path:
+        path = path if path is not None else self.index_path(self.source)
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        pd.to_pickle({
+            "frame": self.frame,
+            "emotions": self.emotions,
+            "source": self.source.as_posix(),
+            "source_mtime_ns": self.source_mtime_ns
+        }, path)
+        logging.info(f"Written emotion index at {path.as_posix()}")
+        return path
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "EmotionIndex":
+        saved = pd.read_pickle(path)
+        return cls(saved["frame"], saved["emotions"], pathlib.Path(saved["source"]), saved["source_mtime_ns"])
+
+    @classmethod
+    def open(cls, source: pathlib.Path=None) -> "EmotionIndex":
+        """Loads the persisted index of `source` (default: latest result), rebuilding it if it is stale"""
+        source = source if source is not None else latest_result()
+        path = cls.index_path(source)
+        if path.exists():
+            index = cls.load(path)
+            if index.source_mtime_ns == source.stat().st_mtime_ns:
+                return index
+            logging.info(f"{source.name} was modified since the index was built")
+
+        index = cls.build(source)
+        index.save(path)
+        return index
+
+    def rows(self, speaker: str=None, chapter: Union[str, int]=None, act: int=None, dialogue: int=None) -> np.ndarray:
+        """Positions (in story order) of the lines matching every given filter"""
+        chapter_ix = self.chapters[chapter] if isinstance(chapter, str) else chapter
+        if speaker is not None:
+            if speaker not in self.speaker_rows:
+                raise KeyError(f"Unknown speaker '{speaker}'")
+            rows = self.speaker_rows[speaker]
+            if chapter_ix is not None:
+                rows = rows[self.chapter_index[rows] == chapter_ix]
+            if act is not None:
+                rows = rows[self.act[rows] == act]
+        else:
+            # Lines are sorted by chapter, hence by act: both are a single range of positions
+            lo, hi = 0, len(self.frame)
+            if chapter_ix is not None:
+                lo, hi = np.searchsorted(self.chapter_index, [chapter_ix, chapter_ix + 1])
+            if act is not None:
+                act_lo, act_hi = np.searchsorted(self.act, [act, act + 1])
+                lo = max(lo, act_lo)
+                hi = max(lo, min(hi, act_hi))
+            rows = np.arange(lo, hi)
+
+        if dialogue is not None:
+            rows = rows[self.dialogue_index[rows] == dialogue]
+        return rows
+
+    def select(self, **filters) -> pd.DataFrame:
+        return self.frame.iloc[self.rows(**filters)]
+
+    def speakers(self) -> pd.DataFrame:
+        """Speakers and their number of lines, most lines first"""
+        counts = pd.DataFrame({
+            "speaker": list(self.speaker_rows.keys()),
+            "lines": [len(r) for r in self.speaker_rows.values()]
+        })
+        counts = counts[counts["lines"] > 0]
+        return counts.sort_values("lines", ascending=False, kind="stable").reset_index(drop=True)
+
+    def _emotion_ix(self, emotions: list[str]) -> list[int]:
+        unknown = [e for e in emotions if e not in self.emotions]
+        if unknown:
+            raise KeyError(f"Unknown emotions {unknown}. Available: {self.emotions}")
+        return [self.emotions.index(e) for e in emotions]
+
+    def arc(self, speaker: str=None, emotions: list[str]=None, by: str="chapter", **filters) -> pd.DataFrame:
+        """
+        Mean scores per act, chapter or dialogue, in story order: the emotional arc of `speaker`
+        (or of every speaker matching the filters).
+        """
+        emotions = emotions if emotions else self.emotions
+        rows = self.rows(speaker=speaker, **filters)
+        keys = self.frame[GROUP_KEYS[by]].iloc[rows].reset_index(drop=True)
+        scores = pd.DataFrame(self.scores[np.ix_(rows, self._emotion_ix(emotions))], columns=emotions)
+
+        grouped = pd.concat([keys, scores], axis=1).groupby(GROUP_KEYS[by], observed=True, sort=True)
+        out = grouped[emotions].mean()
+        out.insert(0, "lines", grouped.size())
+        return out.reset_index()
+
+    def rolling(self, emotion: str, window: int=20, speaker: str=None, **filters) -> pd.DataFrame:
+        """Rolling mean of `emotion` over the last `window` lines in story order"""
+        rows = self.rows(speaker=speaker, **filters)
+        values = np.nan_to_num(self.scores[rows, self._emotion_ix([emotion])[0]].astype(np.float64))
+
+        # Rolling sum from the cumulative sum: windows are shorter at the beginning
+        cumsum = np.concatenate([[0.0], np.cumsum(values)])
+        ends = np.arange(1, len(values) + 1)
+        starts = np.maximum(ends - window, 0)
+        out = self.frame.iloc[rows][["act", "chapter_index", "chapter", "dialogue_index", "line_index", "speaker"]].copy()
+        out[emotion] = values
+        out[f"{emotion}_rolling"] = (cumsum[ends] - cumsum[starts]) / (ends - starts)
+        return out.reset_index(drop=True)
+
+    def top(self, emotion: str, k: int=10, **filters) -> pd.DataFrame:
+        """The `k` lines with the highest `emotion` score, highest first"""
+        rows = self.rows(**filters)
+        values = np.nan_to_num(self.scores[rows, self._emotion_ix([emotion])[0]], nan=-np.inf)
+        k = min(k, len(rows))
+        if k == 0:
+            return self.frame.iloc[[]]
+
+        best = np.argpartition(-values, k - 1)[:k]
+        best = best[np.argsort(-values[best], kind="stable")]
+        return self.frame.iloc[rows[best]].reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    pd.set_option("display.width", 200)
+    pd.set_option("display.max_colwidth", 80)
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(
+            """
+            Query the classified emotions by speaker, chapter, act and dialogue.
+            The index is built from the latest file in 'output/result' (see prep_for_dashboard.py)
+            and rebuilt automatically when that file changes.
+
+            Examples:
+                python query.py speakers
+                python query.py arc Verso --emotions fear --by chapter --act 2
+                python query.py rolling Verso fear --window 30
+                python query.py top sadness -k 5 --speaker Maelle
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--source", type=pathlib.Path, help="Result file to index (default: the latest one)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_filters(p: argparse.ArgumentParser, speaker: bool=True):
+        if speaker:
+            p.add_argument("--speaker", help="Only lines of this speaker")
+        p.add_argument("--chapter", help="Only lines of this chapter (name or index)")
+        p.add_argument("--act", type=int, choices=[1, 2, 3], help="Only lines of this act")
+
+    subparsers.add_parser("build", help="Rebuild the index")
+    subparsers.add_parser("speakers", help="List the speakers by number of lines")
+
+    arc_parser = subparsers.add_parser("arc", help="Mean scores of a speaker per act, chapter or dialogue")
+    arc_parser.add_argument("speaker")
+    arc_parser.add_argument("--emotions", nargs="+", help="Emotions to show (default: all)")
+    arc_parser.add_argument("--by", choices=list(GROUP_KEYS), default="chapter")
+    add_filters(arc_parser, speaker=False)
+
+    rolling_parser = subparsers.add_parser("rolling", help="Rolling mean of an emotion over the lines of a speaker")
+    rolling_parser.add_argument("speaker")
+    rolling_parser.add_argument("emotion")
+    rolling_parser.add_argument("--window", type=int, default=20, help="Number of lines in the window")
+    add_filters(rolling_parser, speaker=False)
+
+    top_parser = subparsers.add_parser("top", help="Most intense lines for an emotion")
+    top_parser.add_argument("emotion")
+    top_parser.add_argument("-k", type=int, default=10, help="Number of lines")
+    add_filters(top_parser)
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        EmotionIndex.build(args.source).save()
+        raise SystemExit(0)
+
+    index = EmotionIndex.open(args.source)
+    filters = {}
+    if getattr(args, "chapter", None) is not None:
+        filters["chapter"] = int(args.chapter) if args.chapter.isdigit() else args.chapter
+    if getattr(args, "act", None) is not None:
+        filters["act"] = args.act
+
+    if args.command == "speakers":
+        out = index.speakers()
+    elif args.command == "arc":
+        out = index.arc(args.speaker, emotions=args.emotions, by=args.by, **filters)
+    elif args.command == "rolling":
+        out = index.rolling(args.emotion, window=args.window, speaker=args.speaker, **filters)
+    else:
+        out = index.top(args.emotion, k=args.k, speaker=args.speaker, **filters)
+
+    print(out.to_string(index=False))
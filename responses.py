@@ -0,0 +1,130 @@
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+
+# Per-line validation flags, stored as bits
+FLAGS = [
+    "missing",          # the line is not in the response
+    "malformed",        # the line is not an {emotion: score} object
+    "unknown_emotion",  # scores of emotions outside of the taxonomy (dropped)
+    "not_numeric",      # scores that are not numbers (set to 0)
+    "out_of_range",     # scores outside of [0, 1] (clipped)
+    "sum",              # scores not adding up to 1 (renormalised)
+    "mixed_polarity",   # positive and negative emotions in the same line (kept)
+    "empty",            # every score is 0
+    "reused",           # the line was not in the response, its scores come from a duplicate (see dedup.py)
+]
+FLAG_BITS = {f: np.uint16(1 << i) for i, f in enumerate(FLAGS)}
+# Allowed difference between the sum of the scores and 1
+SUM_TOLERANCE = 0.011
+
+
+def response_format(ids: list[str], emotions: list[str]) -> dict:
+    """
+    Strict JSON schema of the expected response: one object per line id, with a number for each emotion.
+    https://platform.openai.com/docs/guides/structured-outputs
+    """
+    scores = {
+        "type": "object",
+        "properties": {e: {"type": "number"} for e in emotions},
+        "required": list(emotions),
+        "additionalProperties": False
+    }
+    schema = {
+        "type": "object",
+        "properties": {i: {"$ref": "#/$defs/scores"} for i in ids},
+        "required": list(ids),
+        "additionalProperties": False,
+        "$defs": {"scores": scores}
+    }
+    return {"type": "json_schema", "json_schema": {"name": "emotion_scores", "strict": True, "schema": schema}}
+
+
+def parse_content(res_dict: dict) -> dict:
+    """Decodes the message of a chat completion. Raises ValueError when it is not a JSON object."""
+    content = res_dict["choices"][0]["message"]["content"]
+    try:
+        out = _loads(content)
+    except ValueError as e:
+        raise ValueError(f"Model response is not valid JSON: {e}") from None
+    if not isinstance(out, dict):
+        raise ValueError(f"Model response is a JSON {type(out).__name__}, expected an object")
+    return out
+
+
+def validate_scores(content: dict, ids: list[str], emotions: list[str], positive: list[str], negative: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Checks the scores of `content` (`{id: {emotion: score}}`) against the lines `ids` and the `emotions`
+    taxonomy, and fixes what can be fixed: scores are clipped to [0, 1] and lines that don't add up
+    to 1 are renormalised. Missing lines are NaN.
+
+    Returns the `(lines, emotions)` scores and the `uint16` flags of each line (see FLAGS).
+    """
+    n = len(ids)
+    flags = np.zeros(n, dtype=np.uint16)
+
+    unexpected = len(set(content) - set(ids))
+    if unexpected:
+        logging.warning(f"Model response has {unexpected} ids that are not in the transcript. Ignored.")
+
+    rows = [content.get(i) for i in ids]
+    is_missing = np.array([r is None for r in rows], dtype=bool)
+    is_malformed = np.array([r is not None and not isinstance(r, dict) for r in rows], dtype=bool)
+    flags[is_missing] |= FLAG_BITS["missing"]
+    flags[is_malformed] |= FLAG_BITS["malformed"]
+
+    emotion_set = set(emotions)
+    has_unknown = np.array([isinstance(r, dict) and not emotion_set.issuperset(r) for r in rows], dtype=bool)
+    flags[has_unknown] |= FLAG_BITS["unknown_emotion"]
+
+    empty = [None] * len(emotions)
+    raw = np.array([[r.get(e) for e in emotions] if isinstance(r, dict) else empty for r in rows], dtype=object).reshape(n, len(emotions))
+    given = np.not_equal(raw, None)
+    try:
+        scores = np.where(given, raw, np.nan).astype(np.float64)
+    except (TypeError, ValueError):
+        # Some scores are not numbers
+        scores = pd.to_numeric(pd.Series(raw.ravel()), errors="coerce").to_numpy(dtype=np.float64).reshape(raw.shape)
+    valid = ~(is_missing | is_malformed)
+    flags[((given & np.isnan(scores)).any(axis=1))] |= FLAG_BITS["not_numeric"]
+    # Emotions not scored count as 0, as required by the prompt
+    scores = np.where(np.isnan(scores), 0.0, scores)
+
+    flags[((scores < 0) | (scores > 1)).any(axis=1)] |= FLAG_BITS["out_of_range"]
+    scores = np.clip(scores, 0.0, 1.0)
+
+    totals = scores.sum(axis=1)
+    off = valid & (np.abs(totals - 1) > SUM_TOLERANCE) & (totals > 0)
+    flags[off] |= FLAG_BITS["sum"]
+    scores[off] = np.round(scores[off] / totals[off, None], 4)
+    flags[valid & (totals == 0)] |= FLAG_BITS["empty"]
+
+    pos = [emotions.index(e) for e in positive if e in emotions]
+    neg = [emotions.index(e) for e in negative if e in emotions]
+    mixed = (scores[:, pos] > 0).any(axis=1) & (scores[:, neg] > 0).any(axis=1)
+    flags[valid & mixed] |= FLAG_BITS["mixed_polarity"]
+
+    scores[~valid] = np.nan
+    return scores, flags
+
+
+def flag_names(flags: np.ndarray) -> np.ndarray:
+    """`|` separated names of the flags of each line, empty string when the line is valid"""
+    names = np.full(len(flags), "", dtype=object)
+    for f, bit in FLAG_BITS.items():
+        has = (flags & bit) != 0
+        names[has] = np.where(names[has] == "", f, names[has] + "|" + f)
+    return names
+
+
+def summarise(flags: np.ndarray) -> dict[str, int]:
+    """Number of lines with each flag"""
+    return {f: int(((flags & bit) != 0).sum()) for f, bit in FLAG_BITS.items() if ((flags & bit) != 0).any()}
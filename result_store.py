@@ -0,0 +1,299 @@
+import argparse
+import datetime
+import json
+import logging
+import pathlib
+import shutil
+import textwrap
+import numpy as np
+import pandas as pd
+# custom scripts
+import helpers
+import comparison
+import query
+import transcript
+
+
+STORE_PATH = helpers.BASE_PATH/"output/store"
+KAGGLE_PATH = helpers.BASE_PATH/"output/kaggle"
+KAGGLE_DATASET = "davidemarcantoni/clair-obscur-expedition-33-dialogues-emotions"
+FORMAT_VERSION = 1
+# Fixed-width columns, one .npy file each
+INT_COLUMNS = {
+    "row_index": np.int32,
+    "act": np.int8,
+    "chapter_index": np.int32,
+    "dialogue_index": np.int32,
+    "line_index": np.int32,
+    "speaker": np.int32,
+    "flags": np.int16
+}
+
+
+def _string_table(values: list[str]) -> tuple[bytes, np.ndarray]:
+    """UTF-8 blob of the strings and the `(n + 1)` offsets of each string in it"""
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return b"".join(encoded), offsets
+
+
+def write(df: pd.DataFrame, version: str, path: pathlib.Path=None) -> pathlib.Path:
+    """
+    Writes a result DataFrame (as built by prep_for_dashboard.py) as version `version` of the store.
+    Rows are stored by chapter, dialogue and line: each chapter is a contiguous partition of every column.
+    """
+    path = path if path is not None else STORE_PATH/version
+    tmp_path = path.with_name(path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+
+    df = df.sort_values(["chapter_index", "dialogue_index", "line_index"], kind="stable")
+    emotions = [e for e in comparison.emotion_columns(df) if e not in query.RESULT_COLUMNS]
+    speakers = pd.Categorical(df["speaker"].astype(str))
+    flags = pd.Categorical(df[comparison.FLAGS_COLUMN].fillna("")) if comparison.FLAGS_COLUMN in df.columns else None
+
+    columns = {
+        "row_index": df.index.to_numpy(),
+        "act": df["Act Number"].to_numpy() if "Act Number" in df.columns else query.chapter_act(df["chapter_index"]),
+        "chapter_index": df["chapter_index"].to_numpy(),
+        "dialogue_index": df["dialogue_index"].to_numpy(),
+        "line_index": df["line_index"].to_numpy(),
+        "speaker": speakers.codes,
+    }
+    if flags is not None:
+        columns["flags"] = flags.codes
+    for c, values in columns.items():
+        np.save(tmp_path/f"{c}.npy", np.ascontiguousarray(values, dtype=INT_COLUMNS[c]))
+    # float64: exports are identical to the source values
+    np.save(tmp_path/"scores.npy", df[emotions].to_numpy(dtype=np.float64, na_value=np.nan))
+
+    blob, offsets = _string_table(df["line"].astype(str).to_list())
+    (tmp_path/"lines.bin").write_bytes(blob)
+    np.save(tmp_path/"line_offsets.npy", offsets)
+
+    # Rows of every speaker, in story order
+    order = np.argsort(speakers.codes, kind="stable").astype(np.int32)
+    np.save(tmp_path/"speaker_rows.npy", order)
+    speaker_bounds = np.searchsorted(speakers.codes[order], np.arange(len(speakers.categories) + 1))
+
+    chapter_index = columns["chapter_index"]
+    starts = np.flatnonzero(np.r_[True, np.diff(chapter_index) != 0]) if len(df) else np.array([], dtype=int)
+    stops = np.r_[starts[1:], len(df)]
+    chapter_names = df["chapter"].astype(str).to_numpy()
+    manifest = {
+        "format": FORMAT_VERSION,
+        "version": version,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "rows": len(df),
+        "emotions": emotions,
+        "speakers": [
+            {"name": s, "start": int(speaker_bounds[i]), "stop": int(speaker_bounds[i + 1])} for i, s in enumerate(speakers.categories)
+        ],
+        "flags": list(flags.categories) if flags is not None else None,
+        "chapters": [
+            {"name": chapter_names[s], "chapter_index": int(chapter_index[s]), "start": int(s), "stop": int(e)} for s, e in zip(starts, stops)
+        ]
+    }
+    with open(tmp_path/"manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    if path.exists():
+        shutil.rmtree(path)
+    tmp_path.replace(path)
+    logging.info(f"Written result store version '{version}' at {path.as_posix()}")
+    return path
+
+
+def versions() -> list[str]:
+    """Versions of the store, oldest first"""
+    if not STORE_PATH.exists():
+        return []
+    return sorted(p.name for p in STORE_PATH.iterdir() if (p/"manifest.json").exists())
+
+
+class ResultStore(object):
+    """
+    Read-only view of a version of the result store. Columns are memory-mapped: opening the store
+    only parses its manifest, and reading a chapter or a speaker only touches their rows.
+
+    ```
+    store = ResultStore.open()
+    store.frame(chapter="The Gommage")
+    store.frame(speaker="Verso", columns=["chapter", "line", "sadness"])
+    ```
+    """
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.manifest = json.load(open(path/"manifest.json", "r"))
+        if self.manifest["format"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported result store format {self.manifest['format']} in {path.as_posix()}")
+
+        self.version: str = self.manifest["version"]
+        self.emotions: list[str] = self.manifest["emotions"]
+        self._chapters = {c["name"]: c for c in self.manifest["chapters"]}
+        self._speakers = {s["name"]: s for s in self.manifest["speakers"]}
+        self._arrays: dict[str, np.ndarray] = {}
+
+    @classmethod
+    def open(cls, version: str=None) -> "ResultStore":
+        """Opens a version of the store, the latest by default"""
+        if version is None:
+            available = versions()
+            if not available:
+                raise FileNotFoundError(f"No result store in {STORE_PATH.as_posix()}. Run prep_for_dashboard.py first.")
+            version = available[-1]
+        return cls(STORE_PATH/version)
+
+    def __len__(self):
+        return self.manifest["rows"]
+
+    def __repr__(self):
+        return f"ResultStore(version='{self.version}', rows={len(self)}, chapters={len(self._chapters)})"
+
+    def _array(self, name: str) -> np.ndarray:
+        if name not in self._arrays:
+            if name == "lines":
+                self._arrays[name] = np.memmap(self.path/"lines.bin", dtype=np.uint8, mode="r") if len(self) else np.zeros(0, dtype=np.uint8)
+            else:
+                self._arrays[name] = np.load(self.path/f"{name}.npy", mmap_mode="r")
+        return self._arrays[name]
+
+    def chapters(self) -> list[str]:
+        return list(self._chapters)
+
+    def speakers(self) -> list[str]:
+        return list(self._speakers)
+
+    def rows(self, chapter: str=None, speaker: str=None) -> np.ndarray:
+        """Positions of the rows of a chapter and/or a speaker, in story order"""
+        if chapter is not None and chapter not in self._chapters:
+            raise KeyError(f"Unknown chapter '{chapter}'")
+        if speaker is not None and speaker not in self._speakers:
+            raise KeyError(f"Unknown speaker '{speaker}'")
+
+        if speaker is None:
+            c = self._chapters[chapter] if chapter is not None else {"start": 0, "stop": len(self)}
+            return np.arange(c["start"], c["stop"])
+
+        s = self._speakers[speaker]
+        rows = np.asarray(self._array("speaker_rows")[s["start"]:s["stop"]])
+        if chapter is not None:
+            c = self._chapters[chapter]
+            rows = rows[(rows >= c["start"]) & (rows < c["stop"])]
+        return rows
+
+    def lines(self, rows: np.ndarray) -> list[str]:
+        offsets = self._array("line_offsets")
+        blob = self._array("lines")
+        return [bytes(blob[offsets[r]:offsets[r + 1]]).decode("utf-8") for r in rows]
+
+    def frame(self, chapter: str=None, speaker: str=None, columns: list[str]=None) -> pd.DataFrame:
+        """
+        Rows of a chapter and/or a speaker (the whole store by default) with the columns of the result file.
+        `columns` limits the columns to read: lines are only decoded when requested.
+        """
+        rows = self.rows(chapter, speaker)
+        # Slices of a contiguous range don't copy the memory-mapped data
+        ix = slice(rows[0], rows[-1] + 1) if len(rows) and speaker is None else rows
+        all_columns = ["Act Number"] + transcript.TRANSCRIPT_COLUMNS + self.emotions + ([comparison.FLAGS_COLUMN] if self.manifest["flags"] is not None else [])
+        columns = columns if columns is not None else all_columns
+
+        out = {}
+        for c in columns:
+            if c == "Act Number":
+                out[c] = self._array("act")[ix]
+            elif c == "chapter":
+                names = [ch["name"] for ch in self.manifest["chapters"]]
+                starts = np.array([ch["start"] for ch in self.manifest["chapters"]])
+                codes = np.searchsorted(starts, rows, side="right") - 1
+                out[c] = pd.Categorical.from_codes(codes, categories=names)
+            elif c == "speaker":
+                out[c] = pd.Categorical.from_codes(self._array("speaker")[ix], categories=self.speakers())
+            elif c == "line":
+                out[c] = pd.array(self.lines(rows), dtype=transcript.LINE_DTYPE)
+            elif c == comparison.FLAGS_COLUMN:
+                out[c] = pd.Categorical.from_codes(self._array("flags")[ix], categories=self.manifest["flags"])
+            elif c in self.emotions:
+                out[c] = self._array("scores")[ix, self.emotions.index(c)]
+            elif c in INT_COLUMNS:
+                out[c] = self._array(c)[ix]
+            else:
+                raise KeyError(f"Unknown column '{c}'")
+
+        return pd.DataFrame(out, index=pd.Index(self._array("row_index")[ix], name="row_index"))
+
+    def to_csv(self, path: pathlib.Path) -> pathlib.Path:
+        """Exports the whole store in the format of the result csv files"""
+        df = self.frame()
+        df.to_csv(path.as_posix(), **helpers.CSV_SETTINGS, index_label="row_index")
+        logging.info(f"Exported result store version '{self.version}' at {path.as_posix()}")
+        return path
+
+    def to_kaggle(self, path: pathlib.Path=KAGGLE_PATH) -> pathlib.Path:
+        """Kaggle dataset folder: the csv export and the `dataset-metadata.json` read by `kaggle datasets version`"""
+        if not path.exists():
+            path.mkdir(parents=True)
+        for old in path.glob("*.csv"):
+            old.unlink()
+        self.to_csv(path/"clair_obscur_dialogues_emotions.csv")
+        with open(path/"dataset-metadata.json", "w") as f:
+            json.dump({"id": KAGGLE_DATASET, "title": "Clair Obscur: Expedition 33 - Dialogues Emotions"}, f, indent=2)
+        return path
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(
+            """
+            Versioned, memory-mapped store of the published dataset, written by prep_for_dashboard.py
+            in 'output/store'. The csv files of 'output/result' and the Kaggle dataset are exported from it.
+
+            Examples:
+                python result_store.py info
+                python result_store.py show --speaker Verso --chapter "The Monolith"
+                python result_store.py import output/result/2025-11-16_14-04-41.csv
+                python result_store.py export --kaggle
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--version", help="Store version (default: latest)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("info", help="Versions, chapters and speakers")
+    show_parser = subparsers.add_parser("show", help="Print the rows of a chapter and/or a speaker")
+    show_parser.add_argument("--chapter")
+    show_parser.add_argument("--speaker")
+    import_parser = subparsers.add_parser("import", help="Build a store version from an existing result csv")
+    import_parser.add_argument("csv", type=pathlib.Path)
+    export_parser = subparsers.add_parser("export", help="Export a store version")
+    export_parser.add_argument("--csv", type=pathlib.Path, help="Csv file to write (default: output/result/{version}.csv)")
+    export_parser.add_argument("--kaggle", action="store_true", help="Write the Kaggle dataset folder 'output/kaggle' instead")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        df = transcript.read_transcript(args.csv, index_col="row_index")
+        write(df, args.csv.stem)
+
+    elif args.command == "info":
+        store = ResultStore.open(args.version)
+        print(f"Versions: {versions()}")
+        print(store)
+        print(f"Emotions: {store.emotions}")
+        print(f"Chapters: {store.chapters()}")
+        print(f"Speakers: {store.speakers()}")
+
+    elif args.command == "show":
+        store = ResultStore.open(args.version)
+        with pd.option_context("display.max_rows", None, "display.width", 200, "display.max_colwidth", 60):
+            print(store.frame(chapter=args.chapter, speaker=args.speaker))
+
+    elif args.command == "export":
+        store = ResultStore.open(args.version)
+        if args.kaggle:
+            store.to_kaggle()
+        else:
+            store.to_csv(args.csv if args.csv else query.RESULT_PATH/f"{store.version}.csv")
@@ -1,42 +1,237 @@
-import requests
+from __future__ import annotations
 import pathlib
 import unicodedata
+import hashlib
 import re
 import datetime
 import logging
-import csv
-import bs4
+import threading
+from typing import Callable, Optional, TYPE_CHECKING
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
 # custom scripts
 import helpers
+import instrumentation
+
+if TYPE_CHECKING:
+    import bs4
+    import pandas as pd
+    import requests
+
+# requests, bs4 and pandas (through transcript) are imported when a page is fetched or parsed:
+# the adapter registry is read without them (e.g. by 'main.py run --dry-run')
+
+
+ADAPTERS: dict[str, type["SiteAdapter"]] = {}
+
+
+def register_adapter(cls: type["SiteAdapter"]) -> type["SiteAdapter"]:
+    """Class decorator: makes a SiteAdapter available by its `name`"""
+    if cls.name in ADAPTERS:
+        raise ValueError(f"Site adapter '{cls.name}' is already registered")
+    ADAPTERS[cls.name] = cls
+    return cls
+
+
+class SiteAdapter(object):
+    """
+    Layout of a transcript website: where the dialogues are, how to find the next chapter
+    and who is speaking.
+
+    Subclasses set the selectors (CSS) and override the hooks that don't fit their layout,
+    then register with `@register_adapter`.
+    """
+    name: str = None
+    start_url: str = None
+    # Prefixed to the raw csv file names, to keep sources apart in '1_raw'
+    output_prefix: str = ""
+
+    container_selector: str = "body"
+    paragraph_selector: str = "p"
+    title_selector: str = "h1"
+    next_link_text: str = "next chapter"
+
+    def main_container(self, soup: bs4.BeautifulSoup) -> bs4.element.Tag:
+        return soup.select_one(self.container_selector)
+
+    def paragraphs(self, container: bs4.element.Tag) -> list[bs4.element.Tag]:
+        return container.select(self.paragraph_selector)
+
+    def title(self, soup: bs4.BeautifulSoup) -> str:
+        return soup.select_one(self.title_selector).text.strip()
+
+    def next_page_link(self, container: bs4.element.Tag, url: str) -> Optional[str]:
+        for link in container.find_all("a"):
+            if self.next_link_text in link.text.strip().lower() and link.has_attr("href"):
+                return urljoin(url, link["href"]) if url else link["href"]
+        return None
+
+    def paragraph_speaker(self, p: bs4.element.Tag, last_speaker: str) -> str:
+        """Speaker of a whole paragraph, e.g. a narrator box. Defaults to the last speaker."""
+        return last_speaker
+
+    def new_speaker(self, child: bs4.element.PageElement) -> Optional[str]:
+        """Returns the speaker name if `child` introduces a new speaker"""
+        if child.name == "strong":
+            return child.text.strip().replace(":", "")
+        return None
+
+    def line_speaker(self, child: bs4.element.PageElement, child_ix: int, last_speaker: str) -> Optional[str]:
+        """Returns the speaker of `child` if it is a dialogue line, None if it is not a line"""
+        if child.name is None:
+            return last_speaker
+        return None
+
+    def parse_dialogues(self, paragraphs: list[bs4.element.Tag]) -> list:
+        """Returns one list of `[dialogue_index, line_index, speaker, line]` rows per paragraph"""
+        dialogues = []
+        last_speaker = None
+        for i, p in enumerate(paragraphs):
+            last_speaker = self.paragraph_speaker(p, last_speaker)
+
+            lines = []
+            index = 0
+            for child_ix, child in enumerate(list(p.children)):
+                speaker = self.new_speaker(child)
+                if speaker is not None:
+                    last_speaker = speaker
+                    continue
+
+                speaker = self.line_speaker(child, child_ix, last_speaker)
+                if speaker is None:
+                    # Line breaks or other tags
+                    continue
+
+                line: str = child.text.strip()
+                if line:
+                    lines.append([i, index, speaker, line])
+                    index += 1
+
+            dialogues.append(lines)
+
+        return dialogues
+
+
+@register_adapter
+class DawnbornAdapter(SiteAdapter):
+    name = "dawnborn"
+    start_url = (
+        "https://www.dawnborn.com/game-transcripts/"
+        "clair-obscur-expedition-33-game-transcript-all-dialogues/"
+        "clair-obscur-expedition-33-the-gommage-dawnborn/"
+    )
+    container_classes = [
+        "wp-block-group__inner-container",
+        "is-layout-constrained",
+        "wp-container-core-group-is-layout-5ca99053",
+        "wp-block-group-is-layout-constrained"
+    ]
+
+    def main_container(self, soup: bs4.BeautifulSoup) -> bs4.element.Tag:
+        return soup.find(class_=" ".join(self.container_classes))
+
+    def paragraphs(self, container: bs4.element.Tag) -> list[bs4.element.Tag]:
+        # Paragraphs with lines don't have a class attribute
+        return [p for p in container.find_all("p") if not p.has_attr("class")]
+
+    def title(self, soup: bs4.BeautifulSoup) -> str:
+        return soup.find("h1", class_="has-text-align-center").text.strip()
+
+    def next_page_link(self, container: bs4.element.Tag, url: str) -> Optional[str]:
+        links = container.find("p", class_="has-text-align-right").find_all("a")
+        for link in links:
+            if "next chapter" in link.text.strip().lower():
+                return link['href']
+        return None
+
+    def paragraph_speaker(self, p: bs4.element.Tag, last_speaker: str) -> str:
+        try:
+            parent_class = " ".join(p.parent.attrs["class"])
+            if "wp-block-group info-card" in parent_class:
+                # Dialogue from the narrator
+                return "narrator"
+        except KeyError:
+            pass
+        return last_speaker
+
+    def line_speaker(self, child: bs4.element.PageElement, child_ix: int, last_speaker: str) -> Optional[str]:
+        if child.name is None:
+            return last_speaker
+
+        if child.name == "em":
+            line: str = child.text.strip()
+            if child_ix != 0:
+                # Sometimes, in a line, italics can be used as reinforcement. In the website,
+                # italics is also used to highlight narrator speaking. We consider the narrator
+                # speaking only if the line in italics is the first (and only) line in the paragraph
+                return last_speaker
+            if not (line.startswith("(") and line.endswith(")")):
+                # Lines of the narrator are not enclosed between parenthesis. If they are, they
+                # are considered a "line of thought" of the character
+                return "narrator"
+            return last_speaker
+
+        return None
+
+
+class PageFetcher(object):
+    """
+    Fetches pages over a shared HTTP session and caches them on disk, by source and URL.
+    Safe to share between threads.
+    """
+    def __init__(self, cache_dir: pathlib.Path=None, use_cache: bool=True):
+        self.cache_dir = cache_dir if cache_dir is not None else helpers.BASE_PATH/"html_cache"
+        self.use_cache = use_cache
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        # requests.Session is not thread-safe: one per thread
+        if not hasattr(self._local, "session"):
+            import requests
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def fetch(self, url: str, source: str="default") -> str:
+        cache_path = self.cache_dir/source/f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.html"
+        if self.use_cache and cache_path.exists():
+            return cache_path.read_text(encoding="utf-8")
+
+        res = self._session().get(url)
+        res.raise_for_status()
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_path.write_text(res.text, encoding="utf-8")
+        return res.text
 
 
 class Scraper(object):
-    def __init__(self, parser: str):
+    def __init__(self, parser: str, adapter: SiteAdapter=None, fetcher: PageFetcher=None, on_chapter: Callable[[pathlib.Path], None]=None):
         self.parser = parser
+        self.adapter = adapter if adapter is not None else DawnbornAdapter()
+        self.fetcher = fetcher if fetcher is not None else PageFetcher()
+        # Called with the raw csv of each chapter as soon as it is written
+        self.on_chapter = on_chapter
         self.csv_settings = helpers.CSV_SETTINGS
 
         self._page_scraped_ix = 0
+        self._page_bytes = 0
+        self.__url: str = None
         self.__soup: bs4.BeautifulSoup = None
         self.__main_container: bs4.element.Tag = None
         self.__paragraphs: list[bs4.element.Tag] = None
 
     def load_page(self, url: str):
-        res = requests.get(url)
-        soup = bs4.BeautifulSoup(res.text, self.parser)
-
-        # Main container
-        classes = [
-            "wp-block-group__inner-container",
-            "is-layout-constrained",
-            "wp-container-core-group-is-layout-5ca99053",
-            "wp-block-group-is-layout-constrained"
-        ]
-        main_container: bs4.element.Tag = soup.find(class_=" ".join(classes))
-
-        paragraphs = main_container.find_all("p")
-        # Paragraphs with lines don't have a class attribute
-        paragraphs = [p for p in paragraphs if not p.has_attr("class")]
+        self.load_html(self.fetcher.fetch(url, source=self.adapter.name), url=url)
+
+    def load_html(self, html: str, url: str=None):
+        import bs4
+
+        self._page_bytes = len(html.encode("utf-8"))
+        soup = bs4.BeautifulSoup(html, self.parser)
+
+        main_container: bs4.element.Tag = self.adapter.main_container(soup)
+        paragraphs = self.adapter.paragraphs(main_container)
 
+        self.__url = url
         self.__soup = soup
         self.__main_container = main_container
         self.__paragraphs = paragraphs
@@ -45,98 +240,49 @@ class Scraper(object):
         if self.__soup is None or self.__main_container is None or self.__paragraphs is None:
             raise RuntimeError("No page loaded. Call load_page(url) first.")
 
-        title = self.get_title()
-        logging.info(f"Parsing chapter: '{title}'")
+        while True:
+            title = self.get_title()
+            logging.info(f"Parsing chapter: '{title}' ({self.adapter.name})")
 
-        dialogues = self.parse_dialogues(chapter=title)
-        self.write(dialogues, chapter=title)
-        self._page_scraped_ix += 1
+            with instrumentation.stage("scrape", chapter=title, source=self.adapter.name) as event:
+                event["bytes_read"] = self._page_bytes
+                df = self.parse_dialogues(chapter=title)
+                out_path = self.write(df, chapter=title)
+                event["rows_out"] = len(df)
+                event["bytes_written"] = instrumentation.file_size(out_path)
+            self._page_scraped_ix += 1
+            if self.on_chapter is not None:
+                self.on_chapter(out_path)
+
+            next_page = self.next_page_link()
+            if not next_page:
+                logging.error("No next chapter link found.")
+                break
 
-        next_page = self.next_page_link()
-        if next_page:
             logging.info(f"Next chapter link found: {next_page}")
             self.load_page(next_page)
-            self.main()
-        else:
-            logging.error("No next chapter link found.")
 
     def get_title(self) -> str:
-        return self.__soup.find("h1", class_="has-text-align-center").text.strip()
+        return self.adapter.title(self.__soup)
 
     def next_page_link(self) -> str:
-        links = self.__main_container.find("p", class_="has-text-align-right").find_all("a")
-        next_page_link = None
-
-        for link in links:
-            if "next chapter" in link.text.strip().lower():
-                next_page_link = link['href']
-                break
-
-        return next_page_link
-    
-    def parse_dialogues(self, chapter: str=None) -> list:
-        dialogues = []
-        last_speaker = None
-        for i, p in enumerate(self.__paragraphs):
-            try:
-                parent_class = " ".join(p.parent.attrs["class"])
-                if "wp-block-group info-card" in parent_class:
-                    # Dialogue from the narrator
-                    last_speaker = "narrator"
-            except KeyError:
-                pass
+        return self.adapter.next_page_link(self.__main_container, self.__url)
 
-            lines = []
-            index = 0
-            for child_ix, child in enumerate(list(p.children)):
-                if child.name == "strong":
-                    # New speaker
-                    last_speaker = child.text.strip().replace(":", "")
-                elif child.name is None or child.name == "em":
-                    # Dialogue line
-                    line:str = child.text.strip()
-
-                    if child.name == "em":
-                        if not (line.startswith("(") and line.endswith(")")):
-                            # Lines of the narrator are not enclosed between parenthesis. If they are, they
-                            # are considered a "line of thought" of the character
-                            speaker = "narrator"
-                        
-                        if child_ix != 0:
-                            # Sometimes, in a line, italics can be used as reinforcement. In the website,
-                            # italics is also used to highlight narrator speaking. We consider the narrator
-                            # speaking only if the line in italics is the first (and only) line in the paragraph
-                            speaker = last_speaker
-                    else:
-                        speaker = last_speaker
-
-                    if line:
-                        lines.append([self._page_scraped_ix, chapter, i, index, speaker, line])
-                        index += 1
-                else:
-                    # Line breaks or other tags
-                    pass
+    def parse_dialogues(self, chapter: str=None) -> pd.DataFrame:
+        import transcript
 
-            dialogues.append(lines)
+        dialogues = self.adapter.parse_dialogues(self.__paragraphs)
+        return transcript.from_dialogues(dialogues, self._page_scraped_ix, chapter)
 
-        return dialogues
-
-    def write(self, dialogues: list, chapter: str=None):
+    def write(self, df: pd.DataFrame, chapter: str=None) -> pathlib.Path:
         if chapter is None:
             chapter = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        
+
         chapter = self.__file_name_safe(chapter)
-        outfile = open(
-            helpers.CSV_PATH/f"1_raw/{self._page_scraped_ix}_{chapter}.csv",
-            "w",
-            encoding="utf-8",
-            newline=""
-        )
-        writer = csv.writer(outfile, **self.csv_settings)
-        writer.writerow(["chapter_index", "chapter", "dialogue_index", "line_index", "speaker", "line"])
-        # Unpack list of lists
-        for dialogue in dialogues:
-            writer.writerows(dialogue)
+        out_path = helpers.CSV_PATH/f"1_raw/{self.adapter.output_prefix}{self._page_scraped_ix}_{chapter}.csv"
+        df.to_csv(out_path, index=False, encoding="utf-8", **self.csv_settings)
+
+        return out_path
 
     def __file_name_safe(self, title: str):
         # Normalize accents (e.g., é → e)
@@ -148,3 +294,27 @@ class Scraper(object):
         cleaned = re.sub(r'\s+', '_', cleaned.strip())
         # Limit filename length for safety
         return cleaned[:255]
+
+
+def scrape_sources(sources: list[str], parser: str="html.parser", use_cache: bool=True, workers: int=4,
+                   on_chapter: Callable[[pathlib.Path], None]=None):
+    """
+    Scrapes several sources in one job. Each source follows its own chain of "next chapter"
+    links, sources run concurrently and share the same page fetcher and cache.
+    `on_chapter` is called with the raw csv of each chapter as soon as it is written.
+    """
+    unknown = [s for s in sources if s not in ADAPTERS]
+    if unknown:
+        raise ValueError(f"Unknown sources {unknown}. Available: {list(ADAPTERS)}")
+
+    fetcher = PageFetcher(use_cache=use_cache)
+
+    def scrape(source: str):
+        adapter = ADAPTERS[source]()
+        scraper = Scraper(parser=parser, adapter=adapter, fetcher=fetcher, on_chapter=on_chapter)
+        scraper.load_page(adapter.start_url)
+        scraper.main()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() re-raises the exceptions of the workers
+        list(executor.map(scrape, sources))
@@ -0,0 +1,273 @@
+import argparse
+import json
+import logging
+import pathlib
+import textwrap
+import wave
+import numpy as np
+from typing import Iterable, Iterator
+# custom scripts
+import helpers
+
+
+# Energy is measured on frames of FRAME_MS, then smoothed over SMOOTH_MS so that a pause
+# between two words is preferred over a single quiet frame in the middle of a word
+FRAME_MS = 10
+SMOOTH_MS = 200
+# Frames below floor + SILENCE_RATIO * (level - floor) are silent, where the floor and the level
+# are the 2nd percentile and the median of the energy (dB)
+SILENCE_RATIO = 0.3
+FLOOR_DB = -100.0
+SPLIT_RULES_PATH = helpers.BASE_PATH/"0_data_manip_cfg/split_rules.json"
+DRAFT_PATH = helpers.BASE_PATH/"0_data_manip_cfg/split_rules.draft.json"
+
+
+def time_to_seconds(t: str) -> float:
+    """Converts 'MM:SS', 'HH:MM:SS' or 'MM:SS.mmm' to seconds"""
+    parts = t.split(":")
+    if len(parts) not in (2, 3):
+        raise ValueError(f"Invalid time format: '{t}'")
+    seconds = float(parts[-1])
+    for i, p in enumerate(reversed(parts[:-1])):
+        seconds += int(p) * 60 ** (i + 1)
+    return seconds
+
+
+def seconds_to_time(seconds: float, precision: int=3) -> str:
+    """Converts seconds to 'MM:SS.mmm' ('MM:SS' with `precision=0`), or 'HH:MM:SS.mmm' past one hour"""
+    seconds = round(seconds, precision)
+    h, rest = divmod(seconds, 3600)
+    m, s = divmod(rest, 60)
+    width = 2 + (precision + 1 if precision else 0)
+    out = f"{int(m):02d}:{s:0{width}.{precision}f}"
+    return f"{int(h):02d}:{out}" if h else out
+
+
+def iter_wav(path: pathlib.Path, block_s: float=30.0) -> tuple[dict, Iterator[bytes]]:
+    """Opens a PCM WAV and returns `(params, blocks)`, the blocks being read lazily"""
+    w = wave.open(path.as_posix(), "rb")
+    params = {
+        "channels": w.getnchannels(),
+        "sampwidth": w.getsampwidth(),
+        "framerate": w.getframerate(),
+        "nframes": w.getnframes()
+    }
+
+    def blocks():
+        with w:
+            block_frames = int(block_s * params["framerate"])
+            while True:
+                block = w.readframes(block_frames)
+                if not block:
+                    break
+                yield block
+
+    return params, blocks()
+
+
+def pcm_samples(block: bytes, sampwidth: int) -> np.ndarray:
+    """PCM bytes to float samples in [-1, 1]"""
+    if sampwidth == 1:
+        # 8-bit WAV is unsigned
+        return (np.frombuffer(block, dtype=np.uint8).astype(np.float32) - 128) / 128
+    if sampwidth == 3:
+        raw = np.frombuffer(block, dtype=np.uint8).reshape(-1, 3)
+        ints = (raw[:, 0].astype(np.int32) | (raw[:, 1].astype(np.int32) << 8) | (raw[:, 2].astype(np.int32) << 16))
+        ints = np.where(ints & 0x800000, ints - (1 << 24), ints)
+        return ints.astype(np.float32) / (1 << 23)
+    dtype = {2: np.int16, 4: np.int32}[sampwidth]
+    return np.frombuffer(block, dtype=dtype).astype(np.float32) / np.iinfo(dtype).max
+
+
+def frame_seconds(params: dict, frame_ms: int=FRAME_MS) -> float:
+    """Exact length of an energy frame: a whole number of samples, close to `frame_ms`"""
+    return max(1, round(params["framerate"] * frame_ms / 1000)) / params["framerate"]
+
+
+def frame_energy(blocks: Iterable[bytes], params: dict, frame_ms: int=FRAME_MS) -> np.ndarray:
+    """
+    RMS energy in dBFS of every frame (see `frame_seconds()`), in a single streaming pass over the
+    PCM blocks. Channels are averaged. Bytes of an incomplete frame are carried over to the next block.
+    """
+    bytes_per_frame = params["channels"] * params["sampwidth"]
+    samples_per_frame = max(1, round(params["framerate"] * frame_ms / 1000))
+    chunk_bytes = samples_per_frame * bytes_per_frame
+
+    energies = []
+    carry = b""
+    for block in blocks:
+        block = carry + block
+        usable = len(block) - len(block) % chunk_bytes
+        carry = block[usable:]
+        if usable == 0:
+            continue
+
+        samples = pcm_samples(block[:usable], params["sampwidth"])
+        frames = samples.reshape(-1, samples_per_frame, params["channels"]).mean(axis=2)
+        energies.append(np.sqrt(np.mean(np.square(frames), axis=1)))
+
+    if carry:
+        tail = pcm_samples(carry[:len(carry) - len(carry) % bytes_per_frame], params["sampwidth"])
+        if len(tail):
+            tail = tail.reshape(-1, params["channels"]).mean(axis=1)
+            energies.append(np.array([np.sqrt(np.mean(np.square(tail)))], dtype=np.float32))
+
+    if not energies:
+        return np.array([], dtype=np.float32)
+    rms = np.concatenate(energies)
+    return np.maximum(20 * np.log10(np.maximum(rms, 1e-10)), FLOOR_DB).astype(np.float32)
+
+
+def smooth(energy: np.ndarray, frame_s: float, smooth_ms: int=SMOOTH_MS) -> np.ndarray:
+    """Centered moving average of the energy, computed with a cumulative sum"""
+    width = max(1, int(smooth_ms / 1000 / frame_s))
+    if len(energy) == 0 or width == 1:
+        return energy
+    cumsum = np.concatenate([[0.0], np.cumsum(energy, dtype=np.float64)])
+    ix = np.arange(len(energy))
+    lo = np.maximum(ix - width // 2, 0)
+    hi = np.minimum(ix + width - width // 2, len(energy))
+    return ((cumsum[hi] - cumsum[lo]) / (hi - lo)).astype(np.float32)
+
+
+def silence_threshold(energy: np.ndarray, ratio: float=SILENCE_RATIO) -> float:
+    floor, level = np.percentile(energy, [2, 50])
+    return float(floor + ratio * (level - floor))
+
+
+def silences(energy: np.ndarray, frame_s: float, min_silence_ms: int=500, threshold_db: float=None) -> np.ndarray:
+    """
+    Runs of silent frames lasting at least `min_silence_ms`, as an array of `(start_s, end_s)` rows.
+    """
+    if len(energy) == 0:
+        return np.empty((0, 2))
+    threshold_db = threshold_db if threshold_db is not None else silence_threshold(energy)
+
+    silent = np.concatenate([[False], energy <= threshold_db, [False]])
+    edges = np.flatnonzero(np.diff(silent.astype(np.int8)))
+    starts, ends = edges[0::2], edges[1::2]
+    keep = (ends - starts) * frame_s * 1000 >= min_silence_ms
+    return np.column_stack([starts[keep], ends[keep]]) * frame_s
+
+
+def snap(timestamps: Iterable[float], energy: np.ndarray, frame_s: float, tolerance_s: float=1.5) -> list[float]:
+    """
+    Moves every timestamp to the quietest point (smoothed energy) within `tolerance_s`.
+    Among equally quiet frames the one closest to the original timestamp wins. When that point
+    is in a silence, the cut is moved to the middle of the silence (still within the tolerance).
+    """
+    smoothed = smooth(energy, frame_s)
+    silent = energy <= silence_threshold(energy) if len(energy) else energy.astype(bool)
+    tol = int(tolerance_s / frame_s)
+    snapped = []
+    for t in timestamps:
+        center = int(round(t / frame_s))
+        lo, hi = max(0, center - tol), min(len(smoothed), center + tol + 1)
+        if lo >= hi:
+            snapped.append(t)
+            continue
+        window = smoothed[lo:hi]
+        candidates = np.flatnonzero(window <= window.min() + 0.5) + lo
+        best = candidates[np.argmin(np.abs(candidates - center))]
+        if silent[best]:
+            # Bounds of the silent run around `best`, within the window
+            run_lo = lo + np.flatnonzero(~silent[lo:best + 1])[-1] + 1 if not silent[lo:best + 1].all() else lo
+            after = np.flatnonzero(~silent[best:hi])
+            run_hi = best + after[0] if len(after) else hi
+            best = (run_lo + run_hi - 1) // 2
+        # Middle of the frame
+        snapped.append(float((best + 0.5) * frame_s))
+    return snapped
+
+
+def propose(energy: np.ndarray, frame_s: float, target_s: float=240.0, min_silence_ms: int=500) -> list[float]:
+    """
+    Proposes split points roughly every `target_s` seconds, each one in the middle of the longest
+    silence found within half a target of the ideal position.
+    """
+    duration = len(energy) * frame_s
+    gaps = silences(energy, frame_s, min_silence_ms)
+    points = []
+    last = 0.0
+    while duration - last > 1.5 * target_s:
+        ideal = last + target_s
+        mids = gaps.mean(axis=1)
+        near = (np.abs(mids - ideal) <= target_s / 2) & (mids > last)
+        if near.any():
+            lengths = np.where(near, gaps[:, 1] - gaps[:, 0], -1)
+            point = float(mids[np.argmax(lengths)])
+        else:
+            point = snap([ideal], energy, frame_s, tolerance_s=target_s / 4)[0]
+        points.append(point)
+        last = point
+    return points
+
+
+def wav_energy(path: pathlib.Path, frame_ms: int=FRAME_MS) -> tuple[np.ndarray, float]:
+    """Returns `(energy, frame_s)` of a WAV file"""
+    params, blocks = iter_wav(path)
+    return frame_energy(blocks, params, frame_ms), frame_seconds(params, frame_ms)
+
+
+def draft_rules(wavs: list[pathlib.Path], tolerance_s: float=1.5, target_s: float=240.0, min_silence_ms: int=500) -> list[dict]:
+    """
+    Split rules draft: timestamps of the existing rules snapped to the nearest silence, and proposed
+    timestamps for the chapters without rules. The csv `ranges` are copied from the existing rules,
+    new chapters get an empty list to fill in.
+    """
+    rules = {r["source"]: r for r in json.load(open(SPLIT_RULES_PATH, "r"))}
+    draft = []
+    for wav in wavs:
+        logging.info(f"Analysing {wav.name}")
+        energy, frame_s = wav_energy(wav)
+        rule = rules.get(wav.stem)
+
+        if rule and rule.get("timestamps"):
+            original = [time_to_seconds(t) for t in rule["timestamps"]]
+            points = snap(original, energy, frame_s, tolerance_s=tolerance_s)
+            for o, p in zip(original, points):
+                if abs(o - p) >= 0.05:
+                    logging.info(f"{seconds_to_time(o)} → {seconds_to_time(p)}")
+            ranges = rule["ranges"]
+        else:
+            points = propose(energy, frame_s, target_s=target_s, min_silence_ms=min_silence_ms)
+            logging.info(f"Proposed {[seconds_to_time(p) for p in points]}")
+            ranges = rule["ranges"] if rule else []
+
+        draft.append({"source": wav.stem, "ranges": ranges, "timestamps": [seconds_to_time(p) for p in points]})
+
+    # Rules of chapters without audio are kept as they are
+    drafted = {d["source"] for d in draft}
+    draft += [r for s, r in rules.items() if s not in drafted]
+    return draft
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(
+            """
+            Detect silences in the edited chapter audio and write a draft of split_rules.json
+            with split timestamps snapped to the nearest pause (millisecond precision).
+            Chapters without timestamps get proposed split points.
+            Review the draft, then copy it over split_rules.json.
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("chapters", nargs="*", help="Chapter names (default: every wav in 'audio/2_edits')")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Max distance (seconds) a timestamp can be moved")
+    parser.add_argument("--target", type=float, default=240.0, help="Target split length (seconds) for new chapters")
+    parser.add_argument("--min-silence", type=int, default=500, help="Min silence length (ms) for proposed split points")
+    parser.add_argument("--out", type=pathlib.Path, default=DRAFT_PATH, help="Draft output path")
+    args = parser.parse_args()
+
+    wavs = sorted((helpers.AUDIO_PATH/"2_edits").glob("*.wav"))
+    if args.chapters:
+        wavs = [w for w in wavs if w.stem in args.chapters]
+
+    draft = draft_rules(wavs, tolerance_s=args.tolerance, target_s=args.target, min_silence_ms=args.min_silence)
+    with open(args.out, "w") as f:
+        json.dump(draft, f, indent=2, ensure_ascii=False)
+    logging.info(f"Written split rules draft at {args.out.as_posix()}")
@@ -2,19 +2,25 @@ import pathlib
 import logging
 import json
 import os
-import pandas as pd
-import wave
-import lameenc
+import shutil
 # custom scripts
 import helpers
+import audio_cache
+import catalog
+import instrumentation
+import silence
+import transcript
 
 
 class Splitter(object):
-    def __init__(self):
+    def __init__(self, delete_existing: bool=True, snap_tolerance: float=None):
         self.split_rules = json.load(open(helpers.BASE_PATH/"0_data_manip_cfg/split_rules.json", "r"))
         self.csv_settings = helpers.CSV_SETTINGS
-
-        self.delete_existing_files()
+        # Max distance (seconds) a timestamp can be moved to the nearest silence. None: cut at the exact timestamps
+        self.snap_tolerance = snap_tolerance
+        self.audio_cache = audio_cache.AudioCache()
+        # The outputs of the previous run are deleted when `main()` starts, not on construction
+        self.delete_existing = delete_existing
 
     def delete_existing_files(self):
         logging.info("Deleting existing csv splits")
@@ -45,17 +51,45 @@ class Splitter(object):
         return pairs
 
     def main(self):
+        if self.delete_existing:
+            self.delete_existing_files()
+
         # Link each wav to its matching csv
         pairs = self._csv_wav_edit_pairs()
         for pair in pairs:
-            logging.info(f"Splitting csv for '{pair['csv'].stem}'")
-            self._split_csv(pair["csv"])
-            logging.info(f"Splitting audio for '{pair['wav'].stem}'")
-            self._split_wav(pair["wav"])
+            self.split_chapter_csv(pair["csv"])
+            self.split_chapter_wav(pair["wav"])
             logging.info("---")
 
-    def _split_csv(self, path:pathlib.Path):
-        df = pd.read_csv(path.as_posix(), **self.csv_settings)
+        logging.info("Refreshing split catalog")
+        catalog.SplitCatalog().refresh()
+
+    def split_chapter_csv(self, path: pathlib.Path) -> list[pathlib.Path]:
+        """Splits the csv of a chapter, replacing its previous splits"""
+        chapter = path.stem
+        logging.info(f"Splitting csv for '{chapter}'")
+        with instrumentation.stage("split_csv", chapter=chapter) as event:
+            event["bytes_read"] = instrumentation.file_size(path)
+            for f in catalog.chapter_splits(chapter, "csv"):
+                os.remove(f.as_posix())
+            out_paths = self._split_csv(path)
+            event["bytes_written"] = sum(instrumentation.file_size(p) for p in out_paths)
+        return out_paths
+
+    def split_chapter_wav(self, path: pathlib.Path) -> list[pathlib.Path]:
+        """Splits the wav of a chapter into mp3s, replacing its previous splits"""
+        chapter = path.stem
+        logging.info(f"Splitting audio for '{chapter}'")
+        with instrumentation.stage("split_wav", chapter=chapter) as event:
+            event["bytes_read"] = instrumentation.file_size(path)
+            for f in catalog.chapter_splits(chapter, "mp3"):
+                os.remove(f.as_posix())
+            out_paths = self._split_wav(path)
+            event["bytes_written"] = sum(instrumentation.file_size(p) for p in out_paths)
+        return out_paths
+
+    def _split_csv(self, path:pathlib.Path) -> list[pathlib.Path]:
+        df = transcript.read_transcript(path)
         file_has_split_rules = False
         splits = []
         for split_rule in self.split_rules:
@@ -86,111 +120,68 @@ class Splitter(object):
 
                 slices.append(df[mask].copy())
 
+            out_paths = []
             for i, slice in enumerate(slices):
-                slice.to_csv(helpers.CSV_PATH/f"3_splits/{path.stem}_{i}.csv", index=False, **self.csv_settings)
+                out_path = helpers.CSV_PATH/f"3_splits/{path.stem}_{i}.csv"
+                slice.to_csv(out_path, index=False, **self.csv_settings)
+                out_paths.append(out_path)
 
         else:
             logging.info(f"{path.stem} copied as-is")
-            df.to_csv(helpers.CSV_PATH/f"3_splits/{path.stem}.csv", index=False, **self.csv_settings)
+            out_paths = [helpers.CSV_PATH/f"3_splits/{path.stem}.csv"]
+            df.to_csv(out_paths[0], index=False, **self.csv_settings)
 
-    def _split_wav(self, path: pathlib.Path):
+        return out_paths
+
+    def _split_wav(self, path: pathlib.Path) -> list[pathlib.Path]:
         """
         Split a WAV file into MP3 chunks based on timestamps in self.split_rules.
-        Uses only pydub (no ffmpeg needed for WAV input).
+        The MP3s come from the shared audio cache when the same WAV was already split at the same points.
         """
         timestamps = []
         for split_rule in self.split_rules:
             if split_rule["source"] == path.stem:
-                timestamps = [self.__time_to_seconds(t) for t in split_rule["timestamps"]]
+                timestamps = [silence.time_to_seconds(t) for t in split_rule["timestamps"]]
 
         out_dir = path.parent.parent / "3_splits"
+        out_paths = []
 
-        # Load the WAV
-        params, pcm = self.__read_wav(path)
+        # Metadata only: the WAV is decoded only if the splits are not cached or must be snapped
+        params = self.audio_cache.info(path)
         duration_ms = int(params["nframes"] / params["framerate"] * 1000)
+        pcm = None
+
+        if timestamps and self.snap_tolerance:
+            pcm = audio_cache.read_wav(path)
+            energy = silence.frame_energy([pcm[1]], params)
+            snapped = silence.snap(timestamps, energy, silence.frame_seconds(params), tolerance_s=self.snap_tolerance)
+            logging.info(
+                f"Timestamps snapped to silences: {[silence.seconds_to_time(t) for t in snapped]}"
+            )
+            timestamps = snapped
 
         if timestamps:
             # Convert timestamps to ms
             split_points = [0] + [t * 1000 for t in timestamps] + [duration_ms]
+            bounds = list(zip(split_points[:-1], split_points[1:]))
+            mp3s = self.audio_cache.split_mp3s(path, bounds, pcm=pcm)
 
-            for i in range(len(split_points) - 1):
-                start_ms: int = split_points[i]
-                end_ms: int = split_points[i + 1]
-
-                pcm_slice = self.__slice_pcm(pcm, params, start_ms, end_ms)
+            for i, ((start_ms, end_ms), mp3) in enumerate(zip(bounds, mp3s)):
                 out_name = out_dir / f"{path.stem}_{i}.mp3"
-
-                self.__write_mp3(pcm_slice, params, out_name)
+                out_name.write_bytes(mp3)
+                out_paths.append(out_name)
 
                 logging.info(out_name.as_posix())
                 logging.info(
                     f"Wrote audio split {path.stem}_{i}: "
-                    f"{self.__seconds_to_time(start_ms/1000)}s → {self.__seconds_to_time(end_ms/1000)}s"
+                    f"{silence.seconds_to_time(start_ms/1000)}s → {silence.seconds_to_time(end_ms/1000)}s"
                 )
 
         else:
             # No timestamps: convert whole file
             out_name = out_dir / f"{path.stem}.mp3"
-            self.__write_mp3(pcm, params, out_name)
+            shutil.copyfile(self.audio_cache.chapter_mp3(path), out_name)
+            out_paths.append(out_name)
             logging.info(f"{path.name} copied as-is (converted to MP3)")
 
-    def __read_wav(self, path: pathlib.Path):
-        """Reads PCM WAV and returns (params, raw_bytes)."""
-        with wave.open(path.as_posix(), "rb") as w:
-            params = {
-                "channels": w.getnchannels(),
-                "sampwidth": w.getsampwidth(),
-                "framerate": w.getframerate(),
-                "nframes": w.getnframes()
-            }
-            pcm = w.readframes(params["nframes"])
-        return params, pcm
-
-    def __slice_pcm(self, pcm: bytes, params: dict, start_ms: int, end_ms: int):
-        """Return PCM slice between start/end in ms."""
-        frame_rate = params["framerate"]
-        channels = params["channels"]
-        sampwidth = params["sampwidth"]
-
-        bytes_per_frame = channels * sampwidth
-
-        start_frame = int(start_ms / 1000 * frame_rate)
-        end_frame = int(end_ms / 1000 * frame_rate)
-
-        start_byte = start_frame * bytes_per_frame
-        end_byte = end_frame * bytes_per_frame
-
-        return pcm[start_byte:end_byte]
-
-    def __write_mp3(self, pcm_slice: bytes, params: dict, outpath: pathlib.Path):
-        encoder = lameenc.Encoder()
-        encoder.set_in_sample_rate(params["framerate"])
-        encoder.set_channels(params["channels"])
-        encoder.set_bit_rate(192)
-        encoder.set_quality(2)
-
-        mp3 = encoder.encode(pcm_slice)
-        mp3 += encoder.flush()
-
-        with open(outpath.as_posix(), "wb") as f:
-            f.write(mp3)
-
-    def __time_to_seconds(self, t:str):
-        """Convert 'MM:SS' or 'HH:MM:SS' string to seconds"""
-        parts = [int(p) for p in t.split(":")]
-        if len(parts) == 2:
-            m, s = parts
-            return m * 60 + s
-        elif len(parts) == 3:
-            h, m, s = parts
-            return h * 3600 + m * 60 + s
-        else:
-            raise ValueError("Invalid time format")
-    
-    def __seconds_to_time(self, seconds):
-        """Convert seconds to 'MM:SS' string"""
-        seconds = int(seconds)
-        m = (seconds % 3600) // 60
-        s = seconds % 60
-
-        return f"{m:02d}:{s:02d}"
+        return out_paths
@@ -0,0 +1,290 @@
+import argparse
+import datetime
+import json
+import logging
+import pathlib
+import textwrap
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+# custom scripts
+import helpers
+import transcript
+import comparison
+
+
+EMOTIONS_SCORED_PATH = helpers.BASE_PATH/"output/emotions_scored"
+API_RESPONSES_PATH = helpers.BASE_PATH/"output/api_responses"
+STABILITY_PATH = helpers.BASE_PATH/"output/stability"
+# Same format used by Classifier.write_outputs
+RUN_TIME_FORMAT = "%d-%m-%YT%H-%M"
+
+
+def run_time(path: pathlib.Path) -> datetime.datetime:
+    """Parses the run timestamp out of a classification file name"""
+    try:
+        return datetime.datetime.strptime(path.stem.split("_")[0], RUN_TIME_FORMAT)
+    except ValueError:
+        return datetime.datetime.fromtimestamp(path.stat().st_mtime)
+
+
+def load_chapter_runs(chapter_dir: pathlib.Path) -> pd.DataFrame:
+    """
+    Loads every classification run of a chapter into a single long DataFrame, with a `run` column
+    holding the run file stem. Runs are sorted oldest first.
+    """
+    runs = sorted([f for f in chapter_dir.iterdir() if f.is_file() and f.suffix == ".csv"], key=run_time)
+    dfs = []
+    for run in runs:
+        df = transcript.read_transcript(run)
+        df["run"] = run.stem
+        dfs.append(df)
+
+    if not dfs:
+        return pd.DataFrame()
+    return transcript.concat(dfs)
+
+
+USAGE_COLUMNS = [
+    "run", "requests", "lines", "transcript_encoding",
+    "prompt_tokens", "completion_tokens", "text_tokens", "audio_tokens", "cached_tokens"
+]
+
+
+def _response_lines(response: dict) -> int:
+    """Number of lines scored in a response, 0 if its content is not valid JSON"""
+    try:
+        return len(json.loads(response["choices"][0]["message"]["content"]))
+    except (KeyError, IndexError, TypeError, ValueError):
+        return 0
+
+
+def load_chapter_usage(chapter: str) -> pd.DataFrame:
+    """
+    Sums the token usage stored in `api_responses` for every run of a chapter, with the prompt
+    tokens broken down into text, audio and cached tokens.
+    """
+    rows = []
+    chapter_dir = API_RESPONSES_PATH/chapter
+    if not chapter_dir.exists():
+        return pd.DataFrame(columns=USAGE_COLUMNS)
+
+    for f in chapter_dir.iterdir():
+        if f.suffix != ".json":
+            continue
+        responses = json.load(open(f, "r"))
+        if isinstance(responses, dict):
+            # Older runs stored a single response instead of a list
+            responses = [responses]
+        usages = [r.get("usage") or {} for r in responses]
+        details = [u.get("prompt_tokens_details") or {} for u in usages]
+        encodings = {r.get("transcript_encoding", "full") for r in responses}
+        rows.append({
+            "run": f.stem,
+            "requests": len(responses),
+            "lines": sum(_response_lines(r) for r in responses),
+            "transcript_encoding": encodings.pop() if len(encodings) == 1 else "mixed",
+            "prompt_tokens": sum(u.get("prompt_tokens", 0) for u in usages),
+            "completion_tokens": sum(u.get("completion_tokens", 0) for u in usages),
+            "text_tokens": sum(d.get("text_tokens", 0) for d in details),
+            "audio_tokens": sum(d.get("audio_tokens", 0) for d in details),
+            "cached_tokens": sum(d.get("cached_tokens", 0) for d in details),
+        })
+
+    return pd.DataFrame(rows, columns=USAGE_COLUMNS)
+
+
+def runs_to_array(runs_df: pd.DataFrame, emotions: list[str]) -> tuple[np.ndarray, pd.DataFrame]:
+    """
+    Aligns the runs by `(dialogue_index, line_index)` and returns a `(lines, runs, emotions)` score
+    array along with the line keys. Only lines scored in every run are kept.
+    """
+    run_names = list(dict.fromkeys(runs_df["run"]))
+    wide = runs_df.drop_duplicates(comparison.KEY_COLUMNS + ["run"]).pivot(
+        index=comparison.KEY_COLUMNS, columns="run", values=emotions
+    )
+    wide = wide.dropna()
+
+    # Columns are (emotion, run): reorder to runs in chronological order, then reshape
+    wide = wide.reindex(columns=pd.MultiIndex.from_product([emotions, run_names]))
+    scores = wide.to_numpy(dtype=float).reshape(len(wide), len(emotions), len(run_names))
+    return scores.transpose(0, 2, 1), wide.index.to_frame(index=False)
+
+
+def chapter_stability(runs_df: pd.DataFrame) -> dict:
+    """
+    Computes the inter-run stability metrics of a single chapter.
+
+    Returns a dict with:
+    - `per_emotion`: DataFrame with mean variance, argmax flip rate and drift for each emotion
+    - `per_line`: DataFrame with the variance and the flip flag of each line
+    - `convergence`: mean absolute deviation of the mean of the first k runs from the mean of all runs
+    - `runs`, `lines`, `lines_dropped`, `flip_rate`
+    """
+    emotions = [e for e in comparison.emotion_columns(runs_df) if e != "run"]
+    scores, keys = runs_to_array(runs_df, emotions)
+    n_lines, n_runs, _ = scores.shape
+    total_lines = runs_df.drop_duplicates(comparison.KEY_COLUMNS).shape[0]
+
+    dominant = scores.argmax(axis=2)                               # (lines, runs)
+    flipped = (dominant != dominant[:, :1]).any(axis=1)            # (lines,)
+    variance = scores.var(axis=1)                                  # (lines, emotions)
+
+    # Modal dominant emotion of each line, used to attribute flips to an emotion
+    counts = np.apply_along_axis(np.bincount, 1, dominant, minlength=len(emotions)) if n_lines else np.zeros((0, len(emotions)))
+    modal = counts.argmax(axis=1) if n_lines else np.zeros(0, dtype=int)
+
+    flip_rate_per_emotion = []
+    for e_ix in range(len(emotions)):
+        lines_of_e = modal == e_ix
+        flip_rate_per_emotion.append(flipped[lines_of_e].mean() if lines_of_e.any() else np.nan)
+
+    if n_runs > 1:
+        drift = (scores[:, -1, :] - scores[:, 0, :]).mean(axis=0)
+        step_change = np.abs(np.diff(scores, axis=1)).mean(axis=(0, 1))
+    else:
+        drift = np.full(len(emotions), np.nan)
+        step_change = np.full(len(emotions), np.nan)
+
+    per_emotion = pd.DataFrame({
+        "emotion": emotions,
+        "mean_variance": variance.mean(axis=0) if n_lines else np.nan,
+        "modal_lines": np.bincount(modal, minlength=len(emotions)),
+        "flip_rate": flip_rate_per_emotion,
+        "drift_first_last": drift,
+        "mean_step_change": step_change,
+    })
+
+    per_line = keys.copy()
+    per_line["variance"] = variance.sum(axis=1)
+    per_line["flipped"] = flipped
+    per_line["modal_emotion"] = np.array(emotions, dtype=object)[modal] if n_lines else []
+
+    # How far the average of the first k runs is from the average of all runs
+    overall_mean = scores.mean(axis=1, keepdims=True)
+    running_mean = np.cumsum(scores, axis=1) / np.arange(1, n_runs + 1)[None, :, None]
+    convergence = np.abs(running_mean - overall_mean).sum(axis=2).mean(axis=0) if n_lines else np.zeros(n_runs)
+
+    return {
+        "runs": n_runs,
+        "lines": n_lines,
+        "lines_dropped": total_lines - n_lines,
+        "flip_rate": float(flipped.mean()) if n_lines else np.nan,
+        "per_emotion": per_emotion,
+        "per_line": per_line,
+        "convergence": [float(c) for c in convergence],
+    }
+
+
+def analyse_chapter(chapter_dir: pathlib.Path) -> dict:
+    runs_df = load_chapter_runs(chapter_dir)
+    if runs_df.empty:
+        return None
+
+    result = chapter_stability(runs_df)
+    result["chapter"] = chapter_dir.name
+    result["usage"] = load_chapter_usage(chapter_dir.name)
+    return result
+
+
+def analyse(chapters: list[str]=None, workers: int=8) -> list[dict]:
+    """
+    Analyses the classification history of every chapter (or only `chapters`) in parallel.
+    """
+    chapter_dirs = [d for d in EMOTIONS_SCORED_PATH.iterdir() if d.is_dir() and d.stem != "Z_Final"]
+    if chapters:
+        chapter_dirs = [d for d in chapter_dirs if d.name in chapters]
+    chapter_dirs.sort(key=lambda x: int(x.stem.split("_")[0]))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(analyse_chapter, chapter_dirs))
+
+    return [r for r in results if r is not None]
+
+
+def build_report(results: list[dict], input_price: float=None, output_price: float=None) -> tuple[pd.DataFrame, dict]:
+    """
+    Flattens the per-chapter results into a `(chapter, emotion)` report DataFrame and a compact summary dict.
+
+    Prices are in dollars per 1M tokens. When given, the summary includes the mean cost of a run.
+    """
+    report_dfs = []
+    summary = {"generated_at": datetime.datetime.now().isoformat(timespec="seconds"), "chapters": {}}
+    for r in results:
+        df = r["per_emotion"].copy()
+        df.insert(0, "chapter", r["chapter"])
+        df.insert(1, "runs", r["runs"])
+        report_dfs.append(df)
+
+        usage = r["usage"]
+        chapter_summary = {
+            "runs": r["runs"],
+            "lines": r["lines"],
+            "lines_dropped": r["lines_dropped"],
+            "flip_rate": r["flip_rate"],
+            "mean_variance": float(r["per_emotion"]["mean_variance"].sum()),
+            "convergence": r["convergence"],
+            "mean_prompt_tokens_per_run": float(usage["prompt_tokens"].mean()) if not usage.empty else None,
+            "mean_completion_tokens_per_run": float(usage["completion_tokens"].mean()) if not usage.empty else None,
+        }
+        if input_price is not None and output_price is not None and not usage.empty:
+            run_costs = (usage["prompt_tokens"] * input_price + usage["completion_tokens"] * output_price) / 1_000_000
+            chapter_summary["mean_cost_per_run"] = float(run_costs.mean())
+        summary["chapters"][r["chapter"]] = chapter_summary
+
+    report_df = pd.concat(report_dfs, ignore_index=True) if report_dfs else pd.DataFrame()
+
+    multi_run = [s for s in summary["chapters"].values() if s["runs"] > 1]
+    summary["multi_run_chapters"] = len(multi_run)
+    summary["mean_flip_rate"] = float(np.mean([s["flip_rate"] for s in multi_run])) if multi_run else None
+    return report_df, summary
+
+
+def write_report(report_df: pd.DataFrame, summary: dict) -> pathlib.Path:
+    if not STABILITY_PATH.exists():
+        STABILITY_PATH.mkdir(parents=True)
+
+    now = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    report_path = STABILITY_PATH/f"{now}_report.csv"
+    report_df.to_csv(report_path.as_posix(), **helpers.CSV_SETTINGS, index=False)
+    logging.info(f"Written stability report at {report_path.as_posix()}")
+
+    # Fixed name: the dashboard always reads the latest summary
+    summary_path = STABILITY_PATH/"summary.json"
+    with open(summary_path.as_posix(), "w") as f:
+        json.dump(summary, f, indent=2)
+    logging.info(f"Written stability summary at {summary_path.as_posix()}")
+
+    return report_path
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(
+            """
+            Analyse the stability of repeated classification runs stored in 'output/emotions_scored'.
+            Chapters with a single run are reported, but have no inter-run metrics.
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--chapters", nargs="*", help="Only analyse these chapters (folder names)")
+    parser.add_argument("--workers", type=int, default=8, help="Number of chapters loaded in parallel")
+    parser.add_argument("--input-price", type=float, help="Prompt price in $ per 1M tokens")
+    parser.add_argument("--output-price", type=float, help="Completion price in $ per 1M tokens")
+    args = parser.parse_args()
+    logging.info(f"Running with arguments: {args}")
+
+    results = analyse(args.chapters, workers=args.workers)
+    report_df, summary = build_report(results, args.input_price, args.output_price)
+
+    for chapter, s in summary["chapters"].items():
+        if s["runs"] > 1:
+            logging.info(
+                f"{chapter}: {s['runs']} runs, {s['lines']} lines, flip rate {s['flip_rate']:.1%}, "
+                f"convergence {[round(c, 3) for c in s['convergence']]}"
+            )
+    write_report(report_df, summary)
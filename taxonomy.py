@@ -0,0 +1,211 @@
+import json
+import argparse
+import logging
+import pathlib
+import textwrap
+import numpy as np
+import pandas as pd
+# custom scripts
+import helpers
+import comparison
+import query
+import transcript
+
+
+# Relative to helpers.BASE_PATH, resolved at call time
+TAXONOMY_FILE = "0_data_manip_cfg/taxonomy.json"
+DEFAULT_TAXONOMY = "default"
+# Reprocessed runs and results, see `cli`
+REPROCESSED_PATH = helpers.BASE_PATH/"output/taxonomies"
+POLARITIES = ["positive", "negative", "neutral"]
+
+
+def apply_threshold(scores: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Scores lower than `threshold` set to 0 and added to the highest score of their line.
+    `scores` is a `(lines, emotions)` matrix, lines that are all NaN are left as they are.
+    """
+    scores = np.array(scores, dtype=np.float64)
+    scored = ~np.isnan(scores).all(axis=1)
+    values = np.nan_to_num(scores[scored])
+    below = (values > 0) & (values < threshold)
+    top = values.argmax(axis=1)
+    dropped = np.where(below, values, 0.0).sum(axis=1)
+    values[below] = 0.0
+    values[np.arange(len(values)), top] += dropped
+    scores[scored] = values
+    return scores
+
+
+def renormalise(scores: np.ndarray) -> np.ndarray:
+    """Lines scaled to add up to 1 (lines without scores are left as they are)"""
+    totals = np.nansum(scores, axis=1, keepdims=True)
+    return np.divide(scores, totals, out=np.array(scores, dtype=np.float64), where=totals > 0)
+
+
+def project(scores: np.ndarray, valence: np.ndarray, arousal: np.ndarray) -> np.ndarray:
+    """`(lines, 2)` valence and arousal of each line: mean of those of its emotions, weighted by their scores"""
+    return renormalise(scores) @ np.column_stack([valence, arousal])
+
+
+def dominant(scores: np.ndarray, emotions: list[str]) -> np.ndarray:
+    """Highest scored emotion of each line, None for the lines without scores"""
+    values = np.nan_to_num(scores, nan=-1.0)
+    names = np.asarray(emotions, dtype=object)[values.argmax(axis=1)] if len(emotions) else np.full(len(scores), None)
+    names[values.max(axis=1, initial=-1.0) <= 0] = None
+    return names
+
+
+class Taxonomy(object):
+    """
+    Emotions classified by the model, with their polarity, valence and arousal, dashboard color
+    and the minimum score kept by the post-processing.
+    `mapping` turns the emotions of other taxonomies into these ones (`{emotion: {emotion: weight}}`),
+    so that runs classified with another taxonomy can be reprocessed without prompting the model again.
+    """
+    def __init__(self, name: str, emotions: list[dict], threshold: float=0.0, mapping: dict=None):
+        unknown = [e["name"] for e in emotions if e["polarity"] not in POLARITIES]
+        if unknown:
+            raise ValueError(f"Taxonomy '{name}': emotions {unknown} have no polarity in {POLARITIES}")
+        self.name = name
+        self.threshold = threshold
+        self.mapping: dict[str, dict[str, float]] = mapping or {}
+        self.positive = [e["name"] for e in emotions if e["polarity"] == "positive"]
+        self.negative = [e["name"] for e in emotions if e["polarity"] == "negative"]
+        self.neutral = [e["name"] for e in emotions if e["polarity"] == "neutral"]
+        # Target emotions (named in the run ids) and columns of the scored DataFrames
+        self.target = self.negative + self.positive
+        self.scored = self.positive + self.negative + self.neutral
+
+        by_name = {e["name"]: e for e in emotions}
+        self.colors = {e: by_name[e].get("color", "#B3B3B3") for e in self.scored}
+        self.valence = np.array([by_name[e].get("valence", 0.0) for e in self.scored])
+        self.arousal = np.array([by_name[e].get("arousal", 0.0) for e in self.scored])
+
+    @property
+    def abbreviation(self) -> str:
+        """Emotions in the run ids and output file names, e.g. `ang-sad-fea-hap-amb-sur`"""
+        return "-".join([e[:3] for e in self.target])
+
+    def matrix(self, emotions: list[str]) -> np.ndarray:
+        """`(emotions, scored)` weights of the scores of `emotions` in the emotions of this taxonomy"""
+        weights = np.zeros((len(emotions), len(self.scored)))
+        unmapped = []
+        for i, e in enumerate(emotions):
+            if e in self.scored:
+                weights[i, self.scored.index(e)] = 1.0
+            elif e in self.mapping:
+                for target, weight in self.mapping[e].items():
+                    weights[i, self.scored.index(target)] = weight
+            else:
+                unmapped.append(e)
+        if unmapped:
+            raise ValueError(f"Taxonomy '{self.name}' has no mapping for the emotions {unmapped}")
+        return weights
+
+    def map(self, scores: np.ndarray, emotions: list[str]) -> np.ndarray:
+        """Scores of `emotions` as scores of this taxonomy. Missing scores count as 0, lines without any stay NaN."""
+        mapped = np.nan_to_num(scores) @ self.matrix(emotions)
+        mapped[np.isnan(scores).all(axis=1)] = np.nan
+        return mapped
+
+    def process(self, scores: np.ndarray) -> np.ndarray:
+        """Thresholded and renormalised `(lines, scored)` scores"""
+        if self.threshold:
+            scores = apply_threshold(scores, self.threshold)
+        return np.round(renormalise(scores), 4)
+
+    def frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Classified DataFrame (a run or a result) reprocessed with this taxonomy: its emotions mapped,
+        post-processed, and the valence, arousal and dominant emotion of each line.
+        """
+        emotions = [e for e in comparison.emotion_columns(df) if e not in query.RESULT_COLUMNS]
+        scores = self.process(self.map(df[emotions].to_numpy(dtype=np.float64, na_value=np.nan), emotions))
+        position = project(scores, self.valence, self.arousal)
+
+        out = df.drop(columns=emotions + [c for c in comparison.DERIVED_COLUMNS if c in df.columns])
+        at = out.columns.get_loc(comparison.FLAGS_COLUMN) if comparison.FLAGS_COLUMN in out.columns else len(out.columns)
+        derived = pd.DataFrame(scores, columns=self.scored, index=out.index)
+        derived["valence"] = position[:, 0].round(4)
+        derived["arousal"] = position[:, 1].round(4)
+        derived["dominant_emotion"] = dominant(scores, self.scored)
+        return pd.concat([out.iloc[:, :at], derived, out.iloc[:, at:]], axis=1)
+
+
+def _config() -> list[dict]:
+    return json.load(open(helpers.BASE_PATH/TAXONOMY_FILE, "r"))
+
+
+def names() -> list[str]:
+    return [t["name"] for t in _config()]
+
+
+def load(name: str=None) -> Taxonomy:
+    """Taxonomy `name` of the config (default: DEFAULT_TAXONOMY)"""
+    name = name if name is not None else DEFAULT_TAXONOMY
+    for t in _config():
+        if t["name"] == name:
+            return Taxonomy(t["name"], t["emotions"], threshold=t.get("threshold", 0.0), mapping=t.get("map"))
+    raise ValueError(f"Unknown taxonomy '{name}', expected one of {names()}")
+
+
+def colors() -> dict[str, str]:
+    """Color of every emotion of every taxonomy, for the dashboards"""
+    return {e["name"]: e["color"] for t in reversed(_config()) for e in t["emotions"] if "color" in e}
+
+
+def reprocess(path: pathlib.Path, taxonomy: Taxonomy, out_path: pathlib.Path) -> pathlib.Path:
+    df = transcript.read_transcript(path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    taxonomy.frame(df).to_csv(out_path.as_posix(), **helpers.CSV_SETTINGS, index=False)
+    logging.info(f"Reprocessed '{path.name}' with taxonomy '{taxonomy.name}': {out_path.as_posix()}")
+    return out_path
+
+
+def cli(argv: list[str]=None, prog: str=None):
+    """Command-line interface of the taxonomies (also `python main.py taxonomy`)"""
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description=textwrap.dedent(
+            """
+            Reprocess classification runs with a taxonomy of 'taxonomy.json', without prompting the model again:
+            emotions are mapped to those of the taxonomy, thresholded and renormalised, and every line gets
+            its valence, arousal and dominant emotion.
+            Writes to 'output/taxonomies/{TAXONOMY}', with the names of the source files.
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("taxonomy", nargs="?", default=DEFAULT_TAXONOMY, help=f"Taxonomy to reprocess with (default: {DEFAULT_TAXONOMY})")
+    parser.add_argument("runs", nargs="*", type=pathlib.Path, help="Classified csv files (default: the latest run of each chapter)")
+    parser.add_argument("--result", action="store_true", help="Reprocess the latest result of prep_for_dashboard.py instead")
+    parser.add_argument("--list", action="store_true", help="List the taxonomies and their emotions")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name in names():
+            t = load(name)
+            print(f"{name:<12} {', '.join(t.scored)} (threshold {t.threshold})")
+        return
+
+    try:
+        taxonomy = load(args.taxonomy)
+    except ValueError as e:
+        parser.error(str(e))
+    out_dir = REPROCESSED_PATH/taxonomy.name
+    if args.result:
+        result = query.latest_result()
+        reprocess(result, taxonomy, out_dir/result.name)
+        return
+
+    if not args.runs:
+        import prep_for_dashboard
+        args.runs = prep_for_dashboard.latest_runs()
+    for run in args.runs:
+        reprocess(run, taxonomy, out_dir/run.parent.name/run.name)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    cli()
@@ -0,0 +1,89 @@
+import json
+import logging
+import pathlib
+import numpy as np
+import pandas as pd
+# custom scripts
+import helpers
+import audio_cache
+import silence
+
+
+# Envelope resolution: 1500 buckets of (min, max) float32 are 12 KB per chapter
+ENVELOPE_BUCKETS = 1500
+
+
+def chapter_wav(chapter: str) -> pathlib.Path:
+    return helpers.AUDIO_PATH/f"2_edits/{chapter}.wav"
+
+
+def envelope(wav: pathlib.Path, buckets: int=ENVELOPE_BUCKETS, cache: audio_cache.AudioCache=None) -> pd.DataFrame:
+    """
+    Downsampled waveform of a chapter: one row per bucket with its time (`t`, seconds) and its
+    `min` / `max` sample. Computed once by min/max decimation and cached by the AudioCache.
+    """
+    cache = cache if cache is not None else audio_cache.AudioCache()
+    info = cache.info(wav)
+    peaks = cache.peaks(wav, buckets)
+    per_bucket = max(1, -(-info["nframes"] // buckets))
+    first_frame = np.arange(buckets) * per_bucket
+    t = (first_frame + per_bucket / 2) / info["framerate"]
+    # Short files have fewer frames than buckets
+    keep = first_frame < info["nframes"]
+    return pd.DataFrame({"t": t[keep], "min": peaks[keep, 0], "max": peaks[keep, 1]})
+
+
+def split_segments(chapter: str) -> list[tuple[dict, tuple[float, float]]]:
+    """
+    `(csv range, (start_s, end_s))` of each split of a chapter, when its split rules have exactly one
+    audio segment per csv range. Empty list otherwise (e.g. the audio is split more finely than the csv).
+    """
+    rules = json.load(open(helpers.BASE_PATH/"0_data_manip_cfg/split_rules.json", "r"))
+    rule = next((r for r in rules if r["source"] == chapter), None)
+    if rule is None or len(rule["ranges"]) != len(rule["timestamps"]) + 1:
+        return []
+
+    points = [0.0] + [silence.time_to_seconds(t) for t in rule["timestamps"]] + [np.inf]
+    return [(r, (points[i], points[i + 1])) for i, r in enumerate(rule["ranges"])]
+
+
+def _in_range(df: pd.DataFrame, r: dict) -> np.ndarray:
+    dialogues = df["dialogue_index"].to_numpy()
+    lines = df["line_index"].to_numpy()
+    after_start = (dialogues > r["dial_s"]) | ((dialogues == r["dial_s"]) & (lines >= r["line_s"]))
+    if r["dial_e"] == -1 and r["line_e"] == -1:
+        return after_start
+    before_end = (dialogues < r["dial_e"]) | ((dialogues == r["dial_e"]) & (lines <= r["line_e"]))
+    return after_start & before_end
+
+
+def line_times(df: pd.DataFrame, duration_s: float, segments: list[tuple[dict, tuple[float, float]]]=None) -> pd.DataFrame:
+    """
+    Estimated `start_s` / `end_s` of every line. Lines have no timestamps: each segment of audio is
+    shared between its lines proportionally to their length in characters. Without segments, the
+    whole chapter is a single segment.
+    """
+    df = df.sort_values(["dialogue_index", "line_index"], kind="stable").reset_index(drop=True)
+    # A few characters minimum: short interjections still take some time
+    weights = np.maximum(df["line"].fillna("").astype(str).str.len().to_numpy(dtype=np.float64), 10)
+
+    starts = np.full(len(df), np.nan)
+    ends = np.full(len(df), np.nan)
+    if not segments:
+        segments = [(None, (0.0, duration_s))]
+
+    for r, (seg_start, seg_end) in segments:
+        mask = np.ones(len(df), dtype=bool) if r is None else _in_range(df, r)
+        if not mask.any():
+            continue
+        seg_end = min(seg_end, duration_s)
+        cum = np.cumsum(weights[mask])
+        scale = (seg_end - seg_start) / cum[-1]
+        ends[mask] = seg_start + cum * scale
+        starts[mask] = ends[mask] - weights[mask] * scale
+
+    if np.isnan(starts).any():
+        logging.warning(f"{int(np.isnan(starts).sum())} lines are outside of the split ranges and have no time")
+    df["start_s"] = starts
+    df["end_s"] = ends
+    return df
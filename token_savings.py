@@ -0,0 +1,102 @@
+import argparse
+import logging
+import textwrap
+import pandas as pd
+# custom scripts
+import stability
+import transcript
+from classifier import Classifier
+from planner import count_tokens
+
+
+def measured_savings(chapters: list[str]) -> pd.DataFrame:
+    """
+    Token usage per chapter and transcript encoding, from the `usage` stored in `api_responses`.
+    Tokens are normalised per scored line, since runs can classify different splits.
+    `text_saving_pct` compares the text tokens per line with the `full` encoding of the same chapter.
+    """
+    rows = []
+    for chapter in chapters:
+        usage = stability.load_chapter_usage(chapter)
+        usage = usage[usage["lines"] > 0]
+        for encoding, g in usage.groupby("transcript_encoding"):
+            rows.append({
+                "chapter": chapter,
+                "transcript_encoding": encoding,
+                "runs": len(g),
+                "requests": int(g["requests"].sum()),
+                "lines": int(g["lines"].sum()),
+                "text_tokens_per_line": g["text_tokens"].sum() / g["lines"].sum(),
+                "audio_tokens_per_line": g["audio_tokens"].sum() / g["lines"].sum(),
+                "cached_share": g["cached_tokens"].sum() / max(g["prompt_tokens"].sum(), 1),
+            })
+
+    df = pd.DataFrame(rows, columns=[
+        "chapter", "transcript_encoding", "runs", "requests", "lines",
+        "text_tokens_per_line", "audio_tokens_per_line", "cached_share"
+    ])
+    baseline = df[df["transcript_encoding"] == "full"].set_index("chapter")["text_tokens_per_line"]
+    df["text_saving_pct"] = 100 * (1 - df["text_tokens_per_line"] / df["chapter"].map(baseline))
+    return df
+
+
+def estimated_savings(classifier: Classifier, max_line_chars: int=None) -> pd.DataFrame:
+    """
+    Text tokens of the current splits of each chapter, system message included, when sent
+    with the `full` and the `compact` encoding. Needs no API call.
+    """
+    system_tokens = count_tokens(classifier.system_message)
+    rows = []
+    for pair in classifier.pairs:
+        full = compact = lines = 0
+        for _, csv_file, _ in pair:
+            df = transcript.read_transcript(csv_file)
+            lines += len(df)
+            full += system_tokens + count_tokens(classifier.prep_dialogue(df.copy(), encoding="full"))
+            compact += system_tokens + count_tokens(classifier.prep_dialogue(df.copy(), encoding="compact", max_line_chars=max_line_chars))
+        rows.append({"chapter": pair.chapter, "splits": len(pair), "lines": lines, "full_tokens": full, "compact_tokens": compact})
+
+    df = pd.DataFrame(rows, columns=["chapter", "splits", "lines", "full_tokens", "compact_tokens"])
+    df["saving_pct"] = 100 * (1 - df["compact_tokens"] / df["full_tokens"])
+    return df
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(
+            """
+            Token savings of the compact transcript encoding (classifier.py --transcript-encoding compact).
+
+            By default, compares the text tokens per line measured in 'output/api_responses' for each
+            encoding, with the share of cached prompt tokens. With --estimate, counts the tokens of the
+            current splits in both encodings instead (with tiktoken when installed, ~4 chars per token otherwise).
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--chapters", nargs="*", help="Only these chapters (folder names)")
+    parser.add_argument("--estimate", action="store_true", help="Estimate the savings on the current splits, without API responses")
+    parser.add_argument("--max-line-chars", type=int, metavar="N", help="Truncation of the lines in the compact estimate")
+    args = parser.parse_args()
+
+    classifier = Classifier()
+    if args.chapters:
+        classifier.set_chapters(args.chapters)
+    chapters = [p.chapter for p in classifier.pairs]
+
+    if args.estimate:
+        df = estimated_savings(classifier, args.max_line_chars)
+        total_saving = 100 * (1 - df["compact_tokens"].sum() / df["full_tokens"].sum())
+    else:
+        df = measured_savings(chapters)
+        compact = df[df["transcript_encoding"] == "compact"].dropna(subset=["text_saving_pct"])
+        total_saving = (compact["text_saving_pct"] * compact["lines"]).sum() / compact["lines"].sum() if not compact.empty else None
+
+    with pd.option_context("display.max_rows", None, "display.width", 200, "display.float_format", "{:.2f}".format):
+        print(df.to_string(index=False))
+    if total_saving is None:
+        print("\nNo chapter has both a full and a compact run yet: use --estimate")
+    else:
+        print(f"\nText tokens saved: {total_saving:.1f}%")
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+from typing import Iterable
+# custom scripts
+import helpers
+
+
+TRANSCRIPT_COLUMNS = ["chapter_index", "chapter", "dialogue_index", "line_index", "speaker", "line"]
+INDEX_COLUMNS = ["chapter_index", "dialogue_index", "line_index"]
+CATEGORY_COLUMNS = ["chapter", "speaker"]
+
+# Optional dependency: pyarrow (a dependency of streamlit, see requirements.txt) stores the lines
+# as Arrow strings, in one buffer per column instead of a Python object per line
+try:
+    import pyarrow  # noqa: F401
+    LINE_DTYPE = pd.StringDtype("pyarrow")
+except ImportError:
+    # Same API, lines are stored as python objects
+    LINE_DTYPE = pd.StringDtype("python")
+
+
+def compact(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts the transcript columns of `df` to the compact model: int32 indices, categorical
+    chapter and speaker (one string table per column, rows hold integer codes) and a string line.
+    Other columns (emotions, ids...) are left as they are. The input DataFrame is modified in place.
+    """
+    for c in INDEX_COLUMNS:
+        # Indices with missing values (e.g. after an outer merge) can't be int32
+        if c in df.columns and not df[c].isna().any():
+            df[c] = df[c].astype(np.int32)
+    for c in CATEGORY_COLUMNS:
+        if c in df.columns and not isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype("category")
+    if "line" in df.columns:
+        df["line"] = df["line"].astype(LINE_DTYPE)
+    return df
+
+
+def read_transcript(path_or_buffer, **kwargs) -> pd.DataFrame:
+    """Reads a transcript csv (raw, edited, split or scored) straight into the compact model"""
+    dtype = {c: "category" for c in CATEGORY_COLUMNS}
+    dtype["line"] = LINE_DTYPE
+    dtype.update(kwargs.pop("dtype", {}))
+    if hasattr(path_or_buffer, "as_posix"):
+        path_or_buffer = path_or_buffer.as_posix()
+
+    df = pd.read_csv(path_or_buffer, dtype=dtype, **helpers.CSV_SETTINGS, **kwargs)
+    return compact(df)
+
+
+def from_dialogues(dialogues: list[list], chapter_index: int, chapter: str) -> pd.DataFrame:
+    """
+    Builds a chapter from nested `[dialogue_index, line_index, speaker, line]` rows.
+    The chapter title is stored once, as the only category of the `chapter` column.
+    """
+    rows = [row for dialogue in dialogues for row in dialogue]
+    dialogue_index, line_index, speaker, line = zip(*rows) if rows else ([], [], [], [])
+
+    df = pd.DataFrame({
+        "chapter_index": np.full(len(rows), chapter_index, dtype=np.int32),
+        "chapter": pd.Categorical.from_codes(np.zeros(len(rows), dtype=np.int8), categories=[chapter]),
+        "dialogue_index": np.array(dialogue_index, dtype=np.int32),
+        "line_index": np.array(line_index, dtype=np.int32),
+        "speaker": pd.Categorical(speaker),
+        "line": pd.array(line, dtype=LINE_DTYPE),
+    })
+    return df
+
+
+def concat(frames: Iterable[pd.DataFrame], ignore_index: bool=True) -> pd.DataFrame:
+    """
+    Concatenates transcripts keeping the categorical columns: the string tables are merged instead of
+    falling back to object columns when the chapters have different speakers.
+    With `ignore_index=False`, rows keep the index of their frame (e.g. their row in the chapter file).
+    """
+    frames = [f for f in frames]
+    if not frames:
+        return pd.DataFrame(columns=TRANSCRIPT_COLUMNS)
+
+    categories = {}
+    for c in CATEGORY_COLUMNS:
+        if all(c in f.columns for f in frames):
+            categories[c] = pd.api.types.union_categoricals(
+                [f[c].astype("category") for f in frames], ignore_order=True
+            ).categories
+
+    aligned = []
+    for f in frames:
+        f = f.copy(deep=False)
+        for c, cats in categories.items():
+            f[c] = pd.Categorical(f[c], categories=cats)
+        aligned.append(f)
+
+    return compact(pd.concat(aligned, ignore_index=ignore_index))
+
+
+def speaker_mask(df: pd.DataFrame, speakers: Iterable[str]) -> np.ndarray:
+    """Boolean mask of the rows spoken by `speakers`, evaluated on the integer codes"""
+    speaker = df["speaker"]
+    if not isinstance(speaker.dtype, pd.CategoricalDtype):
+        return speaker.isin(list(speakers)).to_numpy()
+    wanted = speaker.cat.categories.isin(list(speakers))
+    codes = speaker.cat.codes.to_numpy()
+    return (codes >= 0) & wanted[codes]
+
+
+def memory_usage(df: pd.DataFrame) -> int:
+    """Bytes held by `df`, including the strings"""
+    return int(df.memory_usage(deep=True).sum())
@@ -2,8 +2,15 @@ import pathlib
 import streamlit as st
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 # custom scripts
 import helpers
+import audio_cache
+import comparison
+import query
+import taxonomy
+import timeline
+import transcript
 
 
 st.title("Emotion Classification Inspector")
@@ -11,15 +18,8 @@ st.set_page_config(
     page_title="Emotion Classification Inspector",
     layout="wide"
 )
-COLOR_MAP = {
-    "neutral": "#818181",
-    "anger": "#dd0b27",
-    "sadness": "#128cbc",
-    "fear": "#a3cc3f",
-    "happiness": "#f0f011",
-    "surprise": "#e242df",
-    "ambitious": "#302C2C"
-}
+# Colors of the emotions of every taxonomy, see 'taxonomy.json'
+COLOR_MAP = taxonomy.colors()
 
 def custom_file_loader(key:str, options:list[pathlib.Path], chapter:str=None, **kwargs) -> dict:
     col1, col2 = st.columns([0.8, 0.2])
@@ -47,12 +47,59 @@ def custom_file_loader(key:str, options:list[pathlib.Path], chapter:str=None, **
 
 # Inspect vs Compare mode: inspect a single dataframe
 # or compare one to another
-mode = st.segmented_control("asdf", ["Inspect", "Compare"], key="mode_select", default="Inspect",
+mode = st.segmented_control("asdf", ["Inspect", "Compare", "Speaker"], key="mode_select", default="Inspect",
                             selection_mode="single", label_visibility="collapsed")
 if "mode" not in st.session_state or st.session_state["mode"] != mode:
     st.session_state["mode"] = mode
 mode = st.session_state["mode"]
 
+
+@st.cache_resource
+def load_emotion_index(source: pathlib.Path, source_mtime_ns: int) -> query.EmotionIndex:
+    # The mtime is part of the cache key: a new result file builds a new index
+    return query.EmotionIndex.open(source)
+
+# Speaker mode: emotional arc of a speaker across the whole story, from the latest result file
+if mode == "Speaker":
+    try:
+        result_path = query.latest_result()
+    except FileNotFoundError as e:
+        st.warning(str(e))
+        st.stop()
+    index = load_emotion_index(result_path, result_path.stat().st_mtime_ns)
+    st.caption(f"Source: {result_path.name}")
+
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        speaker = st.selectbox("Speaker", index.speakers()["speaker"].to_list())
+    with col2:
+        emotions = st.multiselect("Emotions", index.emotions, default=[e for e in index.emotions if e != "neutral"])
+    with col3:
+        by = st.selectbox("Group by", ["chapter", "act", "dialogue"])
+    with col4:
+        act = st.selectbox("Act", [None, 1, 2, 3], format_func=lambda a: "All" if a is None else f"Act {a}")
+
+    if speaker and emotions:
+        arc_df = index.arc(speaker, emotions=emotions, by=by, act=act)
+        x = "act" if by == "act" else "chapter_index"
+        if by == "dialogue":
+            arc_df["x"] = arc_df["chapter_index"].astype(str) + "_" + arc_df["dialogue_index"].astype(str)
+            x = "x"
+        st.write(f"### Arc of {speaker}")
+        st.line_chart(arc_df, x=x, y=emotions, color=[COLOR_MAP.get(e, "#B3B3B3") for e in emotions])
+
+        col1, col2 = st.columns(2)
+        with col1:
+            emotion = st.selectbox("Emotion", emotions)
+            window = st.slider("Rolling window (lines)", 1, 100, 20)
+            rolling_df = index.rolling(emotion, window=window, speaker=speaker, act=act).reset_index()
+            st.line_chart(rolling_df, x="index", y=f"{emotion}_rolling", color=COLOR_MAP.get(emotion, "#B3B3B3"))
+        with col2:
+            st.write(f"Most intense lines ({emotion})")
+            top_df = index.top(emotion, k=10, speaker=speaker, act=act)
+            st.dataframe(top_df[["chapter", "dialogue_index", "line_index", emotion, "line"]], hide_index=True)
+    st.stop()
+
 col_no = 2
 if mode == "Compare":
     col_no = 3
@@ -87,12 +134,12 @@ with columns[1]:
 # Select second file (comparison)
 try:
     with columns[2]:
-        comparison = custom_file_loader(
+        comparison_file = custom_file_loader(
             key="Comparison file",
             options=classified_csvs,
             format_func=fmt_func
         )
-        comparison_csv_path = comparison["selection"]
+        comparison_csv_path = comparison_file["selection"]
 except IndexError:
     pass
 
@@ -108,10 +155,7 @@ st.divider()
 
 # Load data, audio and plot
 def load_dataframe(path_or_buffer):
-    if isinstance(path_or_buffer, pathlib.Path):
-        df: pd.DataFrame = pd.read_csv(path_or_buffer.as_posix(), **helpers.CSV_SETTINGS)
-    else:
-        df: pd.DataFrame = pd.read_csv(path_or_buffer, **helpers.CSV_SETTINGS)
+    df: pd.DataFrame = transcript.read_transcript(path_or_buffer)
     df["id"] = df["dialogue_index"].astype(str) + "_" + df["line_index"].astype(str)
 
     return df
@@ -130,15 +174,64 @@ def barchart(df: pd.DataFrame, title:str=None):
         y=emotions,
     )
 
-def audio_player(path):
+@st.cache_resource
+def get_audio_cache() -> audio_cache.AudioCache:
+    return audio_cache.AudioCache()
+
+def audio_player(path, start_time: float=0):
     if path:
+        try:
+            # Serve the MP3 encoded once in the audio cache instead of the full WAV
+            path = get_audio_cache().chapter_mp3(path)
+        except Exception:
+            pass
         try:
             _, audio_col, _ = st.columns([3, 2, 3])
             with audio_col:
-                st.audio(path)
+                st.audio(path, start_time=int(start_time))
         except:
             pass
 
+@st.cache_data
+def load_envelope(wav: pathlib.Path, wav_mtime_ns: int) -> tuple[pd.DataFrame, float]:
+    # Only the cached peaks (a few KB) are loaded, not the audio
+    envelope = timeline.envelope(wav, cache=get_audio_cache())
+    return envelope, get_audio_cache().info(wav)["duration_s"]
+
+def timeline_chart(df: pd.DataFrame, envelope: pd.DataFrame, selected_ids: pd.Series=None):
+    """Per-line emotion scores (step lines) over the chapter waveform, on the same time axis"""
+    emotions = [c for c in df.columns.to_list() if c in COLOR_MAP.keys()]
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=envelope["t"], y=envelope["max"], mode="lines", line={"width": 0, "color": "#B3B3B3"},
+        hoverinfo="skip", showlegend=False, yaxis="y2"
+    ))
+    fig.add_trace(go.Scatter(
+        x=envelope["t"], y=envelope["min"], mode="lines", line={"width": 0, "color": "#B3B3B3"},
+        fill="tonexty", name="waveform", hoverinfo="skip", yaxis="y2"
+    ))
+
+    hover = df["id"] + " | " + df["speaker"].astype(str) + ": " + df["line"].astype(str).str.slice(0, 80)
+    for e in emotions:
+        fig.add_trace(go.Scatter(
+            x=df["start_s"], y=df[e], mode="lines", line={"shape": "hv", "color": COLOR_MAP[e]},
+            name=e, text=hover, hovertemplate="%{text}<br>%{y:.2f}"
+        ))
+    if selected_ids is not None:
+        shown = df[df["id"].isin(selected_ids)]
+        if not shown.empty:
+            fig.add_vrect(x0=shown["start_s"].min(), x1=shown["end_s"].max(), fillcolor="#818181", opacity=0.15, line_width=0)
+
+    fig.update_layout(
+        xaxis={"title": "time (s)"},
+        yaxis={"title": "score", "range": [0, 1.05]},
+        yaxis2={"overlaying": "y", "visible": False, "range": [-1, 1]},
+        height=350,
+        margin={"t": 20, "b": 20},
+        hovermode="x unified"
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
 def filters(df):
     _, col, _ = st.columns([4, 2, 4])
     # Dialogues filter
@@ -169,11 +262,30 @@ if load_data_btn or st.session_state["load"]:
 
     if mode == "Inspect":
         if selection_csv_path:
-            # Audio player
-            audio_player(selection_audio_path)
-
             df = load_dataframe(selection_csv_path)
+
+            # Waveform timeline: only when the chapter audio is available
+            envelope = None
+            if selection_audio_path is not None and selection_audio_path.exists():
+                try:
+                    envelope, duration_s = load_envelope(selection_audio_path, selection_audio_path.stat().st_mtime_ns)
+                except Exception:
+                    st.info("The chapter audio can't be decoded: timeline not available")
+            if envelope is not None:
+                df = timeline.line_times(df, duration_s, timeline.split_segments(selected_chapter.stem))
+
+            # Audio player, starting from the selected line
+            start_time = 0
+            if envelope is not None:
+                _, play_col, _ = st.columns([3, 2, 3])
+                with play_col:
+                    play_from = st.selectbox("Play from line", df["id"].to_list(), key="play_from")
+                start_time = df.loc[df["id"] == play_from, "start_s"].fillna(0).iloc[0] if play_from else 0
+            audio_player(selection_audio_path, start_time=start_time)
+
             filters_mask = filters(df)
+            if envelope is not None:
+                timeline_chart(df, envelope, selected_ids=df.loc[filters_mask, "id"])
             df = df[filters_mask]
 
             col1, col2 = st.columns(2)
@@ -194,10 +306,34 @@ if load_data_btn or st.session_state["load"]:
             audio_player(selection_audio_path)
 
             selection_df = load_dataframe(selection_csv_path)
+            comparison_df = load_dataframe(comparison_csv_path)
+            if isinstance(selection_csv_path, pathlib.Path) and isinstance(comparison_csv_path, pathlib.Path):
+                metrics_df, summary_df = comparison.compare_files(selection_csv_path, comparison_csv_path)
+            else:
+                aligned_df = comparison.align(selection_df, comparison_df)
+                metrics_df = comparison.line_metrics(selection_df, comparison_df, aligned_df)
+                summary_df = comparison.summary(selection_df, comparison_df, metrics_df, aligned_df)
+
+            # Agreement summary
+            if summary_df.empty:
+                st.warning("The selection and the comparison have no lines in common")
+                st.stop()
+            summary_row = summary_df.iloc[0]
+            kpi_cols = st.columns(5)
+            kpi_cols[0].metric("Lines compared", int(summary_row["lines_compared"]))
+            kpi_cols[1].metric("Argmax agreement", f"{summary_row['argmax_agreement']:.0%}")
+            kpi_cols[2].metric("Mean L1", f"{summary_row['mean_l1']:.3f}")
+            kpi_cols[3].metric("Mean cosine distance", f"{summary_row['mean_cosine']:.3f}")
+            kpi_cols[4].metric(
+                "Unmatched lines",
+                int(summary_row["only_in_selection"] + summary_row["only_in_comparison"])
+            )
 
-            # Filters
+            # Filters: applied by line id, so runs with different rows stay aligned
             filters_mask = filters(selection_df)
             selection_df = selection_df[filters_mask]
+            comparison_df = comparison_df[comparison_df["id"].isin(selection_df["id"])]
+            metrics_df = metrics_df[metrics_df["id"].isin(selection_df["id"])]
 
             col1, col2 = st.columns(2)
             with col1:
@@ -205,8 +341,6 @@ if load_data_btn or st.session_state["load"]:
                 barchart(selection_df, title="Selection")
 
                 # Comparison chart
-                comparison_df = load_dataframe(comparison_csv_path)
-                comparison_df = comparison_df[filters_mask]
                 barchart(comparison_df, title="Comparison")
 
             # Dialogues table
@@ -215,3 +349,32 @@ if load_data_btn or st.session_state["load"]:
                 show_columns = ["id", "speaker", "line"]
                 subs_df = selection_df[show_columns]
                 st.dataframe(subs_df, hide_index=True, key="table", height=700)
+
+            # Disagreement table: sort by a metric and jump to a line
+            st.divider()
+            st.write("### Disagreements")
+            sort_col, jump_col = st.columns([0.3, 0.7])
+            with sort_col:
+                sort_by = st.selectbox("Sort by", ["l1", "cosine", "argmax_agree"], key="disagreement_sort")
+            metrics_df = metrics_df.sort_values(sort_by, ascending=(sort_by == "argmax_agree"))
+
+            with jump_col:
+                jump_to = st.selectbox(
+                    "Jump to line",
+                    metrics_df["id"].to_list(),
+                    key="disagreement_jump"
+                )
+
+            col1, col2 = st.columns(2)
+            with col1:
+                show_columns = ["id", "speaker", "dominant_sel", "dominant_cmp", "l1", "cosine", "line"]
+                st.dataframe(metrics_df[show_columns], hide_index=True, key="disagreements", height=400)
+
+            with col2:
+                if jump_to:
+                    line_df = pd.concat([
+                        selection_df[selection_df["id"] == jump_to].assign(id="Selection"),
+                        comparison_df[comparison_df["id"] == jump_to].assign(id="Comparison"),
+                    ])
+                    line_row = selection_df[selection_df["id"] == jump_to].iloc[0]
+                    barchart(line_df, title=f"**{jump_to}** | {line_row['speaker']}: {line_row['line']}")
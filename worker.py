@@ -0,0 +1,399 @@
+import os
+import time
+import pathlib
+import socket
+import sqlite3
+import logging
+import argparse
+import textwrap
+import multiprocessing
+from typing import Optional
+# custom scripts
+import helpers
+import catalog
+import journal
+from classifier import Classifier, ClassificationStatus, TRANSCRIPT_ENCODINGS, parse_selection
+
+
+QUEUE_PATH = helpers.BASE_PATH/"output/queue.sqlite"
+DEFAULT_LEASE_S = 900
+DEFAULT_MAX_ATTEMPTS = 3
+# Retries wait RETRY_BASE_S * 2^(attempts - 1)
+RETRY_BASE_S = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    run_id TEXT NOT NULL,
+    chapter TEXT NOT NULL,
+    split INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    last_error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (run_id, chapter, split)
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, available_at);
+CREATE TABLE IF NOT EXISTS chapters (
+    run_id TEXT NOT NULL,
+    chapter TEXT NOT NULL,
+    finalized INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (run_id, chapter)
+);
+"""
+
+
+class WorkQueue(object):
+    """
+    Durable queue of split classification jobs, in a SQLite database shared by every worker process.
+
+    A job is `(run_id, chapter, split)`. Workers lease a job for `lease_s` seconds: if the worker dies,
+    the lease expires and another worker takes the job. Failed jobs are retried with an exponential
+    backoff, up to `max_attempts` times. Results are not stored in the queue but in the run's journal.
+    """
+    def __init__(self, path: pathlib.Path=None):
+        self.path = path if path is not None else QUEUE_PATH
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(self.path.as_posix(), timeout=30, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        # Rollback journal rather than WAL: WAL needs shared memory between the processes, which
+        # doesn't work when the workers are on several machines sharing the data folder
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.executescript(SCHEMA)
+
+    def _transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def enqueue(self, run_id: str, selection: dict[str, list[int]], max_attempts: int=DEFAULT_MAX_ATTEMPTS) -> int:
+        now = time.time()
+        rows = [(run_id, chapter, i, max_attempts, now, now) for chapter, splits in selection.items() for i in splits]
+        conn = self._transaction()
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO jobs (run_id, chapter, split, max_attempts, available_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO chapters (run_id, chapter) VALUES (?, ?)",
+                [(run_id, chapter) for chapter in selection]
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    def lease(self, owner: str, lease_s: float=DEFAULT_LEASE_S) -> Optional[sqlite3.Row]:
+        """
+        Leases the oldest available job: pending, or leased with an expired lease. None if there is none.
+        Expired jobs that already used all their attempts are marked failed instead.
+        """
+        now = time.time()
+        conn = self._transaction()
+        try:
+            expired = conn.execute(
+                """
+                UPDATE jobs SET status = 'failed', lease_expires = NULL, last_error = 'lease expired', updated_at = ?
+                WHERE status = 'leased' AND lease_expires <= ? AND attempts >= max_attempts
+                """,
+                (now, now)
+            ).rowcount
+            if expired:
+                logging.warning(f"{expired} jobs failed: their lease expired after their last attempt")
+            job = conn.execute(
+                """
+                SELECT * FROM jobs
+                WHERE (status = 'pending' AND available_at <= ?) OR (status = 'leased' AND lease_expires <= ?)
+                ORDER BY available_at, run_id, chapter, split
+                LIMIT 1
+                """,
+                (now, now)
+            ).fetchone()
+            if job is not None:
+                conn.execute(
+                    """
+                    UPDATE jobs SET status = 'leased', attempts = attempts + 1, lease_owner = ?, lease_expires = ?, updated_at = ?
+                    WHERE run_id = ? AND chapter = ? AND split = ?
+                    """,
+                    (owner, now + lease_s, now, job["run_id"], job["chapter"], job["split"])
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return job
+
+    def _update(self, job: sqlite3.Row, owner: str, sql: str, params: tuple) -> bool:
+        # Only the current lease owner can update a job: a worker whose lease expired loses it
+        cur = self.conn.execute(
+            f"UPDATE jobs SET {sql}, updated_at = ? WHERE run_id = ? AND chapter = ? AND split = ? AND lease_owner = ?",
+            params + (time.time(), job["run_id"], job["chapter"], job["split"], owner)
+        )
+        return cur.rowcount == 1
+
+    def complete(self, job: sqlite3.Row, owner: str) -> bool:
+        return self._update(job, owner, "status = 'done', lease_expires = NULL, last_error = NULL", ())
+
+    def fail(self, job: sqlite3.Row, owner: str, error: str) -> bool:
+        attempts = job["attempts"] + 1
+        if attempts >= job["max_attempts"]:
+            return self._update(job, owner, "status = 'failed', lease_expires = NULL, last_error = ?", (error,))
+        retry_at = time.time() + RETRY_BASE_S * 2 ** (attempts - 1)
+        return self._update(
+            job, owner, "status = 'pending', lease_expires = NULL, available_at = ?, last_error = ?", (retry_at, error)
+        )
+
+    def claim_finalization(self, run_id: str, chapter: str) -> bool:
+        """True for exactly one caller, once every split of the chapter is done"""
+        conn = self._transaction()
+        try:
+            remaining = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE run_id = ? AND chapter = ? AND status != 'done'", (run_id, chapter)
+            ).fetchone()[0]
+            claimed = 0
+            if remaining == 0:
+                claimed = conn.execute(
+                    "UPDATE chapters SET finalized = 1 WHERE run_id = ? AND chapter = ? AND finalized = 0", (run_id, chapter)
+                ).rowcount
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return claimed == 1
+
+    def release_finalization(self, run_id: str, chapter: str):
+        """Lets the chapter be finalized again, after its outputs failed to be written"""
+        self.conn.execute("UPDATE chapters SET finalized = 0 WHERE run_id = ? AND chapter = ?", (run_id, chapter))
+
+    def completed_chapters(self, run_id: str=None) -> list[sqlite3.Row]:
+        """Chapters whose splits are all done, finalized or not"""
+        sql = """
+            SELECT run_id, chapter, finalized FROM chapters c
+            WHERE NOT EXISTS (SELECT 1 FROM jobs j WHERE j.run_id = c.run_id AND j.chapter = c.chapter AND j.status != 'done')
+        """
+        params = ()
+        if run_id:
+            sql += " AND run_id = ?"
+            params += (run_id,)
+        return self.conn.execute(sql, params).fetchall()
+
+    def requeue_failed(self, run_id: str=None) -> int:
+        sql = "UPDATE jobs SET status = 'pending', attempts = 0, available_at = ?, updated_at = ? WHERE status = 'failed'"
+        params = (time.time(), time.time())
+        if run_id:
+            sql += " AND run_id = ?"
+            params += (run_id,)
+        return self.conn.execute(sql, params).rowcount
+
+    def counts(self) -> list[sqlite3.Row]:
+        return self.conn.execute(
+            "SELECT run_id, status, COUNT(*) AS jobs FROM jobs GROUP BY run_id, status ORDER BY run_id, status"
+        ).fetchall()
+
+    def pending(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'leased')").fetchone()[0]
+
+
+def unclassified_selection(pairs: list) -> dict[str, list[int]]:
+    """Every split of the chapters that have never been classified (not those whose status failed)"""
+    status = ClassificationStatus(pairs).load()
+    return {p.chapter: list(p.csv.indices) for p in pairs if not status[p.chapter]["classified"] and not status[p.chapter].get("failed")}
+
+
+def finalize(queue: WorkQueue, classifier: Classifier, run: journal.RunJournal, chapter: str, owner: str) -> bool:
+    """
+    Writes the outputs of a chapter whose splits are all done, when this caller claims its finalization.
+    On failure the claim is released, so that `requeue` can write them again.
+    """
+    if not queue.claim_finalization(run.run_id, chapter):
+        return False
+    try:
+        splits = run.read_selection()[chapter]
+        responses = [run.load_response(chapter, i) for i in splits]
+        frames = [run.load_frame(chapter, i) for i in splits]
+        logging.info(f"[{owner}] Writing outputs of {chapter} for run '{run.run_id}'")
+        classifier.write_outputs(responses, frames, chapter, fname=run.run_id)
+    except Exception:
+        logging.exception(f"[{owner}] Writing outputs of {chapter} for run '{run.run_id}' failed, use 'requeue' to retry")
+        queue.release_finalization(run.run_id, chapter)
+        return False
+    return True
+
+
+def missing_outputs(queue: WorkQueue, run_id: str=None) -> list[sqlite3.Row]:
+    """Completed chapters without their outputs: their finalization failed or their worker died while writing them"""
+    return [
+        row for row in queue.completed_chapters(run_id)
+        if not all(p.exists() for p in Classifier.output_paths(row["chapter"], row["run_id"]))
+    ]
+
+
+def work(queue_path: pathlib.Path=None, lease_s: float=DEFAULT_LEASE_S, max_jobs: int=None, wait: bool=False, poll_s: float=10,
+         classifier_options: dict=None):
+    """
+    Worker loop: leases split jobs until the queue is drained (or `max_jobs` are done), classifies them
+    into their run's journal, and writes the chapter outputs once all the splits of a chapter are done.
+    With `wait`, keeps polling for new jobs instead of exiting when the queue is empty.
+    `classifier_options` are passed to the Classifier (transcript encoding, prompt cache key, taxonomy).
+    """
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    queue = WorkQueue(queue_path)
+    classifier = Classifier(**(classifier_options or {}))
+    classifier.authorize()
+    journals: dict[str, journal.RunJournal] = {}
+    done = 0
+
+    while max_jobs is None or done < max_jobs:
+        job = queue.lease(owner, lease_s)
+        if job is None:
+            if wait or queue.pending() > 0:
+                # Jobs waiting for a retry or leased by another worker
+                time.sleep(poll_s)
+                continue
+            break
+
+        run_id, chapter, split = job["run_id"], job["chapter"], job["split"]
+        logging.info(f"[{owner}] Leased {chapter} #{split} of run '{run_id}' (attempt {job['attempts'] + 1})")
+        try:
+            if run_id not in journals:
+                classifier.check_taxonomy(run_id)
+                journals[run_id] = journal.RunJournal.open(run_id)
+            classifier.journal = journals[run_id]
+            entry = classifier.catalog.get(chapter, split)
+            classifier.classify_split(chapter, split, entry["csv"], entry["mp3"])
+        except Exception as e:
+            logging.exception(f"[{owner}] {chapter} #{split} failed")
+            queue.fail(job, owner, repr(e))
+            continue
+
+        if not queue.complete(job, owner):
+            logging.warning(f"[{owner}] Lease of {chapter} #{split} expired before completion: another worker took it")
+            continue
+        done += 1
+
+        finalize(queue, classifier, classifier.journal, chapter, owner)
+
+    logging.info(f"[{owner}] Exiting after {done} jobs")
+
+
+def _work_process(kwargs: dict):
+    logging.basicConfig(level=logging.INFO)
+    work(**kwargs)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(
+            """
+            Headless classification: split jobs are queued in a SQLite database ('output/queue.sqlite')
+            and drained by worker processes, on one or several machines sharing the data folder.
+            The OpenAI key is read from $OPENAI_API_KEY, or from 'open_ai_token.txt'.
+
+            Examples:
+                python worker.py enqueue --unclassified
+                python worker.py enqueue --select 13_Sirene 19_The_Reacher:0,1
+                python worker.py work --workers 4
+                python worker.py status
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--queue", type=pathlib.Path, help="Queue database (default: output/queue.sqlite)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="Create a run and queue its splits")
+    selection_group = enqueue_parser.add_mutually_exclusive_group(required=True)
+    selection_group.add_argument("--select", nargs="+", metavar="CHAPTER[:SPLITS]", help="Chapters and splits, as in classifier.py")
+    selection_group.add_argument("--unclassified", action="store_true", help="Every chapter without any classification run")
+    enqueue_parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS)
+    enqueue_parser.add_argument("--ignore-integrity", action="store_true", help="As in classifier.py")
+    enqueue_parser.add_argument("--taxonomy", help="As in classifier.py")
+
+    work_parser = subparsers.add_parser("work", help="Drain the queue")
+    work_parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    work_parser.add_argument("--lease", type=float, default=DEFAULT_LEASE_S, help="Seconds before a job of a dead worker is retried")
+    work_parser.add_argument("--max-jobs", type=int, help="Exit after this many jobs (per worker)")
+    work_parser.add_argument("--wait", action="store_true", help="Keep polling for new jobs instead of exiting when the queue is empty")
+    work_parser.add_argument("--transcript-encoding", choices=TRANSCRIPT_ENCODINGS, default="full", help="As in classifier.py")
+    work_parser.add_argument("--max-line-chars", type=int, metavar="N", help="As in classifier.py")
+    work_parser.add_argument("--prompt-cache-key", help="As in classifier.py")
+    work_parser.add_argument("--structured-output", action="store_true", help="As in classifier.py")
+    work_parser.add_argument("--taxonomy", help="As in classifier.py, the one of the queued runs")
+
+    subparsers.add_parser("status", help="Jobs per run and status")
+    requeue_parser = subparsers.add_parser(
+        "requeue", help="Queue the failed jobs again, and write the missing outputs of the completed chapters"
+    )
+    requeue_parser.add_argument("--run", help="Only the failed jobs of this run")
+    args = parser.parse_args()
+
+    if args.command == "enqueue":
+        try:
+            classifier = Classifier(taxonomy_name=args.taxonomy)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.unclassified:
+            selection = unclassified_selection(classifier.pairs)
+        else:
+            try:
+                selection = parse_selection(args.select, classifier.pairs)
+            except ValueError as e:
+                parser.error(str(e))
+        selection = dict(sorted(selection.items(), key=lambda x: catalog.chapter_order(x[0])))
+        if not selection:
+            parser.error("Nothing to classify")
+        classifier.integrity_check = not args.ignore_integrity
+        try:
+            classifier.check_integrity(list(selection))
+        except ValueError as e:
+            parser.error(str(e))
+
+        run = journal.RunJournal.new(classifier.taxonomy)
+        run.write_selection(selection)
+        queued = WorkQueue(args.queue).enqueue(run.run_id, selection, max_attempts=args.max_attempts)
+        logging.info(f"Queued {queued} splits of {list(selection)} as run '{run.run_id}'")
+
+    elif args.command == "work":
+        classifier_options = {
+            "transcript_encoding": args.transcript_encoding,
+            "max_line_chars": args.max_line_chars,
+            "prompt_cache_key": args.prompt_cache_key,
+            "structured_output": args.structured_output,
+            "taxonomy_name": args.taxonomy
+        }
+        kwargs = {"queue_path": args.queue, "lease_s": args.lease, "max_jobs": args.max_jobs, "wait": args.wait,
+                  "classifier_options": classifier_options}
+        if args.workers == 1:
+            work(**kwargs)
+        else:
+            ctx = multiprocessing.get_context("spawn")
+            processes = [ctx.Process(target=_work_process, args=(kwargs,)) for _ in range(args.workers)]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+
+    elif args.command == "status":
+        for row in WorkQueue(args.queue).counts():
+            print(f"{row['run_id']:<45} {row['status']:<8} {row['jobs']}")
+
+    elif args.command == "requeue":
+        queue = WorkQueue(args.queue)
+        requeued = queue.requeue_failed(args.run)
+        logging.info(f"Requeued {requeued} failed jobs")
+
+        missing = missing_outputs(queue, args.run)
+        if missing:
+            owner = f"{socket.gethostname()}:{os.getpid()}"
+            classifier = Classifier()
+            for row in missing:
+                # Finalized by a worker that failed or died while writing the outputs
+                queue.release_finalization(row["run_id"], row["chapter"])
+                finalize(queue, classifier, journal.RunJournal.open(row["run_id"]), row["chapter"], owner)